@@ -0,0 +1,4 @@
+"""Compiler throughput benchmarks.
+
+See `benchmarks.compile_throughput` for the runner.
+"""
@@ -0,0 +1,222 @@
+"""
+Compiler throughput benchmarks.
+
+Generates SPy programs that scale along one axis at a time (see
+`benchmarks.generators`) and records the time spent in each compiler stage:
+`frontend`, `middle_end`, `lower` (`Lowering.lower`, summed over functions)
+and `run_passes`.
+
+Usage:
+
+    python -m benchmarks.compile_throughput run -o results.json
+    python -m benchmarks.compile_throughput run --axis loop_nesting \\
+        --sizes 1,2,4,8
+    python -m benchmarks.compile_throughput compare base.json new.json
+
+`run` prints the log-log slope of each stage against the size of the axis;
+a slope well above 1 indicates a super-linear stage. `compare` reports
+stages that got slower between two result files, e.g. from two commits.
+"""
+
+from __future__ import annotations
+
+import json
+import math
+import os
+import platform
+import subprocess as subp
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import click
+
+from benchmarks.generators import DEFAULT_SIZES, GENERATORS
+
+STAGES = ("frontend", "middle_end", "lower", "run_passes")
+
+SUPERLINEAR_SLOPE = 1.3
+"""Slopes above this value are flagged as super-linear."""
+
+
+def _git_commit() -> str:
+    try:
+        return subp.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            encoding="utf8",
+            stderr=subp.DEVNULL,
+        ).strip()
+    except (OSError, subp.CalledProcessError):
+        return "unknown"
+
+
+def measure(source: str, repeat: int) -> dict[str, float]:
+    """Compile `source` `repeat` times and return the best time per stage."""
+    from nbcc.compiler import compile_to_mlir
+    from nbcc.profiling import CompileStats
+
+    best: dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "bench.spy"
+        path.write_text(source)
+        for _ in range(repeat):
+            stats = CompileStats()
+            compile_to_mlir(str(path), stats=stats)
+            for name in (*STAGES, "compile_to_mlir"):
+                elapsed = stats.total(name)
+                best[name] = min(best.get(name, math.inf), elapsed)
+    return best
+
+
+def slope(sizes: list[int], times: list[float]) -> float:
+    """Least-squares slope of log(time) against log(size)."""
+    points = [
+        (math.log(s), math.log(t))
+        for s, t in zip(sizes, times, strict=True)
+        if s > 0 and t > 0
+    ]
+    if len(points) < 2:
+        return math.nan
+    mx = sum(x for x, _ in points) / len(points)
+    my = sum(y for _, y in points) / len(points)
+    sxx = sum((x - mx) ** 2 for x, _ in points)
+    if sxx == 0:
+        return math.nan
+    return sum((x - mx) * (y - my) for x, y in points) / sxx
+
+
+def run_axis(axis: str, sizes: list[int], repeat: int) -> list[dict[str, Any]]:
+    generate = GENERATORS[axis]
+    results = []
+    for size in sizes:
+        click.echo(f"{axis}={size} ...", err=True)
+        results.append(
+            {
+                "axis": axis,
+                "size": size,
+                "stages": measure(generate(size), repeat),
+            }
+        )
+    return results
+
+
+def format_slopes(results: list[dict[str, Any]]) -> str:
+    lines = [f"{'axis':<16}" + "".join(f"{s:>12}" for s in STAGES)]
+    for axis in dict.fromkeys(r["axis"] for r in results):
+        rows = [r for r in results if r["axis"] == axis]
+        sizes = [r["size"] for r in rows]
+        cells = []
+        for stage in STAGES:
+            k = slope(sizes, [r["stages"][stage] for r in rows])
+            mark = "!" if k > SUPERLINEAR_SLOPE else " "
+            cells.append(f"{k:>11.2f}{mark}")
+        lines.append(f"{axis:<16}" + "".join(cells))
+    lines.append(f"(! marks slopes above {SUPERLINEAR_SLOPE}: super-linear)")
+    return "\n".join(lines)
+
+
+@click.group()
+def main():
+    """Compiler throughput benchmarks."""
+
+
+@main.command()
+@click.option(
+    "--axis",
+    "axes",
+    multiple=True,
+    type=click.Choice(sorted(GENERATORS)),
+    help="Axis to measure (repeatable; default: all)",
+)
+@click.option(
+    "--sizes",
+    default=None,
+    help="Comma separated sizes (default: per-axis defaults)",
+)
+@click.option("--repeat", default=3, show_default=True, type=int)
+@click.option(
+    "--output",
+    "-o",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write the results as JSON",
+)
+def run(axes, sizes, repeat, output):
+    """Measure the compiler stages along each axis."""
+    from nbcc.developer import set_release_mode
+
+    # Measure the compiler, not the debug dumps.
+    set_release_mode(True)
+    # Every repeat redshifts the source rather than loading it from the
+    # cache
+    os.environ["NBCC_DISABLE_CACHE"] = "1"
+
+    results = []
+    for axis in axes or sorted(GENERATORS):
+        axis_sizes = (
+            [int(s) for s in sizes.split(",")]
+            if sizes
+            else DEFAULT_SIZES[axis]
+        )
+        results.extend(run_axis(axis, axis_sizes, repeat))
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.time(),
+        "python": sys.version,
+        "machine": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+    if output:
+        with open(output, "w") as fout:
+            json.dump(report, fout, indent=2)
+    click.echo(format_slopes(results))
+
+
+@main.command()
+@click.argument("base", type=click.Path(exists=True, dir_okay=False))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--threshold",
+    default=1.1,
+    show_default=True,
+    help="Report stages whose time ratio new/base exceeds this",
+)
+def compare(base, new, threshold):
+    """Compare two result files and report regressions."""
+    with open(base) as fin:
+        base_report = json.load(fin)
+    with open(new) as fin:
+        new_report = json.load(fin)
+
+    base_times = {
+        (r["axis"], r["size"], stage): t
+        for r in base_report["results"]
+        for stage, t in r["stages"].items()
+    }
+    click.echo(f"base: {base_report['commit']}")
+    click.echo(f"new:  {new_report['commit']}")
+    regressions = 0
+    for r in new_report["results"]:
+        for stage in STAGES:
+            key = (r["axis"], r["size"], stage)
+            if key not in base_times or base_times[key] <= 0:
+                continue
+            ratio = r["stages"][stage] / base_times[key]
+            if ratio > threshold:
+                regressions += 1
+                click.echo(
+                    f"{r['axis']}={r['size']:<5} {stage:<12}"
+                    f" {base_times[key]:.4f}s -> {r['stages'][stage]:.4f}s"
+                    f" ({ratio:.2f}x)"
+                )
+    if not regressions:
+        click.echo("no regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Generators of synthetic SPy programs for the compiler benchmarks.
+
+Each generator takes a single size parameter and returns the source of a
+SPy module. The programs only grow along the named axis so that the cost of
+each compiler stage can be measured as a function of that axis.
+"""
+
+from __future__ import annotations
+
+from typing import Callable
+
+
+def _indent(depth: int) -> str:
+    return "    " * depth
+
+
+def gen_functions(n: int) -> str:
+    """`n` small functions, all called from `main`."""
+    lines = []
+    for i in range(n):
+        lines += [
+            f"def func_{i}(x: i32) -> i32:",
+            f"    return x + {i}",
+            "",
+            "",
+        ]
+    lines += ["def main() -> i32:", "    c = 0"]
+    lines += [f"    c = func_{i}(c)" for i in range(n)]
+    lines += ["    print(c)", "    return 0"]
+    return "\n".join(lines) + "\n"
+
+
+def gen_statements(n: int) -> str:
+    """A single basic block with `n` arithmetic statements."""
+    lines = ["def main() -> i32:", "    a0 = 1"]
+    for i in range(1, n + 1):
+        lines.append(f"    a{i} = a{i - 1} + {i}")
+    lines += [f"    print(a{n})", "    return 0"]
+    return "\n".join(lines) + "\n"
+
+
+def gen_ifelse_nesting(depth: int) -> str:
+    """If-else statements nested `depth` deep in both branches' path."""
+    lines = ["def main() -> i32:", "    a = 1", "    c = 0"]
+    for d in range(depth):
+        ind = _indent(d + 1)
+        lines += [f"{ind}if a > {d}:", f"{ind}    c = c + {d}"]
+    ind = _indent(depth + 1)
+    lines.append(f"{ind}c = c + a")
+    for d in reversed(range(depth)):
+        ind = _indent(d + 1)
+        lines += [f"{ind}else:", f"{ind}    c = c - {d}"]
+    lines += ["    print(c)", "    return 0"]
+    return "\n".join(lines) + "\n"
+
+
+def gen_loop_nesting(depth: int) -> str:
+    """While loops nested `depth` deep."""
+    lines = ["def main() -> i32:", "    c = 0"]
+    for d in range(depth):
+        ind = _indent(d + 1)
+        lines += [f"{ind}i{d} = 0", f"{ind}while i{d} < 2:"]
+    lines.append(f"{_indent(depth + 1)}c = c + 1")
+    for d in reversed(range(depth)):
+        lines.append(f"{_indent(d + 2)}i{d} = i{d} + 1")
+    lines += ["    print(c)", "    return 0"]
+    return "\n".join(lines) + "\n"
+
+
+def gen_structs(n: int) -> str:
+    """`n` struct types, each constructed and read in `main`."""
+    lines = []
+    for i in range(n):
+        lines += [
+            "@struct",
+            f"class Point{i}:",
+            "    x: i32",
+            "    y: i32",
+            "",
+            "",
+        ]
+    lines += ["def main() -> i32:", "    c = 0"]
+    for i in range(n):
+        lines += [
+            f"    p{i} = Point{i}({i}, {i + 1})",
+            f"    c = c + p{i}.x + p{i}.y",
+        ]
+    lines += ["    print(c)", "    return 0"]
+    return "\n".join(lines) + "\n"
+
+
+_TENSOR_PREAMBLE = """\
+from mlir import MLIR_Type, MLIR_op, MLIR_asm
+
+
+@blue
+def MLIR_tensor_2d(dtype: MLIR_Type):
+    return MLIR_Type("tensor<?x?x{}>", dtype)
+
+
+@blue
+def MLIR_memref_2d(dtype: MLIR_Type):
+    return MLIR_Type("memref<?x?x{}>", dtype)
+
+
+@blue
+def make_tensor_type_2d(DTYPE: MLIR_Type):
+    T = MLIR_tensor_2d(DTYPE)
+
+    T_index = MLIR_Type("index")
+    mlir_i64_to_index = MLIR_asm("arith.index_cast", T_index, (i32,))
+    mlir_tensor_dim = MLIR_asm("tensor.dim", T_index, (T, T_index))
+    mlir_tensor_empty = MLIR_asm("tensor.empty", T, (T_index, T_index))
+    mlir_linalg_add = MLIR_op("linalg.add", T, (T, T, T))
+    mlir_linalg_sub = MLIR_op("linalg.sub", T, (T, T, T))
+    mlir_linalg_exp = MLIR_op("linalg.exp", T, (T, T))
+
+    @struct
+    class TensorType:
+        __ll__: T
+
+        def __new__(value: T) -> TensorType:
+            return TensorType.__make__(value)
+
+        def __add__(self: TensorType, other: TensorType) -> TensorType:
+            lhs = self.__ll__
+            rhs = other.__ll__
+            dim0 = mlir_tensor_dim(lhs, mlir_i64_to_index(0))
+            dim1 = mlir_tensor_dim(lhs, mlir_i64_to_index(1))
+            res = mlir_tensor_empty(dim0, dim1)
+            res = mlir_linalg_add(lhs, rhs, res)
+            return TensorType(res)
+
+        def __sub__(self: TensorType, other: TensorType) -> TensorType:
+            lhs = self.__ll__
+            rhs = other.__ll__
+            dim0 = mlir_tensor_dim(lhs, mlir_i64_to_index(0))
+            dim1 = mlir_tensor_dim(lhs, mlir_i64_to_index(1))
+            res = mlir_tensor_empty(dim0, dim1)
+            res = mlir_linalg_sub(lhs, rhs, res)
+            return TensorType(res)
+
+        def exp(self: TensorType) -> TensorType:
+            src = self.__ll__
+            dim0 = mlir_tensor_dim(src, mlir_i64_to_index(0))
+            dim1 = mlir_tensor_dim(src, mlir_i64_to_index(1))
+            res = mlir_tensor_empty(dim0, dim1)
+            res = mlir_linalg_exp(src, res)
+            return TensorType(res)
+
+    return TensorType
+
+
+@blue
+def exported() -> None:
+    F64 = MLIR_Type("f64")
+    MemRefF64 = MLIR_memref_2d(F64)
+    TensorF64 = make_tensor_type_2d(F64)
+
+    to_tensor = MLIR_asm(
+        "bufferization.to_tensor {restrict}", TensorF64, (MemRefF64,)
+    )
+    to_memref = MLIR_asm("bufferization.to_buffer", MemRefF64, (TensorF64,))
+"""
+
+
+def gen_tensor_chain(n: int) -> str:
+    """An exported kernel applying a chain of `n` elementwise tensor ops."""
+    ops = ["t{prev} + tb", "t{prev} - tb", "t{prev}.exp()"]
+    ind = _indent(1)
+    lines = [
+        f"{ind}def export_chain(a: MemRefF64, b: MemRefF64) -> MemRefF64:",
+        f"{ind}    t0 = to_tensor(a)",
+        f"{ind}    tb = to_tensor(b)",
+    ]
+    for i in range(1, n + 1):
+        expr = ops[(i - 1) % len(ops)].format(prev=i - 1)
+        lines.append(f"{ind}    t{i} = {expr}")
+    lines += [
+        f"{ind}    return to_memref(t{n})",
+        "",
+        f"{ind}return None",
+        "",
+        "",
+        "_ = exported()",
+    ]
+    return _TENSOR_PREAMBLE + "\n" + "\n".join(lines) + "\n"
+
+
+GENERATORS: dict[str, Callable[[int], str]] = {
+    "functions": gen_functions,
+    "statements": gen_statements,
+    "ifelse_nesting": gen_ifelse_nesting,
+    "loop_nesting": gen_loop_nesting,
+    "structs": gen_structs,
+    "tensor_chain": gen_tensor_chain,
+}
+"""Program generators keyed by the axis they scale."""
+
+DEFAULT_SIZES: dict[str, list[int]] = {
+    "functions": [1, 2, 4, 8, 16, 32],
+    "statements": [8, 16, 32, 64, 128, 256],
+    "ifelse_nesting": [1, 2, 3, 4, 6, 8],
+    "loop_nesting": [1, 2, 3, 4, 6, 8],
+    "structs": [1, 2, 4, 8, 16],
+    "tensor_chain": [1, 2, 4, 8, 16, 32],
+}
+"""Sizes measured along each axis when none are given."""
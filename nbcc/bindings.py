@@ -0,0 +1,480 @@
+"""
+Python bindings of the exported functions of a shared library.
+
+`nbcc shared --bindings input.spy out.so` writes ``out_bindings.py`` next
+to the library. It exposes every exported function as a callable taking and
+returning NumPy arrays:
+
+    from out_bindings import export_softmax
+    result = export_softmax(A)
+
+instead of the manual ctypes pattern:
+
+    fn = getattr(CDLL("out.so"), "_mlir_ciface_spy_out$exported$export_softmax")
+    out_memref = (make_nd_memref_descriptor(2, c_double) * 1)()
+    fn(out_memref, byref(get_ranked_memref_descriptor(A)))
+    result = ranked_memref_to_numpy(out_memref)  # never freed
+
+`Kernel` builds the ctypes descriptor classes and sets `argtypes` once, when
+the binding module is imported; a call only checks the dtype, rank and
+contiguity of the arguments and fills in the descriptors.
+
+The signatures of the exported functions are recorded by the backend (see
+`nbcc.mlir_backend.exports`). This module does not depend on MLIR, so the
+generated bindings only need NumPy at runtime.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import keyword
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Sequence
+
+import numpy as np
+
+CIFACE_PREFIX = "_mlir_ciface_"
+
+# Storage type of the MLIR element types. bf16 has no NumPy dtype and is
+# passed as its bit pattern in uint16.
+_STORAGE_DTYPES = {
+    "i1": np.bool_,
+    "i8": np.int8,
+    "i16": np.int16,
+    "i32": np.int32,
+    "i64": np.int64,
+    "f16": np.float16,
+    "bf16": np.uint16,
+    "f32": np.float32,
+    "f64": np.float64,
+}
+
+
+def is_supported_element_type(element_type: str) -> bool:
+    return element_type in _STORAGE_DTYPES
+
+
+@dataclass(frozen=True)
+class Param:
+    """A parameter or result of an exported function.
+
+    Attributes:
+        element_type: MLIR element type, e.g. ``"f64"``.
+        rank: Rank of a memref; None for a scalar.
+    """
+
+    element_type: str
+    rank: int | None = None
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(_STORAGE_DTYPES[self.element_type])
+
+    def format(self) -> str:
+        if self.rank is None:
+            return self.element_type
+        dims = ", ".join(":" * self.rank) if self.rank else ""
+        return f"{self.element_type}[{dims}]"
+
+    def to_json(self) -> list:
+        return [self.element_type, self.rank]
+
+    @classmethod
+    def from_json(cls, data: Sequence) -> Param:
+        element_type, rank = data
+        return cls(element_type, rank)
+
+
+@dataclass(frozen=True)
+class ExportSpec:
+    """Signature of an exported function.
+
+    Attributes:
+        symbol: Symbol name, without the `_mlir_ciface_` prefix.
+        params: Parameters, in order.
+        results: Results; at most one.
+        bare_symbol: Symbol of the bare-pointer entry point, if any; see
+            `nbcc.mlir_backend.bare_ptr`.
+    """
+
+    symbol: str
+    params: tuple[Param, ...]
+    results: tuple[Param, ...]
+    bare_symbol: str | None = None
+
+    @property
+    def name(self) -> str:
+        """The SPy name, e.g. ``"export_softmax"``."""
+        return self.symbol.rsplit("$", 1)[-1]
+
+    def format(self) -> str:
+        params = ", ".join(p.format() for p in self.params)
+        results = ", ".join(r.format() for r in self.results) or "None"
+        return f"{self.name}({params}) -> {results}"
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "symbol": self.symbol,
+            "params": [p.to_json() for p in self.params],
+            "results": [r.to_json() for r in self.results],
+            "bare_symbol": self.bare_symbol,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> ExportSpec:
+        return cls(
+            data["symbol"],
+            tuple(Param.from_json(p) for p in data["params"]),
+            tuple(Param.from_json(r) for r in data["results"]),
+            data.get("bare_symbol"),
+        )
+
+
+class _MemRefDescriptor(ctypes.Structure):
+    """Base of the ranked memref descriptors.
+
+    Same layout as `mlir.runtime.make_nd_memref_descriptor()`, but with
+    untyped pointers so that array addresses can be assigned directly.
+    """
+
+
+_descriptor_classes: dict[int, type[_MemRefDescriptor]] = {}
+
+
+def memref_descriptor_class(rank: int) -> type[_MemRefDescriptor]:
+    """The descriptor class of rank `rank`; created once per rank."""
+    cls = _descriptor_classes.get(rank)
+    if cls is None:
+        fields: list[tuple[str, Any]] = [
+            ("allocated", ctypes.c_void_p),
+            ("aligned", ctypes.c_void_p),
+            ("offset", ctypes.c_longlong),
+        ]
+        if rank:
+            fields += [
+                ("shape", ctypes.c_longlong * rank),
+                ("strides", ctypes.c_longlong * rank),
+            ]
+        cls = type(
+            f"MemRefDescriptor{rank}D",
+            (_MemRefDescriptor,),
+            {"_fields_": fields},
+        )
+        _descriptor_classes[rank] = cls
+    return cls
+
+
+def _scalar_ctype(param: Param) -> Any:
+    return np.ctypeslib.as_ctypes_type(param.dtype)
+
+
+class Kernel:
+    """Callable binding of an exported function of a shared library.
+
+    Memref parameters take C-contiguous NumPy arrays of the exact dtype and
+    rank; scalar parameters take Python numbers. A memref result is
+    returned as a NumPy array that owns the buffer allocated by the kernel
+    and frees it when collected (see `take_memref()`). With libraries
+    built without a deallocation entry point the buffer is never freed.
+
+    Args:
+        library: The loaded shared library.
+        spec: Signature of the function.
+    """
+
+    def __init__(self, library: ctypes.CDLL, spec: ExportSpec):
+        if len(spec.results) > 1:
+            raise NotImplementedError(
+                f"{spec.name}: multiple results are not supported"
+            )
+        self.spec = spec
+        self.__name__ = spec.name
+        self.__doc__ = spec.format()
+        fn = getattr(library, CIFACE_PREFIX + spec.symbol)
+        argtypes = []
+        self._result_cls = None
+        self._result_param = spec.results[0] if spec.results else None
+        if self._result_param is not None:
+            if self._result_param.rank is None:
+                fn.restype = _scalar_ctype(self._result_param)
+            else:
+                self._result_cls = memref_descriptor_class(
+                    self._result_param.rank
+                )
+                self._result_dtype = self._result_param.dtype
+                self._dealloc = find_dealloc(library)
+                argtypes.append(ctypes.POINTER(self._result_cls))
+                fn.restype = None
+        else:
+            fn.restype = None
+        # (descriptor class or None for scalars, dtype, rank)
+        self._params = []
+        for param in spec.params:
+            if param.rank is None:
+                argtypes.append(_scalar_ctype(param))
+                self._params.append((None, param.dtype, None))
+            else:
+                cls = memref_descriptor_class(param.rank)
+                argtypes.append(ctypes.POINTER(cls))
+                self._params.append((cls, param.dtype, param.rank))
+        fn.argtypes = argtypes
+        self._fn = fn
+        self._nargs = len(spec.params)
+
+    def __call__(self, *args: Any) -> Any:
+        if len(args) != self._nargs:
+            raise TypeError(
+                f"{self.__name__}() takes {self._nargs} arguments,"
+                f" got {len(args)}"
+            )
+        cargs: list[Any] = []
+        if self._result_cls is not None:
+            result = self._result_cls()
+            cargs.append(result)
+        for i, (arg, (cls, dtype, rank)) in enumerate(zip(args, self._params)):
+            if cls is None:
+                cargs.append(arg)
+                continue
+            if (
+                not isinstance(arg, np.ndarray)
+                or arg.dtype != dtype
+                or arg.ndim != rank
+                or not arg.flags.c_contiguous
+            ):
+                self._raise_bad_argument(i, arg)
+            address = arg.ctypes.data
+            itemsize = dtype.itemsize
+            if rank:
+                strides = tuple(s // itemsize for s in arg.strides)
+                cargs.append(cls(address, address, 0, arg.shape, strides))
+            else:
+                cargs.append(cls(address, address, 0))
+        value = self._fn(*cargs)
+        if self._result_cls is not None:
+            return take_memref(result, self._dealloc, self._result_dtype)
+        return value
+
+    def _raise_bad_argument(self, index: int, arg: Any) -> None:
+        expected = self.spec.params[index]
+        if isinstance(arg, np.ndarray):
+            got = f"{arg.ndim}-d {arg.dtype} array"
+            if not arg.flags.c_contiguous:
+                got = f"non-contiguous {got}"
+        else:
+            got = type(arg).__name__
+        raise TypeError(
+            f"argument {index} of {self.__name__}: expected a C-contiguous"
+            f" {expected.rank}-d {expected.dtype} array, got {got}"
+        )
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.spec.format()}>"
+
+
+class BarePtrKernel(Kernel):
+    """Binding of the bare-pointer entry point of an exported function.
+
+    Each array is passed as its data pointer followed by its sizes, so no
+    descriptor is built. Only for functions without memref results.
+    """
+
+    def __init__(self, library: ctypes.CDLL, spec: ExportSpec):
+        if spec.bare_symbol is None:
+            raise ValueError(f"{spec.name} has no bare-pointer entry point")
+        if any(r.rank is not None for r in spec.results):
+            raise NotImplementedError(
+                f"{spec.name}: memref results need the C interface"
+            )
+        self.spec = spec
+        self.__name__ = spec.name
+        self.__doc__ = spec.format()
+        fn = getattr(library, spec.bare_symbol)
+        argtypes: list[Any] = []
+        self._params = []
+        for param in spec.params:
+            if param.rank is None:
+                argtypes.append(_scalar_ctype(param))
+            else:
+                argtypes += [ctypes.c_void_p] + [ctypes.c_int64] * param.rank
+            self._params.append((param.rank, param.dtype))
+        fn.argtypes = argtypes
+        fn.restype = _scalar_ctype(spec.results[0]) if spec.results else None
+        self._fn = fn
+        self._nargs = len(spec.params)
+
+    def __call__(self, *args: Any) -> Any:
+        if len(args) != self._nargs:
+            raise TypeError(
+                f"{self.__name__}() takes {self._nargs} arguments,"
+                f" got {len(args)}"
+            )
+        cargs: list[Any] = []
+        for i, (arg, (rank, dtype)) in enumerate(zip(args, self._params)):
+            if rank is None:
+                cargs.append(arg)
+                continue
+            if (
+                not isinstance(arg, np.ndarray)
+                or arg.dtype != dtype
+                or arg.ndim != rank
+                or not arg.flags.c_contiguous
+            ):
+                self._raise_bad_argument(i, arg)
+            cargs.append(arg.ctypes.data)
+            cargs += arg.shape
+        return self._fn(*cargs)
+
+
+def bind(library: ctypes.CDLL, spec: ExportSpec) -> Kernel:
+    """The fastest binding available for `spec`."""
+    if spec.bare_symbol is not None and not any(
+        r.rank is not None for r in spec.results
+    ):
+        return BarePtrKernel(library, spec)
+    return Kernel(library, spec)
+
+
+DEALLOC_SYMBOL = "_nbcc_dealloc"
+"""Deallocation entry point of the libraries; see
+`nbcc.mlir_backend.ownership`."""
+
+
+def find_dealloc(library: ctypes.CDLL) -> Any:
+    """The deallocation entry point of `library`, or None for libraries
+    built without one."""
+    try:
+        dealloc = getattr(library, DEALLOC_SYMBOL)
+    except AttributeError:
+        return None
+    dealloc.argtypes = [ctypes.c_void_p]
+    dealloc.restype = None
+    return dealloc
+
+
+class _OwnedMemRef:
+    """Base object of the arrays returned by `take_memref()`. Frees the
+    buffer when the last array viewing it is collected."""
+
+    __slots__ = ("__array_interface__", "_dealloc", "_allocated")
+
+    def __init__(self, interface: dict, dealloc: Any, allocated: int):
+        self.__array_interface__ = interface
+        self._dealloc = dealloc
+        self._allocated = allocated
+
+    def __del__(self):
+        self._dealloc(self._allocated)
+
+
+class _UnownedMemRef:
+    __slots__ = ("__array_interface__",)
+
+    def __init__(self, interface: dict):
+        self.__array_interface__ = interface
+
+
+def _address(pointer: Any) -> int | None:
+    if pointer is None or isinstance(pointer, int):
+        return pointer
+    # Typed pointer of the `mlir.runtime` descriptors
+    return ctypes.cast(pointer, ctypes.c_void_p).value
+
+
+def take_memref(
+    descriptor: Any, dealloc: Any = None, dtype: Any = None
+) -> np.ndarray:
+    """Wrap a memref returned by a kernel as a NumPy array, without copying.
+
+    Args:
+        descriptor: Ranked memref descriptor, of `memref_descriptor_class()`
+            or `mlir.runtime.make_nd_memref_descriptor()`.
+        dealloc: Deallocation function (see `find_dealloc()`). The array
+            takes ownership of the buffer and frees it with `dealloc` when
+            it is collected. With None the buffer is never freed, like with
+            `ranked_memref_to_numpy`.
+        dtype: Element type; inferred from the typed pointers of
+            `mlir.runtime` descriptors.
+    """
+    if dtype is None:
+        dtype = type(descriptor.aligned)._type_
+    dtype = np.dtype(dtype)
+    shape = tuple(descriptor.shape) if hasattr(descriptor, "shape") else ()
+    allocated = _address(descriptor.allocated)
+    aligned = _address(descriptor.aligned)
+    if not aligned or 0 in shape:
+        if dealloc is not None and allocated:
+            dealloc(allocated)
+        return np.empty(shape, dtype=dtype)
+    itemsize = dtype.itemsize
+    strides = tuple(s * itemsize for s in descriptor.strides) if shape else ()
+    interface = {
+        "version": 3,
+        "data": (aligned + descriptor.offset * itemsize, False),
+        "shape": shape,
+        "strides": strides,
+        "typestr": dtype.str,
+    }
+    if dealloc is None:
+        owner: Any = _UnownedMemRef(interface)
+    else:
+        owner = _OwnedMemRef(interface, dealloc, allocated)
+    return np.asarray(owner)
+
+
+def load_library(module_file: str, library_name: str) -> ctypes.CDLL:
+    """Load the library `library_name` next to the binding module."""
+    return ctypes.CDLL(
+        os.path.join(os.path.dirname(module_file), library_name)
+    )
+
+
+def bindings_path(library_path: str | Path) -> Path:
+    """Path of the binding module of a shared library: ``out.so`` ->
+    ``out_bindings.py``.
+
+    Not ``out.py``: the import system would pick the library itself as an
+    extension module.
+    """
+    path = Path(library_path)
+    return path.with_name(f"{path.stem}_bindings.py")
+
+
+def generate_bindings(exports: Sequence[ExportSpec], library_name: str) -> str:
+    """Source of the binding module of the library `library_name`."""
+    lines = [
+        f'"""Bindings of {library_name}, generated by nbcc. Do not edit."""',
+        "",
+        "from nbcc.bindings import ExportSpec, bind, load_library",
+        "",
+        f"_lib = load_library(__file__, {library_name!r})",
+        "",
+    ]
+    names = []
+    for spec in exports:
+        name = spec.name
+        if not name.isidentifier() or keyword.iskeyword(name):
+            name = f"{name}_"
+        if name in names:
+            continue
+        names.append(name)
+        lines += [
+            "",
+            f"{name} = bind(",
+            "    _lib,",
+            f"    ExportSpec.from_json({spec.to_json()!r}),",
+            ")",
+            f'"""{spec.format()}"""',
+        ]
+    lines += ["", f"__all__ = {names!r}", ""]
+    return "\n".join(lines)
+
+
+def write_bindings(
+    exports: Sequence[ExportSpec], library_path: str | Path
+) -> Path:
+    """Write the binding module of the library at `library_path`."""
+    out = bindings_path(library_path)
+    out.write_text(generate_bindings(exports, Path(library_path).name))
+    return out
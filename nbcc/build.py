@@ -0,0 +1,433 @@
+"""
+Batch builds: `nbcc build`.
+
+Builds many SPy sources in one command instead of one `nbcc shared` process
+per file. The targets come from source paths or glob patterns, with the
+outputs in an output directory, or from a JSON manifest:
+
+    {
+      "output_dir": "build",
+      "targets": [
+        {"source": "kernels/softmax.spy"},
+        {"source": "kernels/matmul.spy", "output": "mm.so", "bindings": true},
+        {"source": "tools/bench.spy", "kind": "binary"}
+      ]
+    }
+
+Paths in a manifest are relative to its directory and outputs to
+``output_dir``. The default output is the stem of the source, with the
+shared library suffix for ``"shared"`` targets.
+
+The targets are ordered by their SPy imports: a target that imports the
+source of another target is built after it, and is skipped if it failed.
+Each target is compiled by one worker of a process pool, from the frontend
+to the native code; the workers share the artifact cache, so unchanged
+targets are copied from it. `build()` returns a `BuildSummary` with the
+status and the time per stage of every target.
+"""
+
+from __future__ import annotations
+
+import glob
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field
+from functools import partial
+from graphlib import TopologicalSorter
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Mapping, Sequence
+
+from nbcc import profiling
+from nbcc.cache import find_imports
+from nbcc.developer import is_release_mode, set_release_mode
+from nbcc.profiling import CompileStats
+from nbcc.toolchain import ToolchainOptions
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+_logger = logging.getLogger(__name__)
+
+KINDS = ("shared", "binary")
+
+_shlib_suffix = ".dylib" if sys.platform == "darwin" else ".so"
+
+# The columns of the summary, and the stages they add up
+SUMMARY_STAGES = {
+    "frontend": ("frontend",),
+    "middle_end": ("middle_end",),
+    "passes": ("run_passes",),
+    "codegen": ("make_shared", "make_binary"),
+}
+
+
+@dataclass(frozen=True)
+class Target:
+    source: Path
+    output: Path
+    kind: str = "shared"
+    bindings: bool = False
+
+    def __post_init__(self) -> None:
+        if self.kind not in KINDS:
+            raise ValueError(
+                f"{self.source}: unknown target kind {self.kind!r}"
+            )
+
+    @property
+    def name(self) -> str:
+        return _display_path(self.source)
+
+
+def default_output(source: Path, out_dir: Path, kind: str) -> Path:
+    suffix = _shlib_suffix if kind == "shared" else ""
+    return out_dir / f"{source.stem}{suffix}"
+
+
+def targets_from_sources(
+    patterns: Iterable[str],
+    out_dir: str | Path,
+    *,
+    kind: str = "shared",
+    bindings: bool = False,
+) -> list[Target]:
+    """Targets for the sources matching the paths or glob patterns.
+
+    Raises:
+        ValueError: A pattern matches no file.
+    """
+    sources: dict[Path, None] = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if not matches:
+            raise ValueError(f"no source matches {pattern!r}")
+        sources.update((Path(match).resolve(), None) for match in matches)
+    out_dir = Path(out_dir)
+    return [
+        Target(src, default_output(src, out_dir, kind), kind, bindings)
+        for src in sources
+    ]
+
+
+def load_manifest(path: str | Path) -> list[Target]:
+    """Read the targets of a build manifest; see the module docstring.
+
+    Raises:
+        ValueError: The manifest is malformed.
+    """
+    path = Path(path)
+    data = json.loads(path.read_text(encoding="utf8"))
+    base = path.resolve().parent
+    out_dir = base / data.get("output_dir", "build")
+    targets = []
+    for entry in data.get("targets", []):
+        if "source" not in entry:
+            raise ValueError(f"{path}: target without a source: {entry}")
+        unknown = set(entry) - {"source", "output", "kind", "bindings"}
+        if unknown:
+            raise ValueError(
+                f"{path}: unknown target fields {sorted(unknown)}"
+            )
+        source = base / entry["source"]
+        if not source.is_file():
+            raise ValueError(f"{path}: no source {entry['source']!r}")
+        kind = entry.get("kind", "shared")
+        if "output" in entry:
+            output = out_dir / entry["output"]
+        else:
+            output = default_output(source, out_dir, kind)
+        targets.append(
+            Target(source, output, kind, bool(entry.get("bindings", False)))
+        )
+    return targets
+
+
+def dependency_graph(targets: Sequence[Target]) -> dict[Target, set[Target]]:
+    """Map every target to the targets whose source it imports,
+    transitively."""
+    by_source: dict[Path, list[Target]] = {}
+    for target in targets:
+        by_source.setdefault(target.source.resolve(), []).append(target)
+    return {
+        target: {
+            dep
+            for imported in find_imports(target.source)
+            for dep in by_source.get(imported, ())
+        }
+        for target in targets
+    }
+
+
+@dataclass(frozen=True)
+class TargetResult:
+    target: Target
+    # "built", "cached", "failed" or "skipped"
+    status: str
+    seconds: float = 0.0
+    # Wall time per column of `SUMMARY_STAGES`
+    stages: dict[str, float] = field(default_factory=dict)
+    error: str | None = None
+
+
+@dataclass(frozen=True)
+class BuildSummary:
+    results: list[TargetResult]
+    seconds: float
+    jobs: int
+
+    @property
+    def failed(self) -> list[TargetResult]:
+        return [r for r in self.results if r.status in ("failed", "skipped")]
+
+    def count(self, status: str) -> int:
+        return sum(r.status == status for r in self.results)
+
+    def format(self) -> str:
+        header = ["target", "status", "total", *SUMMARY_STAGES]
+        rows = [
+            [
+                r.target.name,
+                r.status,
+                f"{r.seconds:.2f}s",
+                *(
+                    f"{r.stages[col]:.2f}s" if r.stages.get(col) else "-"
+                    for col in SUMMARY_STAGES
+                ),
+            ]
+            for r in self.results
+        ]
+        widths = [max(map(len, col)) for col in zip(header, *rows)]
+        lines = [
+            "  ".join(
+                cell.ljust(w) if i < 2 else cell.rjust(w)
+                for i, (cell, w) in enumerate(zip(row, widths))
+            ).rstrip()
+            for row in [header, *rows]
+        ]
+        counts = ", ".join(
+            f"{self.count(status)} {status}"
+            for status in ("built", "cached", "failed", "skipped")
+            if self.count(status)
+        )
+        lines.append(
+            f"{len(self.results)} target(s): {counts} in"
+            f" {self.seconds:.2f}s with {self.jobs} job(s)"
+        )
+        for r in self.results:
+            if r.error:
+                lines.append(f"{r.target.name}: {r.error}")
+        return "\n".join(lines)
+
+
+@dataclass(frozen=True)
+class _BuildOptions:
+    use_cache: bool
+    backend_options: dict[str, Any]
+    toolchain: ToolchainOptions | None
+    middle_end_jobs: int
+    release: bool
+
+
+def build(
+    targets: Sequence[Target],
+    *,
+    jobs: int = 0,
+    use_cache: bool = True,
+    backend_options: Mapping[str, Any] | None = None,
+    toolchain: ToolchainOptions | None = None,
+    middle_end_jobs: int = 1,
+    progress: Callable[[TargetResult, int, int], None] | None = None,
+) -> BuildSummary:
+    """Build `targets` in dependency order.
+
+    Args:
+        jobs: Targets built at the same time, each in a worker process; 0
+            uses all cores. 1 builds in this process.
+        middle_end_jobs: Worker processes for the middle-end of each
+            target; see `nbcc.compiler.compile_to_mlir()`.
+        progress: Called with the result, its index and the number of
+            targets when a target is done.
+
+    Raises:
+        graphlib.CycleError: The sources import each other.
+        ValueError: Two targets have the same output.
+    """
+    outputs = [t.output.resolve() for t in targets]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError("several targets have the same output")
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    jobs = max(1, min(jobs, len(targets)))
+    options = _BuildOptions(
+        use_cache=use_cache,
+        backend_options=dict(backend_options or {}),
+        toolchain=toolchain,
+        middle_end_jobs=middle_end_jobs,
+        release=is_release_mode(),
+    )
+    graph = dependency_graph(targets)
+    start = time.perf_counter()
+    if jobs == 1:
+        results = _schedule(graph, _run_here, options, progress)
+    else:
+        pool = _Pool(jobs)
+        try:
+            results = _schedule(
+                graph, partial(pool.submit, _build_target), options, progress
+            )
+        finally:
+            pool.shutdown()
+    order = {target: i for i, target in enumerate(targets)}
+    results.sort(key=lambda r: order[r.target])
+    return BuildSummary(results, time.perf_counter() - start, jobs)
+
+
+class _Pool:
+    """A process pool that is recreated when one of its workers dies, e.g.
+    of a crash in MLIR, so that the rest of the batch is still built."""
+
+    def __init__(self, jobs: int):
+        self._jobs = jobs
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Spawn: the workers import the compiler themselves rather than
+        # inheriting the MLIR state of this process
+        return ProcessPoolExecutor(
+            max_workers=self._jobs,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future[Any]:
+        from concurrent.futures.process import BrokenProcessPool
+
+        try:
+            return self._executor.submit(fn, *args)
+        except BrokenProcessPool:
+            _logger.debug("a build worker died; starting a new pool")
+            self._executor.shutdown(wait=False)
+            self._executor = self._new_executor()
+            return self._executor.submit(fn, *args)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+def _run_here(target: Target, options: _BuildOptions) -> Future[TargetResult]:
+    future: Future[TargetResult] = Future()
+    future.set_result(_build_target(target, options))
+    return future
+
+
+def _schedule(
+    graph: dict[Target, set[Target]],
+    submit: Callable[[Target, _BuildOptions], Future[TargetResult]],
+    options: _BuildOptions,
+    progress: Callable[[TargetResult, int, int], None] | None,
+) -> list[TargetResult]:
+    sorter = TopologicalSorter(graph)
+    sorter.prepare()
+    results: list[TargetResult] = []
+    broken: set[Target] = set()
+    pending: dict[Future[TargetResult], Target] = {}
+
+    def finish(result: TargetResult) -> None:
+        if result.status in ("failed", "skipped"):
+            broken.add(result.target)
+        results.append(result)
+        sorter.done(result.target)
+        if progress is not None:
+            progress(result, len(results), len(graph))
+
+    while sorter.is_active():
+        for target in sorter.get_ready():
+            if failed_deps := sorted(
+                dep.name for dep in graph[target] & broken
+            ):
+                finish(
+                    TargetResult(
+                        target,
+                        "skipped",
+                        error=f"imports {', '.join(failed_deps)}, which"
+                        " failed",
+                    )
+                )
+            else:
+                pending[submit(target, options)] = target
+        if not pending:
+            continue
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            target = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                # E.g. BrokenProcessPool: the worker died
+                _logger.debug("building %s failed", target.name, exc_info=True)
+                result = TargetResult(target, "failed", error=_describe(e))
+            finish(result)
+    return results
+
+
+def _build_target(target: Target, options: _BuildOptions) -> TargetResult:
+    """Build one target; runs in a worker process."""
+    from nbcc import compiler
+
+    set_release_mode(options.release)
+    target.output.parent.mkdir(parents=True, exist_ok=True)
+    stats = CompileStats()
+    start = time.perf_counter()
+    try:
+        with profiling.collect(stats):
+            if target.kind == "shared":
+                compiler.compile_shared_lib(
+                    str(target.source),
+                    str(target.output),
+                    use_cache=options.use_cache,
+                    jobs=options.middle_end_jobs,
+                    backend_options=options.backend_options,
+                    toolchain=options.toolchain,
+                    bindings=target.bindings,
+                )
+            else:
+                compiler.compile(
+                    str(target.source),
+                    str(target.output),
+                    use_cache=options.use_cache,
+                    jobs=options.middle_end_jobs,
+                    backend_options=options.backend_options,
+                    toolchain=options.toolchain,
+                )
+    except Exception as e:
+        _logger.debug("building %s failed", target.name, exc_info=True)
+        return TargetResult(
+            target, "failed", time.perf_counter() - start, error=_describe(e)
+        )
+    seconds = time.perf_counter() - start
+    compiled = any(r.name == "compile_to_mlir" for r in stats.records)
+    stages = {
+        column: sum(stats.total(name) for name in names)
+        for column, names in SUMMARY_STAGES.items()
+    }
+    return TargetResult(
+        target, "built" if compiled else "cached", seconds, stages
+    )
+
+
+def _describe(e: BaseException) -> str:
+    return traceback.format_exception_only(e)[-1].strip()
+
+
+def _display_path(path: Path) -> str:
+    try:
+        return str(path.relative_to(Path.cwd()))
+    except ValueError:
+        return str(path)
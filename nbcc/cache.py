@@ -0,0 +1,446 @@
+"""
+Content-addressed on-disk cache for compiled artifacts.
+
+Shared libraries and executables produced by `nbcc.compiler` are stored
+under a key derived from everything that can influence the output:
+
+- the SPy source and every local `.spy` module it imports;
+- the backend class;
+- the compiler itself (which defines the pass pipeline) and the transform
+  sequences;
+- the versions of the external toolchain and of the Python packages of the
+  compiler, with the sources of the latter;
+- any extra build options.
+
+A cache hit copies the stored artifact to the requested output path without
+running any part of the compiler. The cache is bounded in size and evicts
+the least recently used artifacts first.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess as subp
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Iterator, Mapping
+
+_CACHE_FORMAT = "nbcc-artifact-cache-v1"
+
+DEFAULT_MAX_SIZE = 2 * 1024**3
+"""Default size bound of the artifact cache in bytes (2 GiB)."""
+
+TOOLS = ("mlir-opt", "mlir-translate", "opt", "llc", "clang", "llvm-config")
+
+_nbcc_dir = Path(os.path.dirname(__file__))
+
+_import_pattern = re.compile(
+    r"^\s*(?:from\s+([\w.]+)\s+import\b|import\s+([\w.]+))", re.MULTILINE
+)
+
+
+def default_cache_dir() -> Path:
+    """
+    Directory of the artifact cache.
+
+    Uses `$NBCC_CACHE_DIR` if set, otherwise `$XDG_CACHE_HOME/nbcc` or
+    `~/.cache/nbcc`.
+    """
+    if path := os.environ.get("NBCC_CACHE_DIR"):
+        return Path(path)
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "nbcc"
+
+
+def default_max_size() -> int:
+    """Size bound of the cache in bytes; override with `$NBCC_CACHE_SIZE`."""
+    if size := os.environ.get("NBCC_CACHE_SIZE"):
+        return int(size)
+    return DEFAULT_MAX_SIZE
+
+
+def is_cache_disabled() -> bool:
+    """The cache can be turned off with `NBCC_DISABLE_CACHE=1`."""
+    return os.environ.get("NBCC_DISABLE_CACHE", "0") not in ("", "0")
+
+
+def find_imports(path: str | Path) -> list[Path]:
+    """
+    Find the local `.spy` modules transitively imported by `path`.
+
+    Modules are resolved relative to the directory of `path`, which matches
+    the search path set up by `nbcc.frontend.redshift`. Imports that do not
+    resolve to a local file (e.g. the builtin `mlir` registry or the SPy
+    stdlib) are ignored; they are covered by the compiler fingerprint.
+
+    Returns:
+        The imported files sorted by path, excluding `path` itself.
+    """
+    path = Path(path).resolve()
+    searchdir = path.parent
+    seen: set[Path] = {path}
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        source = current.read_text(encoding="utf8")
+        for match in _import_pattern.finditer(source):
+            modname = match.group(1) or match.group(2)
+            candidate = searchdir / f"{modname.replace('.', '/')}.spy"
+            if candidate.exists() and candidate not in seen:
+                seen.add(candidate)
+                pending.append(candidate)
+    seen.remove(path)
+    return sorted(seen)
+
+
+def hash_sources(path: str | Path) -> str:
+    """Hash the source at `path` together with all its local imports."""
+    path = Path(path).resolve()
+    h = hashlib.sha256()
+    for filename in [path, *find_imports(path)]:
+        h.update(filename.name.encode())
+        h.update(b"\0")
+        h.update(_file_digest(filename).encode())
+    return h.hexdigest()
+
+
+def _file_digest(path: Path) -> str:
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def compiler_fingerprint() -> str:
+    """
+    Hash of the nbcc sources.
+
+    This covers the frontend, the middle-end rules, the lowering, the
+    pass pipelines defined by the backends and the C runtime.
+    """
+    h = hashlib.sha256()
+    sources = [*_nbcc_dir.rglob("*.py"), *_nbcc_dir.rglob("*.c")]
+    for filename in sorted(sources):
+        if "tests" in filename.relative_to(_nbcc_dir).parts:
+            continue
+        h.update(str(filename.relative_to(_nbcc_dir)).encode())
+        h.update(_file_digest(filename).encode())
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def transform_sequences_fingerprint() -> str:
+    """Hash of the MLIR transform sequences shipped with the MLIR backend."""
+    h = hashlib.sha256()
+    seqdir = _nbcc_dir / "mlir_backend" / "transform_sequences"
+    for filename in sorted(seqdir.glob("*.mlir")):
+        h.update(filename.name.encode())
+        h.update(_file_digest(filename).encode())
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def tool_versions() -> dict[str, str]:
+    """Version strings of the external tools used to build artifacts."""
+    versions = {}
+    for tool in TOOLS:
+        try:
+            out = subp.run(
+                [tool, "--version"],
+                capture_output=True,
+                encoding="utf8",
+                timeout=30,
+            ).stdout
+        except (OSError, subp.TimeoutExpired):
+            out = "<missing>"
+        versions[tool] = out.strip()
+    return versions
+
+
+@lru_cache(maxsize=None)
+def package_fingerprint(name: str) -> str:
+    """Hash of the Python and SPy sources of the installed package `name`.
+
+    Unlike the version, it changes with every commit of an editable
+    checkout, such as the SPy of `make setup-workspace`.
+    """
+    from importlib.util import find_spec
+
+    spec = find_spec(name)
+    if spec is None or not spec.submodule_search_locations:
+        return "<missing>"
+    h = hashlib.sha256()
+    for location in spec.submodule_search_locations:
+        root = Path(location)
+        sources = [*root.rglob("*.py"), *root.rglob("*.spy")]
+        for filename in sorted(sources):
+            h.update(str(filename.relative_to(root)).encode())
+            h.update(_file_digest(filename).encode())
+    return h.hexdigest()
+
+
+def _package_version(name: str) -> str:
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "<missing>"
+
+
+def compute_key_components(
+    path: str | Path,
+    *,
+    kind: str,
+    be_type: type | str,
+    options: Mapping[str, Any] | None = None,
+    source_digest: str | None = None,
+) -> dict[str, Any]:
+    """
+    Collect the inputs that determine the artifact built from `path`.
+
+    Args:
+        path: Path to the SPy source.
+        kind: Kind of artifact, e.g. ``"shared"`` or ``"binary"``.
+        be_type: The backend class used for compilation, or its qualified
+            name.
+        options: Extra build options that affect the output.
+        source_digest: Digest of the input of the build, in place of the
+            hash of the sources at `path`; e.g. of a module assembled by
+            `nbcc.watch`.
+
+    Returns:
+        A JSON-serializable dictionary.
+    """
+    if source_digest is None:
+        source_digest = hash_sources(path)
+    return {
+        "format": _CACHE_FORMAT,
+        "kind": kind,
+        "source": source_digest,
+        "backend": (
+            be_type
+            if isinstance(be_type, str)
+            else f"{be_type.__module__}.{be_type.__qualname__}"
+        ),
+        "compiler": compiler_fingerprint(),
+        "transforms": transform_sequences_fingerprint(),
+        "tools": tool_versions(),
+        # The versions miss the commits of the editable checkouts of
+        # `make setup-workspace`; the sources miss compiled extensions
+        "packages": {
+            name: [_package_version(name), package_fingerprint(name)]
+            for name in ("spy", "sealir", "egglog")
+        },
+        "python": sys.version,
+        "options": dict(options or {}),
+    }
+
+
+def compute_key(
+    path: str | Path,
+    *,
+    kind: str,
+    be_type: type | str,
+    options: Mapping[str, Any] | None = None,
+    source_digest: str | None = None,
+) -> str:
+    """Compute the cache key for building `path`.
+
+    See `compute_key_components()` for the arguments.
+    """
+    components = compute_key_components(
+        path,
+        kind=kind,
+        be_type=be_type,
+        options=options,
+        source_digest=source_digest,
+    )
+    encoded = json.dumps(components, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    directory: Path
+    entries: int
+    total_size: int
+    max_size: int
+    hits: int
+    misses: int
+
+    def format(self) -> str:
+        mib = 1024**2
+        return "\n".join(
+            [
+                f"directory:  {self.directory}",
+                f"entries:    {self.entries}",
+                f"size:       {self.total_size / mib:.1f} MiB"
+                f" / {self.max_size / mib:.1f} MiB",
+                f"hits:       {self.hits}",
+                f"misses:     {self.misses}",
+            ]
+        )
+
+
+class ArtifactCache:
+    """
+    Size-bounded, least-recently-used cache of build artifacts.
+
+    Each entry is stored as ``artifacts/<key>`` with a JSON metadata file
+    ``artifacts/<key>.json`` next to it. The modification time of the
+    artifact is refreshed on every hit and is used as the LRU clock.
+    """
+
+    def __init__(
+        self, directory: str | Path | None = None, max_size: int | None = None
+    ):
+        self.directory = Path(directory or default_cache_dir())
+        self.max_size = default_max_size() if max_size is None else max_size
+        self._artifacts = self.directory / "artifacts"
+        self._stats_file = self.directory / "stats.json"
+
+    def _artifact_path(self, key: str) -> Path:
+        return self._artifacts / key
+
+    def lookup(self, key: str) -> Path | None:
+        """Return the path of the cached artifact for `key`, if any."""
+        path = self._artifact_path(key)
+        if path.exists():
+            now = time.time()
+            os.utime(path, (now, now))
+            self._count("hits")
+            return path
+        self._count("misses")
+        return None
+
+    def fetch(self, key: str, out_path: str | Path) -> bool:
+        """Copy the artifact for `key` to `out_path`.
+
+        Returns:
+            True on a cache hit, False otherwise.
+        """
+        cached = self.lookup(key)
+        if cached is None:
+            return False
+        shutil.copyfile(cached, out_path)
+        shutil.copymode(cached, out_path)
+        return True
+
+    def metadata(self, key: str) -> dict[str, Any] | None:
+        """The metadata stored with the artifact for `key`, if any."""
+        try:
+            text = (
+                self._artifact_path(key).with_name(f"{key}.json").read_text()
+            )
+        except FileNotFoundError:
+            return None
+        return json.loads(text)
+
+    def store(
+        self,
+        key: str,
+        artifact: str | Path,
+        metadata: Mapping[str, Any] | None = None,
+    ) -> Path:
+        """Add `artifact` to the cache under `key` and evict old entries."""
+        self._artifacts.mkdir(parents=True, exist_ok=True)
+        dest = self._artifact_path(key)
+        # Write to a temporary file first so that concurrent readers never
+        # observe a partially written artifact.
+        fd, tmpname = tempfile.mkstemp(dir=self._artifacts, prefix=".tmp")
+        os.close(fd)
+        shutil.copyfile(artifact, tmpname)
+        shutil.copymode(artifact, tmpname)
+        os.replace(tmpname, dest)
+        meta = dict(metadata or {})
+        meta.setdefault("created", time.time())
+        _atomic_write_text(
+            dest.with_name(f"{key}.json"), json.dumps(meta, default=str)
+        )
+        self.evict()
+        return dest
+
+    def _entries(self) -> Iterator[tuple[Path, os.stat_result]]:
+        if not self._artifacts.exists():
+            return
+        for path in self._artifacts.iterdir():
+            if path.suffix == ".json" or path.name.startswith(".tmp"):
+                continue
+            try:
+                yield path, path.stat()
+            except FileNotFoundError:
+                # Removed concurrently
+                continue
+
+    def evict(self) -> int:
+        """Remove least recently used entries until the size bound is met.
+
+        Returns:
+            The number of entries removed.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        total = sum(st.st_size for _, st in entries)
+        removed = 0
+        for path, st in entries:
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= st.st_size
+            removed += 1
+        return removed
+
+    def clear(self) -> int:
+        """Remove all entries and reset the statistics.
+
+        Returns:
+            The number of entries removed.
+        """
+        removed = 0
+        for path, _ in list(self._entries()):
+            self._remove(path)
+            removed += 1
+        self._stats_file.unlink(missing_ok=True)
+        return removed
+
+    def _remove(self, path: Path) -> None:
+        path.unlink(missing_ok=True)
+        path.with_name(f"{path.name}.json").unlink(missing_ok=True)
+
+    def stats(self) -> CacheStats:
+        entries = list(self._entries())
+        counters = self._read_counters()
+        return CacheStats(
+            directory=self.directory,
+            entries=len(entries),
+            total_size=sum(st.st_size for _, st in entries),
+            max_size=self.max_size,
+            hits=counters.get("hits", 0),
+            misses=counters.get("misses", 0),
+        )
+
+    def _read_counters(self) -> dict[str, int]:
+        try:
+            return json.loads(self._stats_file.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _count(self, name: str) -> None:
+        # Counters are best effort; concurrent updates may be lost.
+        self.directory.mkdir(parents=True, exist_ok=True)
+        counters = self._read_counters()
+        counters[name] = counters.get(name, 0) + 1
+        _atomic_write_text(self._stats_file, json.dumps(counters))
+
+
+def _atomic_write_text(path: Path, text: str) -> None:
+    fd, tmpname = tempfile.mkstemp(dir=path.parent, prefix=".tmp")
+    with os.fdopen(fd, "w") as fout:
+        fout.write(text)
+    os.replace(tmpname, path)
@@ -1,17 +1,51 @@
-"""Main CLI module for NumbaCC."""
+"""Main CLI module for NumbaCC.
 
+Only light modules are imported here; the compiler, MLIR and the backends
+are imported by the commands that need them, so that `nbcc --help`, argument
+errors and commands run on the compile server start fast.
+"""
+
+import functools
 import io
+import json
+import warnings
 from contextlib import redirect_stderr, redirect_stdout
 
 import click
 
-from nbcc.compiler import compile as _compile
-from nbcc.compiler import compile_shared_lib, compile_to_mlir
+from nbcc.cache import ArtifactCache
+from nbcc.developer import set_release_mode
+from nbcc.profiling import CompileStats, collect
+from nbcc.server import (
+    SERVER_COMMANDS,
+    CompileServer,
+    ServerError,
+    default_socket_path,
+    default_workers,
+    in_worker,
+    is_server_running,
+    run_on_server,
+    server_request,
+)
+from nbcc.toolchain import ToolchainOptions
 
 
 class SpecialGroup(click.Group):
     """Custom Click Group that allows fallback to a default command."""
 
+    def parse_args(self, ctx, args):
+        # `--time-report` has an optional value that must be attached with
+        # "=", otherwise click would consume the subcommand as its value.
+        args = [
+            "--time-report=text" if arg == "--time-report" else arg
+            for arg in args
+        ]
+        # Forwarded to the compile server as is
+        ctx.meta["nbcc.argv"] = [
+            arg for arg in args if arg not in ("--server", "--no-server")
+        ]
+        return super().parse_args(ctx, args)
+
     def get_command(self, ctx, cmd_name):
         rv = super().get_command(ctx, cmd_name)
         if rv is not None:
@@ -28,8 +62,89 @@ class SpecialGroup(click.Group):
 
 
 @click.group(cls=SpecialGroup, invoke_without_command=True)
+@click.option(
+    "--jobs",
+    "-j",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="Worker processes for the middle-end (0 uses all cores)",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=0, max=1),
+    default=None,
+    help="MLIR pass threads: 0 uses all cores, 1 disables multithreading",
+)
+@click.option(
+    "--openmp",
+    is_flag=True,
+    envvar="NBCC_OPENMP",
+    help="Run parallel loops on multiple cores with OpenMP",
+)
+@click.option(
+    "--omp-threads",
+    type=click.IntRange(min=0),
+    default=0,
+    help="OpenMP thread count (default: chosen at runtime, "
+    "e.g. by OMP_NUM_THREADS)",
+)
+@click.option(
+    "--bare-ptr-exports",
+    is_flag=True,
+    envvar="NBCC_BARE_PTR_EXPORTS",
+    help="Add bare-pointer entry points (data pointer and sizes per array) "
+    "to the exported functions without array results",
+)
+@click.option(
+    "--allocator",
+    type=click.Choice(["malloc", "pool"]),
+    default=None,
+    envvar="NBCC_ALLOCATOR",
+    help="Allocator of the array buffers (pool: size-class pool runtime "
+    "linked into the output)",
+)
+@click.option(
+    "--server/--no-server",
+    default=None,
+    help="Compile on the server started by `nbcc serve` (default: when "
+    "it is running)",
+)
+@click.option(
+    "--release",
+    is_flag=True,
+    envvar="NBCC_RELEASE",
+    help="Skip debug dumps and redundant IR verification",
+)
+@click.option(
+    "--time-report",
+    type=click.Choice(["text", "json", "trace"]),
+    metavar="[=text|json|trace]",
+    default=None,
+    help="Report time and memory per compiler stage "
+    "(trace: Chrome trace-event JSON for Perfetto)",
+)
+@click.option(
+    "--time-report-file",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Write the time report here (default: stderr, or "
+    "nbcc-trace.json for --time-report=trace)",
+)
 @click.pass_context
-def main(ctx):
+def main(
+    ctx,
+    jobs,
+    threads,
+    openmp,
+    omp_threads,
+    bare_ptr_exports,
+    allocator,
+    server,
+    release,
+    time_report,
+    time_report_file,
+):
     """NumbaCC - Numba-like compiler for SPy.
 
     \b
@@ -38,6 +153,10 @@ def main(ctx):
       nbcc compile <input_file> <output_file>  # Explicit compile to binary
       nbcc shared <input_file> <output_file>   # Compile to shared library
       nbcc mlir <input_file>                   # Generate and print MLIR
+      nbcc watch <input_file> <output_file>    # Rebuild on changes
+      nbcc build -j 8 'kernels/*.spy'          # Build many sources
+      nbcc cache stats|clear                   # Manage the artifact cache
+      nbcc serve [--stop|--status]             # Run a compile server
 
     \b
     Examples:
@@ -45,34 +164,416 @@ def main(ctx):
       nbcc shared input.spy output.so    # Compile to shared library
       nbcc compile input.spy output      # Explicit binary compilation
       nbcc mlir input.spy                # Print MLIR to terminal
+      nbcc -j 8 shared input.spy out.so  # Optimize functions in parallel
+      nbcc --release shared input.spy out.so  # No debug dumps
+      nbcc --time-report=trace shared input.spy out.so  # Profile stages
+      nbcc shared -O3 --target-cpu=native input.spy out.so  # Tune for host
+      nbcc --openmp shared input.spy out.so  # Multi-core kernels
+      nbcc --allocator=pool shared input.spy out.so  # Pooled buffers
     """
+    if ctx.invoked_subcommand in SERVER_COMMANDS:
+        _maybe_run_on_server(ctx, server)
+    if release:
+        set_release_mode(True)
+    ctx.ensure_object(dict)
+    ctx.obj["jobs"] = jobs
+    backend_options = ctx.obj["backend_options"] = {}
+    if threads is not None:
+        backend_options["num_threads"] = threads
+    if openmp:
+        backend_options["openmp"] = True
+        backend_options["omp_num_threads"] = omp_threads
+    if bare_ptr_exports:
+        backend_options["bare_ptr_exports"] = True
+    if allocator is not None:
+        backend_options["allocator"] = allocator
+    if time_report:
+        stats = ctx.with_resource(collect(CompileStats()))
+        ctx.call_on_close(
+            lambda: _write_time_report(stats, time_report, time_report_file)
+        )
     if ctx.invoked_subcommand is None:
         # Show help when no arguments provided
         click.echo(ctx.get_help())
 
 
+def _maybe_run_on_server(ctx, server: bool | None) -> None:
+    """Run the command on the compile server if it is running, and exit
+    with its exit code."""
+    if server is False or in_worker():
+        return
+    try:
+        result = run_on_server(ctx.meta["nbcc.argv"])
+    except ServerError as e:
+        if server:
+            raise click.ClickException(f"the compile server failed: {e}")
+        warnings.warn(
+            f"the compile server failed ({e}); compiling in-process",
+            RuntimeWarning,
+        )
+        return
+    if result is None:
+        if server:
+            raise click.ClickException(
+                f"no compile server on {default_socket_path()}; start one"
+                " with `nbcc serve`"
+            )
+        return
+    click.echo(result.stdout, nl=False)
+    click.echo(result.stderr, nl=False, err=True)
+    ctx.exit(result.exit_code)
+
+
+def _write_time_report(
+    stats: CompileStats, fmt: str, filename: str | None
+) -> None:
+    if not stats.records:
+        return
+    if fmt == "trace":
+        filename = filename or "nbcc-trace.json"
+        stats.write_chrome_trace(filename)
+        click.echo(f"Wrote compile trace to {filename}", err=True)
+        return
+    if fmt == "json":
+        report = json.dumps(stats.to_json(), indent=2)
+    else:
+        report = stats.format()
+    if filename:
+        with open(filename, "w") as fout:
+            print(report, file=fout)
+    else:
+        click.echo(report, err=True)
+
+
+no_cache_option = click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Always rebuild and bypass the artifact cache",
+)
+
+
+def toolchain_options(fn):
+    """Add the native code generation options as a `toolchain` argument."""
+
+    @click.option(
+        "-O",
+        "opt_level",
+        type=click.IntRange(0, 3),
+        default=3,
+        show_default=True,
+        help="LLVM optimization level",
+    )
+    @click.option(
+        "--target-cpu",
+        default=None,
+        metavar="native|<name>",
+        help="CPU to generate code for (default: generic)",
+    )
+    @click.option(
+        "--thin-lto",
+        is_flag=True,
+        help="Link with ThinLTO (set NBCC_LIBSPY_BITCODE to include libspy)",
+    )
+    @click.option(
+        "--fast-math",
+        is_flag=True,
+        help="Allow unsafe floating point optimizations",
+    )
+    @functools.wraps(fn)
+    def wrapper(*args, opt_level, target_cpu, thin_lto, fast_math, **kwargs):
+        toolchain = ToolchainOptions(
+            opt_level=opt_level,
+            target_cpu=target_cpu,
+            thin_lto=thin_lto,
+            fast_math=fast_math,
+        )
+        return fn(*args, toolchain=toolchain, **kwargs)
+
+    return wrapper
+
+
 @main.command()
 @click.argument("input_file", type=click.Path(exists=True, dir_okay=False))
 @click.argument("output_file", type=click.Path(dir_okay=False))
-def compile(input_file, output_file):
+@no_cache_option
+@toolchain_options
+@click.pass_obj
+def compile(obj, input_file, output_file, no_cache, toolchain):
     """Compile SPy source to binary executable (default command).
 
     INPUT_FILE: Path to the SPy source file to compile
     OUTPUT_FILE: Path for the compiled binary executable
     """
-    _compile(str(input_file), str(output_file))
+    from nbcc.compiler import compile as _compile
+
+    _compile(
+        str(input_file),
+        str(output_file),
+        use_cache=not no_cache,
+        jobs=obj["jobs"],
+        backend_options=obj["backend_options"],
+        toolchain=toolchain,
+    )
 
 
 @main.command()
 @click.argument("input_file", type=click.Path(exists=True, dir_okay=False))
 @click.argument("output_file", type=click.Path(dir_okay=False))
-def shared(input_file, output_file):
+@no_cache_option
+@toolchain_options
+@click.option(
+    "--bindings",
+    is_flag=True,
+    help="Also write a Python binding module (OUTPUT_FILE stem + _bindings.py)",
+)
+@click.pass_obj
+def shared(obj, input_file, output_file, no_cache, toolchain, bindings):
     """Compile SPy source to shared library.
 
     INPUT_FILE: Path to the SPy source file to compile
     OUTPUT_FILE: Path for the compiled shared library (.so/.dylib/.dll)
     """
-    compile_shared_lib(str(input_file), str(output_file))
+    from nbcc.compiler import compile_shared_lib
+
+    compile_shared_lib(
+        str(input_file),
+        str(output_file),
+        use_cache=not no_cache,
+        jobs=obj["jobs"],
+        backend_options=obj["backend_options"],
+        toolchain=toolchain,
+        bindings=bindings,
+    )
+
+
+@main.command()
+@click.argument("input_file", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output_file", type=click.Path(dir_okay=False))
+@no_cache_option
+@toolchain_options
+@click.option(
+    "--binary",
+    is_flag=True,
+    help="Build an executable instead of a shared library",
+)
+@click.option(
+    "--interval",
+    type=click.FloatRange(min=0),
+    default=0.5,
+    show_default=True,
+    help="Seconds between two checks of the sources",
+)
+@click.option("--once", is_flag=True, help="Build once and exit")
+@click.pass_obj
+def watch(
+    obj, input_file, output_file, no_cache, toolchain, binary, interval, once
+):
+    """Rebuild when the source or its imported modules change.
+
+    Only the functions that changed, and their callers, go through the
+    middle-end and the lowering again. The latency of every rebuild is
+    printed.
+
+    INPUT_FILE: Path to the SPy source file to compile
+    OUTPUT_FILE: Path for the shared library (or executable with --binary)
+    """
+    from nbcc.watch import IncrementalBuilder
+    from nbcc.watch import watch as _watch
+
+    builder = IncrementalBuilder(
+        input_file,
+        output_file,
+        kind="binary" if binary else "shared",
+        backend_options=obj["backend_options"],
+        toolchain=toolchain,
+        use_cache=not no_cache,
+    )
+    if not once:
+        click.echo(f"Watching {input_file} (Ctrl-C to stop)", err=True)
+    try:
+        _watch(
+            builder,
+            interval=interval,
+            once=once,
+            echo=functools.partial(click.echo, err=True),
+        )
+    except KeyboardInterrupt:
+        pass
+
+
+@main.command()
+@click.argument("sources", nargs=-1)
+@click.option(
+    "--manifest",
+    "-m",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="JSON manifest of the targets (see nbcc.build)",
+)
+@click.option(
+    "--out-dir",
+    "-o",
+    type=click.Path(file_okay=False),
+    default="build",
+    show_default=True,
+    help="Directory of the outputs of SOURCES",
+)
+@click.option(
+    "--binary",
+    is_flag=True,
+    help="Build executables from SOURCES instead of shared libraries",
+)
+@click.option(
+    "--bindings",
+    is_flag=True,
+    help="Also write the Python binding modules of SOURCES",
+)
+@click.option(
+    "--jobs",
+    "-j",
+    "build_jobs",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Targets built at the same time (default: all cores)",
+)
+@no_cache_option
+@toolchain_options
+@click.pass_obj
+def build(
+    obj,
+    sources,
+    manifest,
+    out_dir,
+    binary,
+    bindings,
+    build_jobs,
+    no_cache,
+    toolchain,
+):
+    """Build many SPy sources in parallel.
+
+    SOURCES are paths or glob patterns (e.g. 'kernels/**/*.spy'). Targets
+    that import the source of another target are built after it. A summary
+    with the time per stage of every target is printed at the end.
+    """
+    from graphlib import CycleError
+
+    from nbcc.build import build as _build
+    from nbcc.build import load_manifest, targets_from_sources
+
+    if not sources and manifest is None:
+        raise click.UsageError("give SOURCES or --manifest")
+    try:
+        targets = []
+        if manifest is not None:
+            targets += load_manifest(manifest)
+        if sources:
+            targets += targets_from_sources(
+                sources,
+                out_dir,
+                kind="binary" if binary else "shared",
+                bindings=bindings,
+            )
+    except (ValueError, OSError) as e:
+        raise click.ClickException(str(e))
+
+    def progress(result, index, count):
+        click.echo(
+            f"[{index}/{count}] {result.status} {result.target.name}"
+            f" ({result.seconds:.2f}s)",
+            err=True,
+        )
+
+    try:
+        summary = _build(
+            targets,
+            jobs=build_jobs,
+            use_cache=not no_cache,
+            backend_options=obj["backend_options"],
+            toolchain=toolchain,
+            middle_end_jobs=obj["jobs"],
+            progress=progress,
+        )
+    except (ValueError, CycleError) as e:
+        raise click.ClickException(str(e))
+    click.echo(summary.format())
+    if summary.failed:
+        raise click.ClickException(
+            f"{len(summary.failed)} target(s) were not built"
+        )
+
+
+@main.group()
+def cache():
+    """Manage the cache of compiled artifacts.
+
+    The cache lives in $NBCC_CACHE_DIR (default: ~/.cache/nbcc) and is
+    bounded by $NBCC_CACHE_SIZE bytes.
+    """
+
+
+@cache.command("stats")
+def cache_stats():
+    """Show the size and hit rate of the artifact cache."""
+    click.echo(ArtifactCache().stats().format())
+
+
+@cache.command("clear")
+def cache_clear():
+    """Remove all cached artifacts."""
+    removed = ArtifactCache().clear()
+    click.echo(f"Removed {removed} cached artifact(s)")
+
+
+@main.command()
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="Socket to listen on (default: $NBCC_SERVER_SOCKET or "
+    "server.sock in the cache directory)",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Commands compiled at the same time (default: half the cores)",
+)
+@click.option("--stop", is_flag=True, help="Stop the running server")
+@click.option("--status", is_flag=True, help="Check if a server is running")
+def serve(socket_path, workers, stop, status):
+    """Run a compile server.
+
+    Keeps worker processes with the compiler imported and the SPy VM and
+    MLIR context of the next command ready. While it runs, the compile
+    commands of `nbcc` are sent to it (see --server/--no-server).
+    """
+    path = socket_path or default_socket_path()
+    if stop:
+        if server_request({"op": "shutdown"}, path) is None:
+            raise click.ClickException(f"no compile server on {path}")
+        click.echo(f"Stopped the compile server on {path}")
+        return
+    if status:
+        if not is_server_running(path):
+            raise click.ClickException(f"no compile server on {path}")
+        info = server_request({"op": "ping"}, path) or {}
+        click.echo(
+            f"Compile server on {path}: pid {info['pid']},"
+            f" {info['workers']} worker(s)"
+        )
+        return
+    with CompileServer(path, workers=workers or default_workers()) as srv:
+        click.echo(
+            f"Compile server on {srv.socket_path} with {srv.workers}"
+            " worker(s)",
+            err=True,
+        )
+        try:
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
 
 
 @main.command()
@@ -82,7 +583,7 @@ def shared(input_file, output_file):
     "--quiet",
     "-q",
     is_flag=True,
-    help="Suppress debug output, show only final MLIR",
+    help="Suppress debug output, show only final MLIR (implies --release)",
 )
 @click.option(
     "--backend",
@@ -91,7 +592,8 @@ def shared(input_file, output_file):
     default="cpu",
     help="Backend to use for compilation",
 )
-def mlir(input_file, output_file, quiet, backend):
+@click.pass_obj
+def mlir(obj, input_file, output_file, quiet, backend):
     """Generate and print MLIR for SPy source.
 
     INPUT_FILE: Path to the SPy source file to compile to MLIR
@@ -100,25 +602,40 @@ def mlir(input_file, output_file, quiet, backend):
     Use --quiet to suppress debug output and show only final MLIR.
     """
 
+    from nbcc.compiler import compile_to_mlir
 
     # Backend selection logic - TODO: Implement backend-specific compilation
     match backend:
         case "cpu":
             from nbcc.mlir_backend.backend import Backend
+
             be_type = Backend
         case "cutile":
             from nbcc.cutile_backend.backend import CuTileBackend
+
             be_type = CuTileBackend
         case _:
             raise NotImplementedError(f"{backend!r} is not available")
 
     if quiet:
-        # Capture and suppress debug output, only show final MLIR
+        # Don't produce the debug output at all, and capture anything else
+        # printed during compilation.
+        set_release_mode(True)
         with redirect_stdout(io.StringIO()), redirect_stderr(io.StringIO()):
-            module = compile_to_mlir(str(input_file), be_type=be_type)
+            module = compile_to_mlir(
+                str(input_file),
+                be_type=be_type,
+                jobs=obj["jobs"],
+                backend_options=obj["backend_options"],
+            )
     else:
         # Show all debug output as normal
-        module = compile_to_mlir(str(input_file), be_type=be_type)
+        module = compile_to_mlir(
+            str(input_file),
+            be_type=be_type,
+            jobs=obj["jobs"],
+            backend_options=obj["backend_options"],
+        )
 
     # Print the final MLIR
     click.echo("\n" + "=" * 60)
@@ -1,328 +1,319 @@
+"""
+Compiler driver: SPy source to MLIR, shared libraries and executables.
+
+The compiler itself (`spy`, `sealir`, `egglog`, MLIR) is imported by the
+functions that run it rather than by this module, so that importing the
+driver, e.g. for `nbcc --help` or a compile that hits the artifact cache,
+stays cheap. The egraph middle-end is in `nbcc.middle_end`.
+"""
+
+from __future__ import annotations
+
 import logging
 import os
-import subprocess as subp
 import sys
-import tempfile
-from contextlib import ExitStack
-from pathlib import Path
-from pprint import pprint
-from typing import cast, Sequence, Type
-
-import sealir.rvsdg.grammar as rg
-import spy
-from egglog import EGraph
-from mlir import ir
-from sealir.ase import SExpr, TapeCrawler
-from sealir.eqsat.rvsdg_convert import egraph_conversion
-from sealir.eqsat.rvsdg_eqsat import GraphRoot
-from sealir.eqsat.rvsdg_extract import CostModel as _CostModel
-from sealir.eqsat.rvsdg_extract import egraph_extraction
-from sealir.rvsdg import format_rvsdg
-
-from nbcc.developer import TODO
-from nbcc.egraph.conversion import ExtendEGraphToRVSDG
-from nbcc.egraph.rules import egraph_convert_metadata, egraph_optimize
-from nbcc.frontend import TranslationUnit, frontend
-from nbcc.frontend.grammar import IRTag, TypeInfo
-from nbcc.mlir_backend.backend import Backend
-from nbcc.mlir_lowering import (
-    Lowering,
-    MDMap,
-    BackendInterface,
-)
+from functools import partial
+from pprint import pformat
+from typing import TYPE_CHECKING, Any, Callable, Mapping, Sequence, Type
 
-logging.disable(logging.INFO)
+from nbcc import profiling
+from nbcc.cache import ArtifactCache, compute_key, is_cache_disabled
+from nbcc.developer import TODO, Lazy
+from nbcc.mlir_backend.options import BACKEND_NAME, codegen_options
+from nbcc.profiling import CompileStats, stage
+from nbcc.toolchain import Toolchain, ToolchainOptions
 
+if TYPE_CHECKING:
+    import sealir.rvsdg.grammar as rg
+    from mlir import ir
 
-def compile(path: str, out_path: str) -> None:
-    module = compile_to_mlir(path)
-    make_binary(module, out_path)
+    from nbcc.mlir_lowering import BackendInterface
 
+_logger = logging.getLogger(__name__)
 
-def compile_shared_lib(path: str, out_path: str) -> None:
-    module = compile_to_mlir(path)
-    make_shared(module, out_path)
-
-
-def compile_to_mlir(
-    path: str, be_type: Type[BackendInterface] = Backend
-) -> ir.Module:
-    tu = frontend(path)
+# Silence the INFO logs of the egraph libraries
+for _name in ("sealir", "egglog"):
+    logging.getLogger(_name).setLevel(logging.WARNING)
 
-    func_map: dict[str, rg.Func]
-    func_map, mdlist = middle_end(tu)
-    pprint(func_map)
-    be = be_type.create(tu)
-    mdmap = MDMap()
-    mdmap.load(mdlist)
+# Moved to `nbcc.middle_end`
+_MIDDLE_END_NAMES = frozenset(
+    ["middle_end", "optimize_function", "CostModel", "expand_struct_type"]
+)
 
-    module = be.make_module(path)
 
-    transform_map: dict[str, Sequence[str]] = {}
-    for fname, rvsdg_ir in func_map.items():
-        lowering = Lowering(be, module, mdmap, func_map)
-        TODO("Not handling lowering argtypes")
-        fn_op = lowering.lower(rvsdg_ir)
-        print(fn_op.operation.get_asm())
+def __getattr__(name: str) -> Any:
+    if name in _MIDDLE_END_NAMES:
+        import nbcc.middle_end
+
+        return getattr(nbcc.middle_end, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _default_backend() -> Type[BackendInterface]:
+    from nbcc.mlir_backend.backend import Backend
+
+    return Backend
+
+
+def compile(
+    path: str,
+    out_path: str,
+    *,
+    use_cache: bool = True,
+    jobs: int = 1,
+    stats: CompileStats | None = None,
+    backend_options: Mapping[str, Any] | None = None,
+    toolchain: ToolchainOptions | None = None,
+) -> None:
+    with profiling.collect(stats):
+        _build_artifact(
+            path,
+            out_path,
+            "binary",
+            partial(make_binary, toolchain=toolchain),
+            use_cache,
+            toolchain,
+            jobs=jobs,
+            backend_options=backend_options,
+        )
 
-        irtags = lowering.irtags(rvsdg_ir)
-        print("== IRTAGS", irtags)
-        if mlir_transforms := irtags.get("mlir.transforms"):
-            transform_map[fn_op.name.value] = [v for k, v in mlir_transforms]
 
-    lowering.module.operation.verify()
+def compile_shared_lib(
+    path: str,
+    out_path: str,
+    *,
+    use_cache: bool = True,
+    jobs: int = 1,
+    stats: CompileStats | None = None,
+    backend_options: Mapping[str, Any] | None = None,
+    toolchain: ToolchainOptions | None = None,
+    bindings: bool = False,
+) -> None:
+    """Compile the SPy source at `path` to the shared library `out_path`.
+
+    With `bindings`, also write the Python binding module of the library;
+    see `nbcc.bindings`.
+    """
+    with profiling.collect(stats):
+        metadata = _build_artifact(
+            path,
+            out_path,
+            "shared",
+            partial(make_shared, toolchain=toolchain),
+            use_cache,
+            toolchain,
+            jobs=jobs,
+            backend_options=backend_options,
+        )
+        if bindings:
+            from nbcc.bindings import ExportSpec, write_bindings
+
+            with stage("write_bindings"):
+                exports = [
+                    ExportSpec.from_json(data)
+                    for data in metadata.get("exports", [])
+                ]
+                write_bindings(exports, out_path)
+
+
+def _build_artifact(
+    path: str,
+    out_path: str,
+    kind: str,
+    make_artifact: Callable[[ir.Module, str], None],
+    use_cache: bool,
+    toolchain: ToolchainOptions | None,
+    **compile_options: Any,
+) -> dict[str, Any]:
+    """Build `path` into `out_path`, going through the artifact cache.
+
+    On a cache hit the stored artifact is copied to `out_path` without
+    running the compiler. `compile_options` are passed to
+    `compile_to_mlir()`. The cache key includes `toolchain` and the backend
+    options that change the generated code.
+
+    Returns:
+        The metadata of the artifact. ``"exports"`` lists the signatures of
+        the exported functions (`nbcc.bindings.ExportSpec.to_json()`).
+    """
+    if not use_cache or is_cache_disabled():
+        module = compile_to_mlir(path, **compile_options)
+        make_artifact(module, out_path)
+        return _artifact_metadata(path, module)
+
+    cache = ArtifactCache()
+    with stage("cache_lookup"):
+        key = artifact_key(
+            path, kind, toolchain, compile_options.get("backend_options")
+        )
+        if cache.fetch(key, out_path):
+            return cache.metadata(key) or {}
+
+    module = compile_to_mlir(path, **compile_options)
+    make_artifact(module, out_path)
+    metadata = _artifact_metadata(path, module)
+    with stage("cache_store"):
+        cache.store(key, out_path, metadata=metadata)
+    return metadata
+
+
+def artifact_key(
+    path: str,
+    kind: str,
+    toolchain: ToolchainOptions | None = None,
+    backend_options: Mapping[str, Any] | None = None,
+    source_digest: str | None = None,
+) -> str:
+    """Cache key of the artifact of `kind` built from `path` with the MLIR
+    backend. Computed without importing the compiler.
+
+    See `nbcc.cache.compute_key_components()` for `source_digest`.
+    """
+    return compute_key(
+        path,
+        kind=kind,
+        be_type=BACKEND_NAME,
+        options={
+            "toolchain": (toolchain or ToolchainOptions()).cache_key(),
+            "backend": codegen_options(**(backend_options or {})),
+        },
+        source_digest=source_digest,
+    )
 
-    print("=============")
-    print(lowering.module.operation.get_asm())
-    pprint(transform_map)
-    module = be.run_passes(module, transforms=transform_map)
-    print("After optimization")
-    print(module)
 
-    return module
+def _artifact_metadata(path: str, module: ir.Module) -> dict[str, Any]:
+    from nbcc.mlir_backend.exports import read_exports
 
+    return {
+        "source": os.path.abspath(path),
+        "exports": [spec.to_json() for spec in read_exports(module)],
+    }
 
-def make_binary(module: ir.Module, out_path: str):
-    with ExitStack() as raii:
-        temp_file_mlir = raii.enter_context(
-            tempfile.NamedTemporaryFile(suffix=".mlir", mode="w")
-        )
-        print(
-            module.operation.get_asm(enable_debug_info=True),
-            file=temp_file_mlir,
-        )
-        temp_file_mlir.flush()
 
-        temp_file_llvmir = raii.enter_context(
-            tempfile.NamedTemporaryFile(suffix=".ll", mode="w")
-        )
-        subp.check_call(
-            [
-                "mlir-translate",
-                "--mlir-to-llvmir",
-                temp_file_mlir.name,
-                "-o",
-                temp_file_llvmir.name,
-            ]
-        )
-        # subp.check_call(["cat", "out.ll"])
-        subp.check_call(
-            [
-                "clang",
-                "-o",
-                out_path,
-                temp_file_llvmir.name,
-                "-Ldeps/spy/spy/libspy/build/native/release/",
-                "-lspy",
-            ]
+def compile_to_mlir(
+    path: str,
+    be_type: Type[BackendInterface] | None = None,
+    *,
+    jobs: int = 1,
+    stats: CompileStats | None = None,
+    backend_options: Mapping[str, Any] | None = None,
+) -> ir.Module:
+    """Compile the SPy source at `path` to an LLVM-dialect MLIR module.
+
+    Args:
+        be_type: The backend; defaults to the MLIR `Backend`.
+        jobs: Number of worker processes for the middle-end.
+        stats: If given, the wall time, CPU time and peak RSS of every
+            compiler stage are recorded into it. See `nbcc.profiling`.
+        backend_options: Keyword arguments for `be_type.create()`, e.g.
+            ``{"num_threads": 1}`` for the MLIR backend.
+    """
+    with profiling.collect(stats), stage("compile_to_mlir"):
+        return _compile_to_mlir(
+            path, be_type or _default_backend(), jobs, backend_options or {}
         )
 
 
-def make_shared(module: ir.Module, out_path: str):
-    from ctypes.util import find_library
-
-    lib_path = find_library("mlir_c_runner_utils")
-    if lib_path is None:
-        raise RuntimeError("Could not find mlir_c_runner_utils library")
-    libdir = os.path.dirname(lib_path)
-    with ExitStack() as raii:
-        temp_file_mlir = raii.enter_context(
-            tempfile.NamedTemporaryFile(suffix=".mlir", mode="w")
-        )
-        print(
-            module.operation.get_asm(enable_debug_info=True),
-            file=temp_file_mlir,
+def lower_to_mlir(
+    path: str,
+    be_type: Type[BackendInterface] | None = None,
+    *,
+    jobs: int = 1,
+    stats: CompileStats | None = None,
+    backend_options: Mapping[str, Any] | None = None,
+) -> tuple[BackendInterface, ir.Module, dict[str, Sequence[str]]]:
+    """Compile the SPy source at `path` up to, but excluding, the backend
+    pass pipeline.
+
+    This allows the lowered module to be modified, e.g. specialized, before
+    it is finished with ``backend.run_passes(module, transforms=transforms)``.
+    See `compile_to_mlir()` for the arguments.
+
+    Returns:
+        ``(backend, module, transforms)``
+    """
+    with profiling.collect(stats), stage("lower_to_mlir"):
+        return _lower_to_mlir(
+            path, be_type or _default_backend(), jobs, backend_options or {}
         )
-        temp_file_mlir.flush()
 
-        temp_file_llvmir = raii.enter_context(
-            tempfile.NamedTemporaryFile(suffix=".orig.ll", mode="w")
-        )
-        temp_file_llvm_opt = raii.enter_context(
-            tempfile.NamedTemporaryFile(suffix=".opt.ll", mode="w")
-        )
-        temp_file_native_obj = raii.enter_context(
-            tempfile.NamedTemporaryFile(suffix=".o", mode="wb")
-        )
-        target_triple = subp.check_output(
-            "llvm-config --host-target".split(), encoding="utf8"
-        ).strip()
-        subp.check_call(
-            [
-                "mlir-translate",
-                "--mlir-to-llvmir",
-                temp_file_mlir.name,
-                "-o",
-                temp_file_llvmir.name,
-            ]
-        )
 
-        print(temp_file_llvmir.name.center(80, "-"))
-        subp.check_call(["cat", temp_file_llvmir.name])
-
-        subp.check_call(
-            [
-                "opt",
-                "-passes=default<O3>",
-                "-S",
-                f"-mtriple={target_triple}",
-                temp_file_llvmir.name,
-                "-o",
-                temp_file_llvm_opt.name,
-            ]
-        )
+def _compile_to_mlir(
+    path: str,
+    be_type: Type[BackendInterface],
+    jobs: int,
+    backend_options: Mapping[str, Any],
+) -> ir.Module:
+    be, module, transform_map = _lower_to_mlir(
+        path, be_type, jobs, backend_options
+    )
+    with stage("run_passes"):
+        module = be.run_passes(module, transforms=transform_map)
+    _logger.debug("After optimization")
+    _logger.debug("%s", module)
 
-        print(temp_file_llvm_opt.name.center(80, "-"))
-        subp.check_call(["cat", temp_file_llvm_opt.name])
-
-        print(80 * "=")
-        subp.check_call(
-            [
-                "llc",
-                "-O3",
-                "-filetype=obj",
-                "--relocation-model=pic",
-                temp_file_llvm_opt.name,
-                "-o",
-                temp_file_native_obj.name,
-            ]
-        )
-        spydir = os.path.dirname(spy.__file__)
-        spylinkdir = Path(spydir) / "libspy" / "build" / "native" / "release"
-        subp.check_call(
-            [
-                "clang",
-                "-shared",
-                "-o",
-                out_path,
-                temp_file_native_obj.name,
-                f"-L{spylinkdir}",
-                "-lspy",
-                f"-L{libdir}",
-                f"-lmlir_c_runner_utils",
-            ]
-        )
+    return module
 
 
-def middle_end(
-    tu: TranslationUnit,
-) -> tuple[dict[str, rg.Func], list[TypeInfo | IRTag]]:
-    func_nodes: dict[str, rg.Func] = {}
-    mdlist: list[TypeInfo | IRTag] = []
+def _lower_to_mlir(
+    path: str,
+    be_type: Type[BackendInterface],
+    jobs: int,
+    backend_options: Mapping[str, Any],
+) -> tuple[BackendInterface, ir.Module, dict[str, Sequence[str]]]:
+    from nbcc.frontend import frontend
+    from nbcc.middle_end import middle_end
+    from nbcc.mlir_lowering import Lowering, MDMap
 
-    for fqn in tu.list_functions():
-        fi = tu.get_function(fqn)
-        print(fi.fqn, fi.region)
+    with stage("frontend"):
+        tu = frontend(path)
 
-        memo = egraph_conversion(fi.region)
+    func_map: dict[str, rg.Func]
+    with stage("middle_end"):
+        func_map, mdlist = middle_end(tu, jobs=jobs)
+    _logger.debug("%s", Lazy(pformat, func_map))
+    be = be_type.create(tu, **backend_options)
+    mdmap = MDMap()
+    mdmap.load(mdlist)
 
-        root = GraphRoot(memo[fi.region])
+    module = be.make_module(path)
+
+    transform_map: dict[str, Sequence[str]] = {}
+    for fname, rvsdg_ir in func_map.items():
+        lowering = Lowering(be, module, mdmap, func_map)
+        TODO("Not handling lowering argtypes")
+        with stage("lower", fn=fname):
+            fn_op = lowering.lower(rvsdg_ir)
+        _logger.debug("%s", Lazy(fn_op.operation.get_asm))
 
-        egraph = EGraph()
-        egraph.let("root", root)
-        egraph.let("mds", egraph_convert_metadata(fi.metadata, memo))
+        irtags = lowering.irtags(rvsdg_ir)
+        _logger.debug("== IRTAGS %s", irtags)
+        if mlir_transforms := irtags.get("mlir.transforms"):
+            transform_map[fn_op.name.value] = [v for k, v in mlir_transforms]
 
-        expand_struct_type(tu, egraph)
+    with stage("verify"):
+        lowering.module.operation.verify()
 
-        egraph_optimize(egraph)
+    _logger.debug("=============")
+    _logger.debug("%s", Lazy(lowering.module.operation.get_asm))
+    _logger.debug("%s", Lazy(pformat, transform_map))
+    return be, module, transform_map
 
-        extraction = egraph_extraction(egraph, cost_model=CostModel())
-        extraction.compute()
-        extresult = extraction.extract_common_root()
-        print("egraph extracted")
-        print("cost", extresult.cost)
 
-        tape = fi.region._tape
-        last = tape.last
-        converted_root: SExpr = extresult.convert(
-            fi.region, ExtendEGraphToRVSDG
-        )
+def make_binary(
+    module: ir.Module,
+    out_path: str,
+    toolchain: ToolchainOptions | None = None,
+):
+    Toolchain(toolchain).make_binary(module, out_path)
 
-        for node in converted_root._args:
-            match node:
-                case rg.Func(fname=str(matched_fqn)):
-                    assert matched_fqn not in func_nodes
-                    func_nodes[matched_fqn] = node
-
-        crawler = TapeCrawler(tape, converted_root._get_downcast())
-        crawler.move_to_pos_of(last)
-        crawler.move_to_first_record()
-
-        for rec in crawler.walk():
-            node = rec.to_expr()
-            if isinstance(node, TypeInfo):
-                mdlist.append(node)
-            elif isinstance(node, IRTag):
-                mdlist.append(node)
-
-    assert len(func_nodes) >= 1
-    for func in func_nodes.values():
-        print(format_rvsdg(cast(SExpr, func)))
-
-        print(cast(SExpr, func)._tape.dump())
-    return func_nodes, mdlist
-
-
-class CostModel(_CostModel):
-    def get_cost_function(
-        self,
-        nodename,
-        op,
-        ty,
-        cost,
-        children,
-    ):
-        if op in ["Py_Call", "Py_LoadGlobal"]:
-            return self.get_simple(10000)
-        elif op in ["CallFQN"]:
-            return self.get_simple(1)
-        else:
-            return super().get_cost_function(nodename, op, ty, cost, children)
-
-
-def expand_struct_type(tu: TranslationUnit, egraph):
-    from egglog import Ruleset
-
-    from nbcc.egraph.rules import (
-        create_ruleset_struct__get_field__,
-        create_ruleset_struct__make__,
-        create_ruleset_struct__lift__,
-        create_ruleset_struct__unlift__,
-    )
 
-    schedule = Ruleset(None)  # empty ruleset
-    for fqn_struct, w_obj_struct in tu._structs.items():
-        print(fqn_struct, w_obj_struct)
-
-        is_lifted_type = "__ll__" in w_obj_struct.dict_w
-        for fqn, w_obj in tu._builtins.items():
-            print("BUITIN", fqn)
-            subname = fqn.parts[-1].name
-            if subname == "__make__":
-                if is_lifted_type:
-                    print("Add __lift__")
-                    schedule |= create_ruleset_struct__lift__(w_obj)
-
-                else:
-                    print("Add __make__")
-                    schedule |= create_ruleset_struct__make__(w_obj)
-
-            elif subname.startswith("__get_"):
-
-                if is_lifted_type:
-                    assert subname == "__get___ll____"
-                    schedule |= create_ruleset_struct__unlift__(w_obj)
-                else:
-                    print("Add field getter")
-                    for i, w_field in enumerate(
-                        w_obj_struct.iterfields_w()
-                    ):
-                        if subname == f"__get_{w_field.name}__":
-                            schedule |= create_ruleset_struct__get_field__(
-                                w_obj, i
-                            )
-
-    egraph.run(schedule.saturate())
+def make_shared(
+    module: ir.Module,
+    out_path: str,
+    toolchain: ToolchainOptions | None = None,
+):
+    Toolchain(toolchain).make_shared(module, out_path)
 
 
 if __name__ == "__main__":
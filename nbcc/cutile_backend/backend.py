@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import logging
 from typing import Any
 from nbcc.mlir_lowering import BackendInterface, UnsupportedError
 from nbcc.mlir_utils import decode_type_name, parse_composite_type
@@ -19,9 +20,11 @@ import cuda_tile._mlir.dialects._cuda_tile_ops_gen as _cuda_tile
 from cuda_tile._mlir.extras import types as _tile_types
 import cuda_tile._mlir.ir as ir  # Context, Location, Module, Type
 
-from nbcc.developer import TODO
+from nbcc.developer import TODO, Lazy, is_release_mode
 from nbcc.mlir_lowering import LowerStates
 
+_logger = logging.getLogger(__name__)
+
 
 def entry(
     sym_name,
@@ -91,7 +94,9 @@ class CuTileBackend(BackendInterface):
             self._none_type = ir.IntegerType.get_signless(1)
 
     @classmethod
-    def create(cls, tu: TranslationUnit) -> CuTileBackend:
+    def create(cls, tu: TranslationUnit, **options) -> CuTileBackend:
+        if options:
+            raise TypeError(f"unsupported backend options: {sorted(options)}")
         return cls(tu)
 
     def make_module(self, module_name: str) -> ir.Module:
@@ -124,11 +129,12 @@ class CuTileBackend(BackendInterface):
             attrs = None
 
         op = ir.Operation.create(opname, result_types, args, attributes=attrs)
-        try:
-            op.verify()
-        except Exception:
-            print(op.get_asm())
-            raise
+        if not is_release_mode():
+            try:
+                op.verify()
+            except Exception:
+                _logger.error("%s", op.get_asm())
+                raise
         if len(result_types) == 1:
             return op.result
         elif len(result_types) > 1:
@@ -155,7 +161,7 @@ class CuTileBackend(BackendInterface):
             def operation(self):
                 return self.func_op
 
-        print(entry_op.get_asm())
+        _logger.debug("%s", Lazy(entry_op.get_asm))
         return WrappedFunc(entry_op), body_start, body_start
 
     def create_constant(self, value, type):
@@ -1,8 +1,88 @@
+import logging
+import os
+import sys
 from warnings import warn
 from functools import partial
+from typing import Any, Callable
 
 
 class WorkInProgress(Warning): ...
 
 
 TODO = partial(warn, category=WorkInProgress)
+
+
+# ## Debug and release mode
+#
+# The compiler dumps its intermediate representations through the "nbcc"
+# logger at DEBUG level. In release mode the logger is raised to WARNING so
+# the dumps are never formatted, and redundant per-operation verification is
+# skipped.
+
+logger = logging.getLogger("nbcc")
+
+_release_mode = os.environ.get("NBCC_RELEASE", "0") not in ("", "0")
+
+
+def is_release_mode() -> bool:
+    """True if debug dumps and redundant IR verification are disabled.
+
+    Defaults to the `NBCC_RELEASE` environment variable.
+    """
+    return _release_mode
+
+
+def set_release_mode(enabled: bool = True) -> None:
+    global _release_mode
+    _release_mode = enabled
+    logger.setLevel(logging.WARNING if enabled else logging.DEBUG)
+
+
+def debug_verify(op) -> None:
+    """Verify an MLIR operation unless running in release mode.
+
+    The module is verified as a whole after lowering; this is for catching
+    errors close to the operation that introduced them.
+    """
+    if not _release_mode:
+        assert op.verify()
+
+
+class Lazy:
+    """Log record argument that is computed only when the record is emitted.
+
+    Example:
+
+        logger.debug("%s", Lazy(op.get_asm))
+    """
+
+    __slots__ = ("_fn", "_args")
+
+    def __init__(self, fn: Callable[..., Any], *args: Any):
+        self._fn = fn
+        self._args = args
+
+    def __str__(self) -> str:
+        return str(self._fn(*self._args))
+
+
+class _StdoutHandler(logging.StreamHandler):
+    # Resolve sys.stdout on every record so that `redirect_stdout()` applies
+    # to the dumps.
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+_handler = _StdoutHandler()
+_handler.setFormatter(logging.Formatter("%(message)s"))
+logger.addHandler(_handler)
+logger.propagate = False
+set_release_mode(_release_mode)
@@ -0,0 +1,247 @@
+"""
+Runtime dispatch to shape-specialized variants of an exported function.
+
+The exported kernels are compiled for dynamic shapes (`memref<?x?xf64>`),
+which blocks full unrolling and vectorization. Calls usually hit a few
+fixed shapes, so `ShapeDispatcher` compiles a static-shape variant (see
+`nbcc.mlir_backend.specialize`) for shapes that are called repeatedly and
+keeps the variants in an LRU cache keyed by
+``(function, dtypes, shapes, contiguity)``. Other calls go to the generic
+build.
+
+Example:
+
+    softmax = ShapeDispatcher("llm_tensor.spy", "export_softmax")
+    out = softmax(A)
+    print(softmax.stats().format())
+
+The source is lowered once; each variant only reruns the backend pass
+pipeline and the JIT (`nbcc.jit`).
+"""
+
+from __future__ import annotations
+
+import ctypes
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable
+
+import mlir.dialects.func as func
+import mlir.ir as ir
+import numpy as np
+from mlir.runtime import (
+    get_ranked_memref_descriptor,
+    make_nd_memref_descriptor,
+    ranked_memref_to_numpy,
+)
+
+from nbcc.compiler import lower_to_mlir
+from nbcc.jit import JITFunction, jit_compile
+from nbcc.mlir_backend.specialize import (
+    clone_module,
+    find_function,
+    specialize_shapes,
+)
+from nbcc.profiling import stage
+
+_logger = logging.getLogger(__name__)
+
+_NUMPY_DTYPES = {
+    "f16": np.float16,
+    "f32": np.float32,
+    "f64": np.float64,
+    "i32": np.int32,
+    "i64": np.int64,
+}
+
+# Bound on the number of distinct call signatures counted towards
+# `specialize_after`.
+_MAX_TRACKED_KEYS = 1024
+
+
+@dataclass(frozen=True)
+class DispatchStats:
+    hits: int
+    """Calls served by a specialized variant."""
+    misses: int
+    """Calls served by the generic build."""
+    compiles: int
+    evictions: int
+    variants: int
+
+    def format(self) -> str:
+        return "\n".join(
+            [
+                f"hits:       {self.hits}",
+                f"misses:     {self.misses}",
+                f"compiles:   {self.compiles}",
+                f"evictions:  {self.evictions}",
+                f"variants:   {self.variants}",
+            ]
+        )
+
+
+@dataclass(frozen=True)
+class _Param:
+    rank: int
+    dtype: np.dtype
+
+
+class ShapeDispatcher:
+    """Call an exported function through shape-specialized variants.
+
+    Args:
+        path: Path to the SPy source.
+        function: Exported function, by symbol or SPy name.
+        max_variants: Size of the LRU cache of specialized variants.
+        specialize_after: Number of calls with the same key after which a
+            variant is compiled. Earlier calls use the generic build.
+        opt_level: Optimization level of the JIT.
+        jobs: Worker processes for the middle-end.
+
+    Only functions taking ranked memref arguments and returning one ranked
+    memref are supported. Only C-contiguous arguments are specialized.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        function: str,
+        *,
+        max_variants: int = 8,
+        specialize_after: int = 2,
+        opt_level: int = 3,
+        jobs: int = 1,
+    ):
+        if max_variants < 0:
+            raise ValueError("max_variants must be >= 0")
+        self.max_variants = max_variants
+        self.specialize_after = max(specialize_after, 1)
+        self.opt_level = opt_level
+        self._backend, self._module, self._transforms = lower_to_mlir(
+            path, jobs=jobs
+        )
+        fn = find_function(self._module, function)
+        self.symbol: str = fn.name.value
+        self._params, self._result = _signature(fn)
+
+        self._variants: OrderedDict[Hashable, JITFunction] = OrderedDict()
+        self._seen: OrderedDict[Hashable, int] = OrderedDict()
+        self._hits = self._misses = self._compiles = self._evictions = 0
+        self._generic = self._build(None)
+
+    def __call__(self, *arrays: np.ndarray) -> np.ndarray:
+        self._check_args(arrays)
+        key = self._key(arrays)
+        variant = self._variants.get(key)
+        if variant is not None:
+            self._variants.move_to_end(key)
+            self._hits += 1
+            return self._call(variant, arrays)
+        if self._should_specialize(key, arrays):
+            variant = self._add_variant(key, [a.shape for a in arrays])
+            self._hits += 1
+            return self._call(variant, arrays)
+        self._misses += 1
+        return self._call(self._generic, arrays)
+
+    def stats(self) -> DispatchStats:
+        return DispatchStats(
+            hits=self._hits,
+            misses=self._misses,
+            compiles=self._compiles,
+            evictions=self._evictions,
+            variants=len(self._variants),
+        )
+
+    def _key(self, arrays: tuple[np.ndarray, ...]) -> Hashable:
+        return (
+            self.symbol,
+            tuple(a.dtype.str for a in arrays),
+            tuple(a.shape for a in arrays),
+            tuple(bool(a.flags.c_contiguous) for a in arrays),
+        )
+
+    def _should_specialize(
+        self, key: Hashable, arrays: tuple[np.ndarray, ...]
+    ) -> bool:
+        if not self.max_variants:
+            return False
+        if not all(a.flags.c_contiguous for a in arrays):
+            return False
+        count = self._seen.pop(key, 0) + 1
+        if count >= self.specialize_after:
+            return True
+        self._seen[key] = count
+        if len(self._seen) > _MAX_TRACKED_KEYS:
+            self._seen.popitem(last=False)
+        return False
+
+    def _add_variant(
+        self, key: Hashable, shapes: list[tuple[int, ...]]
+    ) -> JITFunction:
+        variant = self._build(shapes)
+        self._compiles += 1
+        self._variants[key] = variant
+        if len(self._variants) > self.max_variants:
+            evicted, _ = self._variants.popitem(last=False)
+            self._evictions += 1
+            _logger.debug("evicted variant %s", evicted)
+        return variant
+
+    def _build(self, shapes: list[tuple[int, ...]] | None) -> JITFunction:
+        with stage("specialize", fn=self.symbol, shapes=shapes):
+            module = clone_module(self._module)
+            if shapes is not None:
+                specialize_shapes(module, self.symbol, shapes)
+            with stage("run_passes"):
+                module = self._backend.run_passes(
+                    module, transforms=self._transforms
+                )
+            lib = jit_compile(module, opt_level=self.opt_level)
+        _logger.debug("compiled %s for shapes %s", self.symbol, shapes)
+        return lib.get_function(self.symbol)
+
+    def _check_args(self, arrays: tuple[np.ndarray, ...]) -> None:
+        if len(arrays) != len(self._params):
+            raise TypeError(
+                f"{self.symbol} takes {len(self._params)} arguments,"
+                f" got {len(arrays)}"
+            )
+        for i, (arr, param) in enumerate(zip(arrays, self._params)):
+            if arr.ndim != param.rank or arr.dtype != param.dtype:
+                raise TypeError(
+                    f"argument {i} of {self.symbol}: expected"
+                    f" {param.rank}-d {param.dtype} array, got"
+                    f" {arr.ndim}-d {arr.dtype}"
+                )
+
+    def _call(
+        self, fn: JITFunction, arrays: tuple[np.ndarray, ...]
+    ) -> np.ndarray:
+        descriptors = [get_ranked_memref_descriptor(a) for a in arrays]
+        ctype = np.ctypeslib.as_ctypes_type(self._result.dtype)
+        out = (make_nd_memref_descriptor(self._result.rank, ctype) * 1)()
+        fn(out, *[ctypes.byref(d) for d in descriptors])
+        return ranked_memref_to_numpy(out)
+
+
+def _signature(fn: func.FuncOp) -> tuple[list[_Param], _Param]:
+    fnty = fn.type
+    results = list(fnty.results)
+    if len(results) != 1:
+        raise NotImplementedError(
+            "only functions with a single result are supported"
+        )
+    return [_param(ty) for ty in fnty.inputs], _param(results[0])
+
+
+def _param(ty: ir.Type) -> _Param:
+    if not ir.MemRefType.isinstance(ty):
+        raise NotImplementedError(f"unsupported parameter type: {ty}")
+    memref_ty = ir.MemRefType(ty)
+    elt = str(memref_ty.element_type)
+    if elt not in _NUMPY_DTYPES:
+        raise NotImplementedError(f"unsupported element type: {elt}")
+    return _Param(memref_ty.rank, np.dtype(_NUMPY_DTYPES[elt]))
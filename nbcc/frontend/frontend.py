@@ -1,3 +1,9 @@
+import hashlib
+import json
+import logging
+import sys
+import tempfile
+import threading
 from collections import defaultdict
 from contextlib import contextmanager
 from dataclasses import dataclass, field
@@ -21,33 +27,56 @@ from sealir.rvsdg import format_rvsdg
 from sealir.rvsdg import grammar as rg
 from sealir.rvsdg import internal_prefix
 from spy.fqn import FQN
-from spy.vm.function import W_ASTFunc, W_BuiltinFunc, W_FuncType, W_Func
-from spy.vm.struct import W_StructType
-from spy.vm.object import W_Type
 from spy.vm.vm import SPyVM
 from spy.location import Loc
 from spy.vm.module import W_Module
 
 from . import grammar as sg
 from .restructure import SCFG, SpyBasicBlock, _SpyScfgRenderer, restructure
-from .spy_ast import Node, convert_to_node
-from nbcc.developer import TODO
+from . import redshifted
+from .redshifted import (
+    FuncRef,
+    FuncTypeRef,
+    RedshiftedModule,
+    StructRef,
+    TypeRef,
+    snapshot,
+)
+from .spy_ast import Node
+from nbcc.cache import (
+    ArtifactCache,
+    compiler_fingerprint,
+    hash_sources,
+    is_cache_disabled,
+    package_fingerprint,
+)
+from nbcc.developer import TODO, Lazy
+from nbcc.profiling import stage
 from . import extra_spy_builtins
 
+_logger = logging.getLogger(__name__)
+
 
 @dataclass(frozen=True)
 class FunctionInfo:
     fqn: FQN
     region: SCFG
     metadata: list[ase.SExpr]
+    # Structural hash of the redshifted AST and the types of the function;
+    # see `function_hash()`
+    ast_hash: str = ""
+    # The functions and builtins it references
+    callees: frozenset[FQN] = frozenset()
 
 
 class TranslationUnit:
     _symtabs: dict[FQN, FunctionInfo]
-    _structs: dict[FQN, W_StructType]
-    _builtins: dict[FQN, Any]
+    _structs: dict[FQN, StructRef]
+    _builtins: dict[FQN, FuncRef]
+    filename: str | None
 
-    def __init__(self):
+    def __init__(self, filename: str | None = None):
+        self.filename = filename
         self._symtabs = {}
         self._structs = {}
         self._builtins = {}
@@ -65,7 +94,7 @@ class TranslationUnit:
     def is_struct(self, fqn: FQN) -> bool:
         return fqn in self._structs
 
-    def get_struct(self, fqn: FQN) -> W_StructType:
+    def get_struct(self, fqn: FQN) -> StructRef:
         return self._structs[fqn]
 
     def get_function(self, fqn: FQN) -> FunctionInfo:
@@ -83,6 +112,38 @@ class TranslationUnit:
         return f"{cname}([{syms}])"
 
 
+def _new_vm() -> SPyVM:
+    vm = SPyVM()
+    # Install custom builtins here
+    vm.make_module(extra_spy_builtins.MLIR)
+    # End custom builtins
+    return vm
+
+
+# A VM created ahead of time by `prepare_vm()`
+_spare_vm: SPyVM | None = None
+_spare_vm_lock = threading.Lock()
+
+
+def prepare_vm() -> None:
+    """Create the VM of the next `redshift()` now.
+
+    Used by the compile server (`nbcc.server`) to take the creation of the
+    VM off the critical path of the next request. A VM is only used once.
+    """
+    global _spare_vm
+    with _spare_vm_lock:
+        if _spare_vm is None:
+            _spare_vm = _new_vm()
+
+
+def _take_vm() -> SPyVM:
+    global _spare_vm
+    with _spare_vm_lock:
+        vm, _spare_vm = _spare_vm, None
+    return vm if vm is not None else _new_vm()
+
+
 def redshift(filename: str | Path) -> tuple[SPyVM, W_Module]:
     """
     Perform redshift on the given file
@@ -92,10 +153,7 @@ def redshift(filename: str | Path) -> tuple[SPyVM, W_Module]:
     filename = Path(filename)
     modname = filename.stem
     builddir = filename.parent
-    vm = SPyVM()
-    # Install custom builtins here
-    vm.make_module(extra_spy_builtins.MLIR)
-    # End custom builtins
+    vm = _take_vm()
     vm.path.append(str(builddir))
     w_mod = vm.import_(modname)
     vm.redshift(error_mode="eager")
@@ -103,63 +161,135 @@ def redshift(filename: str | Path) -> tuple[SPyVM, W_Module]:
 
 
 def frontend(filename: str, *, view: bool = False) -> TranslationUnit:
-    vm, w_mod = redshift(filename)
-
-    tu = TranslationUnit()
-
-    symtab: dict[FQN, Node] = {}
-    fn_type: dict[FQN, W_FuncType] = {}
-
-    fqn_to_local_type = {}
-    vm.pp_globals()
-    for fqn, w_obj in vm.fqns_by_modname(w_mod.name):
-        print("?" * 80)
-        print(fqn, "|", w_obj, "::", type(w_obj))
-        if isinstance(w_obj, W_ASTFunc):
-            if w_obj.locals_types_w is not None:
-                node = convert_to_node(w_obj.funcdef, vm=vm).insert_fqn(fqn)
-                symtab[fqn] = node
-                fn_type[fqn] = w_obj.w_functype
-                fqn_to_local_type[fqn] = w_obj.locals_types_w
-        elif isinstance(w_obj, W_BuiltinFunc):
-            tu.add_builtin(fqn, w_obj)
-        elif isinstance(w_obj, W_StructType):
-            tu.add_struct_type(fqn, w_obj)
-        else:
-            breakpoint()
+    with stage("redshift"):
+        mod = load_redshifted(filename)
+
+    tu = TranslationUnit(str(filename))
+    for fqn, builtin in mod.builtins.items():
+        tu.add_builtin(fqn, builtin)
+    for fqn, struct in mod.structs.items():
+        tu.add_struct_type(fqn, struct)
+
+    fqn_to_local_type = {fn.fqn: fn.locals_types_w for fn in mod.functions}
 
     # restructure
-    for fqn, func_node in symtab.items():
-        print("/" * 80)
-        print("///TRANSLATE", fqn)
+    for fn in mod.functions:
+        fqn, func_node = fn.fqn, fn.node
+        _logger.debug("/" * 80)
+        _logger.debug("///TRANSLATE %s", fqn)
 
-        scfg = restructure(fqn.fullname, func_node)
+        with stage("restructure", fn=fqn.fullname):
+            scfg = restructure(fqn.fullname, func_node)
         if view:
             _SpyScfgRenderer(scfg).view()
-        region, mds = convert_to_sexpr(
-            func_node,
-            scfg,
-            fn_type[fqn],
-            fqn_to_local_type[fqn],
-            fqn_to_local_type,
-            vm,
+        with stage("convert_to_sexpr", fn=fqn.fullname):
+            region, mds = convert_to_sexpr(
+                func_node,
+                scfg,
+                fn.w_functype,
+                fn.locals_types_w,
+                fqn_to_local_type,
+                mod,
+            )
+        _logger.debug("%s", Lazy(format_rvsdg, region))
+        tu.add_function(
+            FunctionInfo(
+                fqn=fqn,
+                region=region,
+                metadata=mds,
+                ast_hash=function_hash(
+                    func_node, fn.w_functype, fn.locals_types_w
+                ),
+                callees=frozenset(func_node.referenced_fqns()),
+            )
         )
-        print(format_rvsdg(region))
-        tu.add_function(FunctionInfo(fqn=fqn, region=region, metadata=mds))
 
     return tu
 
 
+def load_redshifted(filename: str | Path) -> RedshiftedModule:
+    """The redshifted state of the module at `filename`.
+
+    Served from the artifact cache when neither the module, its local
+    imports nor the compiler changed; otherwise the module is redshifted by
+    a new VM and the result is cached. See `nbcc.frontend.redshifted`.
+    """
+    if is_cache_disabled():
+        return snapshot(*redshift(filename))
+
+    cache = ArtifactCache()
+    key = redshift_key(filename)
+    if (path := cache.lookup(key)) is not None:
+        try:
+            with stage("redshift_cache_load"):
+                return redshifted.load(path)
+        except ValueError as e:
+            _logger.warning("ignoring the cached redshift: %s", e)
+
+    mod = snapshot(*redshift(filename))
+    with stage("redshift_cache_store"):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp = Path(tmpdir) / "redshifted.pickle"
+            try:
+                redshifted.dump(mod, tmp)
+            except redshifted.UnserializableError as e:
+                _logger.debug(
+                    "not caching the redshift of %s: %s", filename, e
+                )
+            else:
+                cache.store(key, tmp, metadata={"source": str(filename)})
+    return mod
+
+
+def redshift_key(filename: str | Path) -> str:
+    """Cache key of the redshifted state of `filename`.
+
+    Covers the module and its local imports, the compiler (which defines
+    the extra builtins), the sources of SPy and the version of Python.
+    """
+    components = {
+        "format": redshifted.FORMAT,
+        "source": hash_sources(filename),
+        "compiler": compiler_fingerprint(),
+        "spy": package_fingerprint("spy"),
+        "python": sys.version,
+    }
+    encoded = json.dumps(components, sort_keys=True)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def function_hash(
+    func_node: Node,
+    w_functype: FuncTypeRef,
+    local_types: dict[str, TypeRef],
+) -> str:
+    """Structural hash of a redshifted function: its AST without the
+    source locations, its signature and the types of its locals.
+
+    Used by `nbcc.watch` to find the functions that changed between two
+    builds.
+    """
+    signature = [
+        *(param.w_T.fqn.fullname for param in w_functype.params),
+        w_functype.w_restype.fqn.fullname,
+    ]
+    types = sorted(
+        (name, w_type.fqn.fullname) for name, w_type in local_types.items()
+    )
+    text = f"{func_node.structural_hash()}|{signature}|{types}"
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
 def convert_to_sexpr(
     func_node: Node,
     scfg: SCFG,
-    fn_type: W_FuncType,
-    local_types: dict[str, W_Type],
-    global_ns: dict[FQN, dict[str, W_Type]],
-    vm: SPyVM,
+    fn_type: FuncTypeRef,
+    local_types: dict[str, TypeRef],
+    global_ns: dict[FQN, dict[str, TypeRef]],
+    module: RedshiftedModule,
 ) -> tuple[SCFG, list]:
     with ase.Tape() as tape:
-        cts = ConvertToSExpr(tape, local_types, global_ns, vm)
+        cts = ConvertToSExpr(tape, local_types, global_ns, module)
         with cts.setup_function(func_node) as rb:
             cts.handle_region(scfg)
 
@@ -167,6 +297,11 @@ def convert_to_sexpr(
         return region, cts._metadata
 
 
+def loopcond_name(depth: int) -> str:
+    """Name of the loop condition variable of a region at scope `depth`."""
+    return internal_prefix(f"_loopcond_{depth:03x}")
+
+
 @dataclass(frozen=True)
 class Scope:
     vardefs: dict[str, FQN] = field(init=False, default_factory=dict)
@@ -176,8 +311,8 @@ class Scope:
 @dataclass(frozen=True)
 class ConversionContext:
     grm: sg.Grammar
-    local_types: dict[str, W_Type]
-    global_ns: dict[FQN, dict[str, W_Type]]
+    local_types: dict[str, TypeRef]
+    global_ns: dict[FQN, dict[str, TypeRef]]
     scope_stack: list = field(init=False, default_factory=list)
     scope_map: dict[Any, Scope] = (
         field(  # Keys are wrapped NamedSExpr[Grammar, RegionBegin]
@@ -187,8 +322,7 @@ class ConversionContext:
 
     @property
     def loopcond_name(self) -> str:
-        d = len(self.scope_stack)
-        return internal_prefix(f"_loopcond_{d:03x}")
+        return loopcond_name(len(self.scope_stack))
 
     @property
     def scope(self) -> Scope:
@@ -295,9 +429,9 @@ class ConvertToSExpr:
     def __init__(
         self,
         tape: ase.Tape,
-        local_types: dict[str, W_Type],
-        global_ns: dict[FQN, dict[str, W_Type]],
-        vm: SPyVM,
+        local_types: dict[str, TypeRef],
+        global_ns: dict[FQN, dict[str, TypeRef]],
+        module: RedshiftedModule,
     ):
         self._tape = tape
         self._context = ConversionContext(
@@ -308,9 +442,10 @@ class ConvertToSExpr:
         self._metadata: list[ase.SExpr] = []
         self._local_types = local_types
         self._global_ns = global_ns
-        self._vm = vm
+        self._module = module
         self._args: list[ase.SExpr] = []
         self._memo_fntypes: dict[Any, Any] = {}
+        self._memo_defs: dict[tuple[int, int], set[str]] = {}
 
     def insert_typeinfo(self, value: ase.SExpr, type_expr: ase.SExpr) -> None:
         self._metadata.append(
@@ -320,7 +455,7 @@ class ConvertToSExpr:
         )
 
     def insert_func_typeinfo(
-        self, value: ase.SExpr, functype: W_FuncType
+        self, value: ase.SExpr, functype: FuncTypeRef
     ) -> None:
         tys = [self.emit_type(param.w_T) for param in functype.params]
         restype = self.emit_type(functype.w_restype)
@@ -340,7 +475,7 @@ class ConvertToSExpr:
         )
         return self._context.unwrap_type_expr(written_type)
 
-    def emit_type(self, ty: W_Type):
+    def emit_type(self, ty: TypeRef):
         if fqn := ty.fqn:
             return self._context.grm.write(
                 sg.TypeExpr(name=fqn.fullname, args=())
@@ -371,7 +506,7 @@ class ConvertToSExpr:
             yield rb
 
     def close_function(
-        self, rb: rg.RegionBegin, func_node: Node, fn_type: W_FuncType
+        self, rb: rg.RegionBegin, func_node: Node, fn_type: FuncTypeRef
     ) -> rg.SExpr:
         ctx = self._context
         vars = {internal_prefix("io"), internal_prefix("ret")}
@@ -406,7 +541,7 @@ class ConvertToSExpr:
         self.insert_typeinfo(body, fnty)
 
         # add IRtags
-        irtag = self._vm.irtags[func_node.fqn]
+        irtag = self._module.irtags[func_node.fqn]
         if irtag.tag:
             datalist = []
             for k, v in irtag.data.items():
@@ -434,7 +569,9 @@ class ConvertToSExpr:
             kind = getattr(block, "kind", None)
             by_kinds[kind].append(block)
 
-        print("--by-kinds", [(k, len(vs)) for k, vs in by_kinds.items()])
+        _logger.debug(
+            "--by-kinds %s", [(k, len(vs)) for k, vs in by_kinds.items()]
+        )
         if "branch" in by_kinds:
             [head_block] = by_kinds["head"]
             [then_block, else_block] = by_kinds["branch"]
@@ -485,6 +622,54 @@ class ConvertToSExpr:
                 last = self.codegen(blk)
             return last
 
+    def collect_defs(self, scfg: SCFG, depth: int) -> set[str]:
+        """Names stored into the scope when converting `scfg` at `depth`.
+
+        This mirrors the stores done by `handle_region()`, `codegen()` and
+        `emit_statement()` without writing anything to the tape.
+        """
+        key = (id(scfg), depth)
+        if (cached := self._memo_defs.get(key)) is not None:
+            return cached
+        defs = {internal_prefix("io")}
+        for _, block in scfg.concealed_region_view.items():
+            # The branches of an if-else are converted in a new region
+            if getattr(block, "kind", None) == "branch":
+                defs |= self._collect_block_defs(block, depth + 1)
+            else:
+                defs |= self._collect_block_defs(block, depth)
+        self._memo_defs[key] = defs
+        return defs
+
+    def _collect_block_defs(self, block: BasicBlock, depth: int) -> set[str]:
+        match block:
+            case RegionBlock():
+                if isinstance(block.subregion, SCFG):
+                    if block.kind == "loop":
+                        inner = self.collect_defs(block.subregion, depth + 1)
+                        return inner - {loopcond_name(depth + 1)}
+                    return self.collect_defs(block.subregion, depth)
+                return self._collect_block_defs(block.subregion, depth)
+            case SpyBasicBlock():
+                defs = set()
+                for stmt in block.body:
+                    match stmt:
+                        case Node(
+                            "AssignLocal",
+                            target=Node("StrConst", value=str(target)),
+                        ):
+                            defs.add(target)
+                        case Node("Return"):
+                            defs.add("__scfg_return_value__")
+                return defs
+            case SyntheticAssignment():
+                # codegen() only stores the first assignment
+                return set(list(block.variable_assignment)[:1])
+            case SyntheticExitingLatch():
+                return {loopcond_name(depth)}
+            case _:
+                return set()
+
     def codegen(self, block: BasicBlock) -> ase.SExpr | None:
         ctx = self._context
         grm = ctx.grm
@@ -494,18 +679,16 @@ class ConvertToSExpr:
                     if block.kind == "loop":
                         operands = ctx.get_scope_as_operands()
                         operand_names = list(ctx.get_scope_as_parameters())
-                        with ctx.new_region(operand_names) as loop_region:
-                            self.handle_region(block.subregion)
-                            loopcondvar = ctx.loopcond_name
-
-                        updated_vars = ctx.compute_updated_vars(loop_region)
-                        loop_end = ctx.close_region(loop_region, updated_vars)
-
-                        # TODO: this should use a rewrite pass
-                        #
-                        # Redo the loop region so that the incoming ports
-                        # matches the outgoing ports
-                        new_vars = sorted(updated_vars - {loopcondvar})
+                        # The incoming ports of the loop region must match
+                        # the outgoing ports. Compute the variables defined
+                        # by the body upfront so the region is only
+                        # converted once.
+                        depth = len(ctx.scope_stack) + 1
+                        defs = self.collect_defs(block.subregion, depth)
+                        new_vars = sorted(
+                            (set(operand_names) | defs)
+                            - {loopcond_name(depth)}
+                        )
                         with ctx.new_region(new_vars) as loop_region:
                             self.handle_region(block.subregion)
                             loopcondvar = ctx.loopcond_name
@@ -640,7 +823,7 @@ class ConvertToSExpr:
     def emit_expression(self, node: Node) -> ase.SExpr:
         ctx = self._context
         grm = ctx.grm
-        vm = self._vm
+        module = self._module
         match node:
             case Node("NameLocal"):
                 return ctx.load_local(node.sym.name)
@@ -651,16 +834,16 @@ class ConvertToSExpr:
                 ),
                 args=list(args),
             ):
-                w_obj = vm.lookup_global(callee_fqn)
+                w_obj = module.lookup_global(callee_fqn)
                 assert w_obj is not None
-                assert isinstance(w_obj, W_Func), type(w_obj)
+                assert isinstance(w_obj, FuncRef), type(w_obj)
                 functype = w_obj.w_functype
                 if "mlir::asm" == w_obj.fqn.namespace.fullname:
                     TODO(
                         "implement custom sexpr conversion so this can be plumbed through"
                     )
                     """
-                    tags = vm.irtags[w_obj.fqn]
+                    tags = module.irtags[w_obj.fqn]
                     grm.write(sg.MLIR_asm(asm=tags.data['asm'], io))
                     """
 
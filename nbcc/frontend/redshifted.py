@@ -0,0 +1,229 @@
+"""
+The redshifted state of a SPy module, as plain data.
+
+`redshift()` runs the SPy VM: it imports the module and its dependencies and
+partially evaluates the blue code, e.g. the type constructors of
+`llm_tensor.spy`. The frontend only needs the outcome: the ASTs of the red
+functions, their types, the functions they call, the structs, the builtins
+and the irtags. `snapshot()` copies these out of the VM into a
+`RedshiftedModule`, in which the `W_` objects of the VM are replaced by small
+records with the attributes the compiler reads (`TypeRef`, `FuncTypeRef`,
+`StructRef`, ...). `W_` objects hold references into the whole VM, so they
+are not serialized.
+
+A `RedshiftedModule` is pickled into the artifact cache by
+`nbcc.frontend.frontend.load_redshifted()`, so that a warm compile does not
+create a VM at all.
+"""
+
+from __future__ import annotations
+
+import io
+import logging
+import pickle
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterator
+
+from spy.fqn import FQN
+from spy.vm.function import W_ASTFunc, W_BuiltinFunc, W_Func, W_FuncType
+from spy.vm.object import W_Object, W_Type
+from spy.vm.struct import W_StructType
+
+from .spy_ast import Node, convert_to_node
+
+if TYPE_CHECKING:
+    from spy.vm.module import W_Module
+    from spy.vm.vm import SPyVM
+
+_logger = logging.getLogger(__name__)
+
+# Bump when the records below change
+FORMAT = "nbcc-redshifted-v1"
+
+
+@dataclass(frozen=True)
+class TypeRef:
+    """A `W_Type`, by name."""
+
+    fqn: FQN
+
+
+@dataclass(frozen=True)
+class ParamRef:
+    w_T: TypeRef
+
+
+@dataclass(frozen=True)
+class FuncTypeRef:
+    """A `W_FuncType`."""
+
+    params: tuple[ParamRef, ...]
+    w_restype: TypeRef
+
+
+@dataclass(frozen=True)
+class FuncRef:
+    """A `W_Func`: a builtin or a function called by the module."""
+
+    fqn: FQN
+    w_functype: FuncTypeRef
+
+
+@dataclass(frozen=True)
+class FieldRef:
+    name: str
+    w_T: TypeRef
+
+
+@dataclass(frozen=True)
+class StructRef:
+    """A `W_StructType`."""
+
+    fqn: FQN
+    fields: tuple[FieldRef, ...]
+    # The names defined on the type; only tested for membership
+    dict_w: frozenset[str]
+
+    def iterfields_w(self) -> Iterator[FieldRef]:
+        return iter(self.fields)
+
+
+@dataclass(frozen=True)
+class IRTagRef:
+    tag: Any
+    data: dict[str, Any]
+
+
+@dataclass(frozen=True)
+class RedshiftedFunction:
+    """A red function of the module after redshift."""
+
+    fqn: FQN
+    # The converted AST, with the FQN inserted
+    node: Node
+    w_functype: FuncTypeRef
+    locals_types_w: dict[str, TypeRef]
+
+
+@dataclass(frozen=True)
+class RedshiftedModule:
+    """Everything the frontend reads from the VM.
+
+    Stands in for the VM in `ConvertToSExpr`: it has the `lookup_global()`
+    and `irtags` it uses.
+    """
+
+    functions: list[RedshiftedFunction]
+    structs: dict[FQN, StructRef]
+    builtins: dict[FQN, FuncRef]
+    # The functions called by `functions`
+    callees: dict[FQN, FuncRef]
+    irtags: dict[FQN, IRTagRef]
+
+    def lookup_global(self, fqn: FQN) -> FuncRef | None:
+        return self.callees.get(fqn)
+
+
+def snapshot(vm: SPyVM, w_mod: W_Module) -> RedshiftedModule:
+    """Copy the state of the redshifted module `w_mod` out of `vm`."""
+    functions: list[RedshiftedFunction] = []
+    structs: dict[FQN, StructRef] = {}
+    builtins: dict[FQN, FuncRef] = {}
+    if _logger.isEnabledFor(logging.DEBUG):
+        vm.pp_globals()
+    for fqn, w_obj in vm.fqns_by_modname(w_mod.name):
+        _logger.debug("?" * 80)
+        _logger.debug("%s | %s :: %s", fqn, w_obj, type(w_obj))
+        if isinstance(w_obj, W_ASTFunc):
+            if w_obj.locals_types_w is not None:
+                node = convert_to_node(w_obj.funcdef, vm=vm).insert_fqn(fqn)
+                functions.append(
+                    RedshiftedFunction(
+                        fqn=fqn,
+                        node=node,
+                        w_functype=_functype(w_obj.w_functype),
+                        locals_types_w={
+                            name: _type(w_T)
+                            for name, w_T in w_obj.locals_types_w.items()
+                        },
+                    )
+                )
+        elif isinstance(w_obj, W_BuiltinFunc):
+            builtins[fqn] = FuncRef(fqn, _functype(w_obj.w_functype))
+        elif isinstance(w_obj, W_StructType):
+            structs[fqn] = StructRef(
+                fqn,
+                tuple(
+                    FieldRef(w_field.name, _type(w_field.w_T))
+                    for w_field in w_obj.iterfields_w()
+                ),
+                frozenset(w_obj.dict_w),
+            )
+        else:
+            raise TypeError(f"unexpected global {fqn}: {type(w_obj)}")
+
+    callees: dict[FQN, FuncRef] = {}
+    irtags: dict[FQN, IRTagRef] = {}
+    for fn in functions:
+        irtag = vm.irtags[fn.fqn]
+        irtags[fn.fqn] = IRTagRef(
+            irtag.tag, dict(irtag.data) if irtag.tag else {}
+        )
+        for fqn in fn.node.referenced_fqns():
+            w_obj = vm.lookup_global(fqn)
+            if isinstance(w_obj, W_Func):
+                callees[fqn] = FuncRef(w_obj.fqn, _functype(w_obj.w_functype))
+    return RedshiftedModule(functions, structs, builtins, callees, irtags)
+
+
+def _type(w_T: W_Type) -> TypeRef:
+    return TypeRef(w_T.fqn)
+
+
+def _functype(w_functype: W_FuncType) -> FuncTypeRef:
+    return FuncTypeRef(
+        tuple(ParamRef(_type(param.w_T)) for param in w_functype.params),
+        _type(w_functype.w_restype),
+    )
+
+
+class UnserializableError(ValueError):
+    """The module references VM objects that cannot be serialized."""
+
+
+class _Pickler(pickle.Pickler):
+    def persistent_id(self, obj: Any) -> None:
+        # E.g. a literal in an AST; it would drag the whole VM along
+        if isinstance(obj, W_Object):
+            raise UnserializableError(f"cannot serialize {obj!r}")
+        return None
+
+
+def dump(module: RedshiftedModule, path: str | Path) -> None:
+    """Serialize `module` to `path`.
+
+    Raises:
+        UnserializableError: `module` holds a `W_` object.
+    """
+    buf = io.BytesIO()
+    try:
+        _Pickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump((FORMAT, module))
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        raise UnserializableError(str(e)) from e
+    Path(path).write_bytes(buf.getvalue())
+
+
+def load(path: str | Path) -> RedshiftedModule:
+    """Read a module written by `dump()`.
+
+    Raises:
+        ValueError: The file is not a serialized module of this version.
+    """
+    try:
+        fmt, module = pickle.loads(Path(path).read_bytes())
+    except Exception as e:
+        raise ValueError(f"cannot read {path}: {e}") from e
+    if fmt != FORMAT or not isinstance(module, RedshiftedModule):
+        raise ValueError(f"{path} is not a {FORMAT} file")
+    return module
@@ -1,3 +1,4 @@
+import logging
 from dataclasses import dataclass, field
 from pprint import pformat, pprint
 from textwrap import indent
@@ -13,6 +14,8 @@ from numba_scfg.core.datastructures.scfg import SCFG, RegionBlock
 
 from .spy_ast import Node
 
+_logger = logging.getLogger(__name__)
+
 
 def _format_stmt(stmt: Any) -> str:
     """Format a statement for display"""
@@ -76,9 +79,9 @@ def _create_basic_blocks(node: Node) -> dict[str, BasicBlock]:
 def _print_basic_blocks(block_map: dict[str, BasicBlock]) -> None:
     """Print basic blocks for debugging"""
     for name, block in block_map.items():
-        print(f"BB {name!r}:  # {type(block)}")
+        _logger.debug("BB %r:  # %s", name, type(block))
         for stmt in block.body:
-            print("    ", stmt)
+            _logger.debug("     %s", stmt)
 
 
 def _create_and_process_scfg(block_map: dict[str, BasicBlock]) -> SCFG:
@@ -1,7 +1,9 @@
 from __future__ import annotations
 import ast as py_ast
+import hashlib
+import re
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, Iterator, Optional
 
 import spy.ast
 from spy.analyze.symtable import Color, Symbol
@@ -32,8 +34,10 @@ class Node:
         return hash(id(self))
 
     def __getattr__(self, key: str) -> Any:
+        # Through __dict__: `_attrdict` is not set yet when pickle looks up
+        # `__setstate__` on a new instance
         try:
-            return self._attrdict[key]
+            return self.__dict__["_attrdict"][key]
         except KeyError:
             raise AttributeError(key) from None
 
@@ -41,6 +45,34 @@ class Node:
         self._attrdict["fqn"] = fqn
         return self
 
+    def iter_values(self) -> Iterator[Any]:
+        """The leaf values of the tree, excluding the locations."""
+        for k, v in self._attrdict.items():
+            if k in self.IGNORED:
+                continue
+            for item in v if type(v) is list else [v]:
+                if isinstance(item, Node):
+                    yield from item.iter_values()
+                else:
+                    yield item
+
+    def structural_hash(self) -> str:
+        """Hash of the tree ignoring the source locations, so that moving a
+        function in its file does not change it."""
+        # Literals of objects without a repr print their address
+        text = _address_pattern.sub("", repr(self))
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def referenced_fqns(self) -> set[FQN]:
+        """The FQNs referenced by the tree, e.g. the called functions."""
+        own = self._attrdict.get("fqn")
+        return {
+            v for v in self.iter_values() if isinstance(v, FQN) and v != own
+        }
+
+
+_address_pattern = re.compile(r" at 0x[0-9a-fA-F]+")
+
 
 def convert_to_node(
     node: Any,
@@ -1,6 +1,14 @@
+import sys
 import tempfile
+
+import pytest
+from sealir.rvsdg import format_rvsdg
+
 from nbcc.frontend import frontend
 
+# The package exports the `frontend()` function under the module's name
+frontend_module = sys.modules["nbcc.frontend.frontend"]
+
 
 def _compile(src: str):
     with tempfile.NamedTemporaryFile(
@@ -111,3 +119,75 @@ def main() -> None:
     print(a)
 """
     _compile(source)
+
+
+def _nested_loops_source(depth: int) -> str:
+    lines = ["def main() -> None:"]
+    lines += [f"    i{d}: i32" for d in range(depth)]
+    for d in range(depth):
+        indent = "    " * (d + 1)
+        lines.append(f"{indent}i{d} = 0")
+        lines.append(f"{indent}while i{d} < 2:")
+    for d in reversed(range(depth)):
+        indent = "    " * (d + 2)
+        lines.append(f"{indent}i{d} = i{d} + 1")
+    lines.append("    print(i0)")
+    return "\n".join(lines) + "\n"
+
+
+@pytest.mark.parametrize("depth", range(1, 9))
+def test_bench_nested_loops(benchmark, depth):
+    source = _nested_loops_source(depth)
+    benchmark.pedantic(
+        _compile, args=(source,), rounds=3, iterations=1, warmup_rounds=0
+    )
+
+
+def test_nested_loops_convert_each_region_once(monkeypatch):
+    calls = []
+    handle_region = frontend_module.ConvertToSExpr.handle_region
+
+    def counting_handle_region(self, scfg):
+        calls.append(scfg)
+        return handle_region(self, scfg)
+
+    monkeypatch.setattr(
+        frontend_module.ConvertToSExpr, "handle_region", counting_handle_region
+    )
+    counts = []
+    for depth in range(1, 6):
+        calls.clear()
+        _compile(_nested_loops_source(depth))
+        counts.append(len(calls))
+    # Each level of nesting adds the same number of regions; converting the
+    # loop bodies twice doubled it instead
+    assert len({b - a for a, b in zip(counts, counts[1:])}) == 1
+
+
+def _two_pass_collect_defs(self, scfg, depth):
+    # How the loop ports were computed before `collect_defs()`: by
+    # converting the loop body a first time
+    ctx = self._context
+    with ctx.new_region(list(ctx.get_scope_as_parameters())) as rb:
+        self.handle_region(scfg)
+    return ctx.compute_updated_vars(rb)
+
+
+def _rvsdg(source: str) -> dict[str, str]:
+    tu = _compile(source)
+    return {
+        str(fqn): format_rvsdg(tu.get_function(fqn).region)
+        for fqn in tu.list_functions()
+    }
+
+
+@pytest.mark.parametrize("depth", [1, 3])
+def test_nested_loops_rvsdg_unchanged(monkeypatch, depth):
+    source = _nested_loops_source(depth)
+    single_pass = _rvsdg(source)
+    monkeypatch.setattr(
+        frontend_module.ConvertToSExpr,
+        "collect_defs",
+        _two_pass_collect_defs,
+    )
+    assert _rvsdg(source) == single_pass
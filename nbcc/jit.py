@@ -0,0 +1,202 @@
+"""
+In-process JIT execution of compiled MLIR modules.
+
+This is an alternative to `nbcc.compiler.make_shared` that avoids the
+external toolchain. The LLVM-dialect module returned by
+`nbcc.compiler.compile_to_mlir` is translated and compiled in-process by the
+MLIR `ExecutionEngine`.
+
+Example:
+
+    module = compile_to_mlir("llm_tensor.spy")
+    lib = jit_compile(module, opt_level=3)
+    fn = getattr(lib, "_mlir_ciface_spy_llm_tensor$exported$export_softmax")
+    fn(out_memref, byref(argA))
+
+The returned callables take the same arguments as the corresponding
+functions loaded with `ctypes.CDLL` from a shared library.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import hashlib
+import os
+import subprocess as subp
+import sys
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Sequence
+
+from mlir import ir
+from mlir.execution_engine import ExecutionEngine
+
+from nbcc.cache import default_cache_dir
+from nbcc.compiler import compile_to_mlir
+from nbcc.runtime import allocator_shared
+from nbcc.toolchain import (
+    find_mlir_runner_utils,
+    find_openmp_runtime,
+    libspy_dir,
+    uses_openmp,
+    uses_pool_allocator,
+)
+
+CIFACE_PREFIX = "_mlir_ciface_"
+
+_shlib_suffix = ".dylib" if sys.platform == "darwin" else ".so"
+
+
+@lru_cache(maxsize=None)
+def libspy_shared() -> str:
+    """
+    Path to a shared build of `libspy` that the JIT can load.
+
+    `libspy` is normally built as a static archive for linking native
+    executables. When no shared build is available, one is created from the
+    archive and stored in the nbcc cache directory.
+    """
+    libdir = libspy_dir()
+    shared = libdir / f"libspy{_shlib_suffix}"
+    if shared.exists():
+        return str(shared)
+
+    archive = libdir / "libspy.a"
+    if not archive.exists():
+        raise RuntimeError(f"Could not find libspy in {libdir}")
+    digest = hashlib.sha256(archive.read_bytes()).hexdigest()[:16]
+    outdir = default_cache_dir() / "jit"
+    outdir.mkdir(parents=True, exist_ok=True)
+    out = outdir / f"libspy-{digest}{_shlib_suffix}"
+    if not out.exists():
+        tmp = out.with_name(f".tmp{os.getpid()}-{out.name}")
+        if sys.platform == "darwin":
+            whole_archive = [f"-Wl,-force_load,{archive}"]
+        else:
+            whole_archive = [
+                "-Wl,--whole-archive",
+                str(archive),
+                "-Wl,--no-whole-archive",
+            ]
+        subp.check_call(["clang", "-shared", "-o", str(tmp), *whole_archive])
+        os.replace(tmp, out)
+    return str(out)
+
+
+def default_shared_libs() -> list[str]:
+    """Runtime libraries linked into every JIT-compiled module."""
+    return [libspy_shared(), find_mlir_runner_utils()]
+
+
+class JITFunction:
+    """
+    Callable wrapper of a `_mlir_ciface_*` function in a JIT-compiled module.
+
+    Arguments are the same as for the function loaded from a shared library:
+    pointers to the memref descriptors (e.g. `byref(desc)` or an array of
+    descriptors for the results) and scalars wrapped as ctypes objects. A
+    scalar result is written to a trailing ctypes object, e.g.
+    `fn(c_int64(3), out)` with `out = c_double()`.
+    """
+
+    def __init__(self, library: JITLibrary, name: str):
+        self._library = library  # keeps the engine alive
+        self.name = name
+        engine = library.engine
+        address = engine.raw_lookup(name)
+        if not address:
+            raise AttributeError(f"Unknown JIT function {name!r}")
+        # ExecutionEngine only exposes the packed interface, which takes a
+        # single array of pointers to the arguments.
+        prototype = ctypes.CFUNCTYPE(None, ctypes.c_void_p)
+        self._packed = prototype(address)
+
+    def __call__(self, *args: Any) -> None:
+        # The packed interface takes the address of every argument. A
+        # scalar is its own storage; the value of a pointer (`byref`, an
+        # array of result descriptors) is copied into a `c_void_p`, kept
+        # alive for the duration of the call.
+        values = [
+            (
+                arg
+                if isinstance(arg, ctypes._SimpleCData)
+                else ctypes.cast(arg, ctypes.c_void_p)
+            )
+            for arg in args
+        ]
+        packed = (ctypes.c_void_p * len(values))(
+            *[ctypes.addressof(v) for v in values]
+        )
+        self._packed(packed)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class JITLibrary:
+    """In-process equivalent of a shared library built by `make_shared`."""
+
+    engine: ExecutionEngine
+
+    def __init__(
+        self,
+        module: ir.Module,
+        *,
+        opt_level: int = 3,
+        shared_libs: Sequence[str] | None = None,
+    ):
+        if shared_libs is None:
+            shared_libs = default_shared_libs()
+            if uses_openmp(module):
+                shared_libs.append(find_openmp_runtime())
+            if uses_pool_allocator(module):
+                shared_libs.append(allocator_shared())
+        self.exported_names = _list_ciface_functions(module)
+        self.engine = ExecutionEngine(
+            module, opt_level=opt_level, shared_libs=list(shared_libs)
+        )
+        self._functions: dict[str, JITFunction] = {}
+
+    def get_function(self, name: str) -> JITFunction:
+        """Get the callable for `name`.
+
+        `name` may be given with or without the `_mlir_ciface_` prefix.
+        """
+        if not name.startswith(CIFACE_PREFIX):
+            name = CIFACE_PREFIX + name
+        if name not in self._functions:
+            self._functions[name] = JITFunction(self, name)
+        return self._functions[name]
+
+    def __getattr__(self, name: str) -> JITFunction:
+        # Mirror ctypes.CDLL so that `getattr(lib, "_mlir_ciface_...")`
+        # works for both.
+        if name.startswith(CIFACE_PREFIX):
+            return self.get_function(name)
+        raise AttributeError(name)
+
+
+def _list_ciface_functions(module: ir.Module) -> list[str]:
+    names = []
+    for op in module.body.operations:
+        if op.operation.name != "llvm.func":
+            continue
+        sym_name = ir.StringAttr(op.attributes["sym_name"]).value
+        if sym_name.startswith(CIFACE_PREFIX):
+            names.append(sym_name)
+    return names
+
+
+def jit_compile(
+    module: ir.Module,
+    *,
+    opt_level: int = 3,
+    shared_libs: Sequence[str] | None = None,
+) -> JITLibrary:
+    """JIT-compile an LLVM-dialect module returned by `compile_to_mlir`."""
+    return JITLibrary(module, opt_level=opt_level, shared_libs=shared_libs)
+
+
+def jit_compile_file(path: str, *, opt_level: int = 3) -> JITLibrary:
+    """Compile the SPy source at `path` and JIT it in-process."""
+    return jit_compile(compile_to_mlir(path), opt_level=opt_level)
@@ -0,0 +1,274 @@
+"""
+The egraph middle-end: optimize every function of a translation unit with
+equality saturation and extract the cheapest RVSDG.
+
+Imported by `nbcc.compiler` only when a module is compiled.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import warnings
+from typing import cast
+
+import sealir.rvsdg.grammar as rg
+from egglog import EGraph
+from sealir.ase import SExpr, TapeCrawler
+from sealir.eqsat.rvsdg_convert import egraph_conversion
+from sealir.eqsat.rvsdg_eqsat import GraphRoot
+from sealir.eqsat.rvsdg_extract import CostModel as _CostModel
+from sealir.eqsat.rvsdg_extract import egraph_extraction
+from sealir.rvsdg import format_rvsdg
+from spy.fqn import FQN
+
+from nbcc import profiling
+from nbcc.developer import Lazy
+from nbcc.egraph.conversion import ExtendEGraphToRVSDG
+from nbcc.egraph.rules import egraph_convert_metadata, egraph_optimize
+from nbcc.frontend import TranslationUnit, frontend
+from nbcc.frontend.grammar import IRTag, TypeInfo
+from nbcc.profiling import CompileStats, stage
+
+_logger = logging.getLogger(__name__)
+
+
+def middle_end(
+    tu: TranslationUnit, *, jobs: int = 1
+) -> tuple[dict[str, rg.Func], list[TypeInfo | IRTag]]:
+    """Optimize every function in `tu` with the egraph.
+
+    Args:
+        tu: The translation unit from the frontend.
+        jobs: Number of worker processes. Functions are optimized
+            independently so they can be spread over a process pool. The
+            default of 1 runs serially in this process; 0 uses all cores.
+            Results are merged in the order of `tu.list_functions()` so the
+            output is identical to the serial one.
+    """
+    fqns = tu.list_functions()
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    jobs = min(jobs, len(fqns))
+
+    results: list[tuple[dict[str, rg.Func], list[TypeInfo | IRTag]]]
+    if jobs > 1:
+        results = _middle_end_parallel(tu, jobs)
+    else:
+        results = [optimize_function(tu, fqn) for fqn in fqns]
+
+    func_nodes: dict[str, rg.Func] = {}
+    mdlist: list[TypeInfo | IRTag] = []
+    for fn_nodes, fn_mdlist in results:
+        for matched_fqn, node in fn_nodes.items():
+            assert matched_fqn not in func_nodes
+            func_nodes[matched_fqn] = node
+        mdlist.extend(fn_mdlist)
+
+    assert len(func_nodes) >= 1
+    for func in func_nodes.values():
+        _logger.debug("%s", Lazy(format_rvsdg, cast(SExpr, func)))
+        _logger.debug("%s", Lazy(cast(SExpr, func)._tape.dump))
+    return func_nodes, mdlist
+
+
+def optimize_function(
+    tu: TranslationUnit, fqn: FQN
+) -> tuple[dict[str, rg.Func], list[TypeInfo | IRTag]]:
+    """Run egraph optimization and extraction on a single function.
+
+    Returns:
+        The extracted function nodes keyed by name and their metadata.
+    """
+    with stage("optimize_function", fn=fqn.fullname):
+        return _optimize_function(tu, fqn)
+
+
+def _optimize_function(
+    tu: TranslationUnit, fqn: FQN
+) -> tuple[dict[str, rg.Func], list[TypeInfo | IRTag]]:
+    func_nodes: dict[str, rg.Func] = {}
+    mdlist: list[TypeInfo | IRTag] = []
+
+    fi = tu.get_function(fqn)
+    _logger.debug("%s %s", fi.fqn, fi.region)
+
+    with stage("egraph_conversion"):
+        memo = egraph_conversion(fi.region)
+
+        root = GraphRoot(memo[fi.region])
+
+        egraph = EGraph()
+        egraph.let("root", root)
+        egraph.let("mds", egraph_convert_metadata(fi.metadata, memo))
+
+    with stage("egraph_saturation"):
+        expand_struct_type(tu, egraph)
+
+        egraph_optimize(egraph)
+
+    with stage("egraph_extraction"):
+        extraction = egraph_extraction(egraph, cost_model=CostModel())
+        extraction.compute()
+        extresult = extraction.extract_common_root()
+    _logger.debug("egraph extracted")
+    _logger.debug("cost %s", extresult.cost)
+
+    tape = fi.region._tape
+    last = tape.last
+    with stage("egraph_to_rvsdg"):
+        converted_root: SExpr = extresult.convert(
+            fi.region, ExtendEGraphToRVSDG
+        )
+
+    for node in converted_root._args:
+        match node:
+            case rg.Func(fname=str(matched_fqn)):
+                assert matched_fqn not in func_nodes
+                func_nodes[matched_fqn] = node
+
+    crawler = TapeCrawler(tape, converted_root._get_downcast())
+    crawler.move_to_pos_of(last)
+    crawler.move_to_first_record()
+
+    for rec in crawler.walk():
+        node = rec.to_expr()
+        if isinstance(node, TypeInfo):
+            mdlist.append(node)
+        elif isinstance(node, IRTag):
+            mdlist.append(node)
+
+    return func_nodes, mdlist
+
+
+# The translation unit used by the middle-end worker processes
+_worker_tu: TranslationUnit | None = None
+
+
+def _init_middle_end_worker(
+    tu: TranslationUnit | None, filename: str | None
+) -> None:
+    global _worker_tu
+    if tu is None:
+        # Not forked: the translation unit holds SPy VM objects that cannot
+        # be sent to the worker, so rebuild it from the source.
+        assert filename is not None
+        tu = frontend(filename)
+    _worker_tu = tu
+
+
+def _optimize_function_job(
+    index: int,
+) -> tuple[
+    tuple[dict[str, rg.Func], list[TypeInfo | IRTag]],
+    list[profiling.StageRecord],
+]:
+    assert _worker_tu is not None
+    # Always record the stages; they are cheap and are dropped by the
+    # parent unless it is collecting statistics.
+    stats = CompileStats()
+    with profiling.collect(stats):
+        fqn = _worker_tu.list_functions()[index]
+        result = optimize_function(_worker_tu, fqn)
+    return result, stats.records
+
+
+def _middle_end_parallel(
+    tu: TranslationUnit, jobs: int
+) -> list[tuple[dict[str, rg.Func], list[TypeInfo | IRTag]]]:
+    import multiprocessing
+    import pickle
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+
+    # Prefer fork so that workers inherit the translation unit instead of
+    # rerunning the frontend.
+    if "fork" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("fork")
+        initargs = (tu, None)
+    else:
+        mp_context = multiprocessing.get_context("spawn")
+        initargs = (None, tu.filename)
+
+    indices = range(len(tu.list_functions()))
+    try:
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=mp_context,
+            initializer=_init_middle_end_worker,
+            initargs=initargs,
+        ) as pool:
+            # map() yields in submission order, which keeps the merge
+            # deterministic.
+            jobs_out = list(pool.map(_optimize_function_job, indices))
+    except (pickle.PicklingError, TypeError, BrokenProcessPool) as e:
+        warnings.warn(
+            f"parallel middle-end failed ({e!r}); falling back to serial",
+            RuntimeWarning,
+        )
+        return [optimize_function(tu, fqn) for fqn in tu.list_functions()]
+
+    if (stats := profiling.active_stats()) is not None:
+        for _, records in jobs_out:
+            stats.extend(records)
+    return [result for result, _ in jobs_out]
+
+
+class CostModel(_CostModel):
+    def get_cost_function(
+        self,
+        nodename,
+        op,
+        ty,
+        cost,
+        children,
+    ):
+        if op in ["Py_Call", "Py_LoadGlobal"]:
+            return self.get_simple(10000)
+        elif op in ["CallFQN"]:
+            return self.get_simple(1)
+        else:
+            return super().get_cost_function(nodename, op, ty, cost, children)
+
+
+def expand_struct_type(tu: TranslationUnit, egraph):
+    from egglog import Ruleset
+
+    from nbcc.egraph.rules import (
+        create_ruleset_struct__get_field__,
+        create_ruleset_struct__make__,
+        create_ruleset_struct__lift__,
+        create_ruleset_struct__unlift__,
+    )
+
+    schedule = Ruleset(None)  # empty ruleset
+    for fqn_struct, w_obj_struct in tu._structs.items():
+        _logger.debug("%s %s", fqn_struct, w_obj_struct)
+
+        is_lifted_type = "__ll__" in w_obj_struct.dict_w
+        for fqn, w_obj in tu._builtins.items():
+            _logger.debug("BUITIN %s", fqn)
+            subname = fqn.parts[-1].name
+            if subname == "__make__":
+                if is_lifted_type:
+                    _logger.debug("Add __lift__")
+                    schedule |= create_ruleset_struct__lift__(w_obj)
+
+                else:
+                    _logger.debug("Add __make__")
+                    schedule |= create_ruleset_struct__make__(w_obj)
+
+            elif subname.startswith("__get_"):
+
+                if is_lifted_type:
+                    assert subname == "__get___ll____"
+                    schedule |= create_ruleset_struct__unlift__(w_obj)
+                else:
+                    _logger.debug("Add field getter")
+                    for i, w_field in enumerate(w_obj_struct.iterfields_w()):
+                        if subname == f"__get_{w_field.name}__":
+                            schedule |= create_ruleset_struct__get_field__(
+                                w_obj, i
+                            )
+
+    egraph.run(schedule.saturate())
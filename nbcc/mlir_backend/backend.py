@@ -1,6 +1,10 @@
 from __future__ import annotations
 
-from typing import Sequence, cast
+import logging
+import os
+import re
+import threading
+from typing import Any, Sequence, cast
 
 import mlir.dialects.arith as arith
 import mlir.dialects.cf as cf
@@ -13,12 +17,23 @@ from sealir import ase
 from sealir.dispatchtable import DispatchTableBuilder, dispatchtable
 from spy.fqn import FQN
 
-from nbcc.developer import TODO
+from nbcc.developer import TODO, Lazy, debug_verify, is_release_mode
+from nbcc.profiling import stage
+from nbcc.runtime import FREE_SYMBOL
 from nbcc.mlir_utils import decode_type_name, decode_asm_operation
 from nbcc.mlir_lowering import BackendInterface, MDMap, LowerStates
 
 from ..frontend import grammar as sg, TranslationUnit
+from .bare_ptr import add_bare_ptr_wrappers
+from .destination_passing import (
+    DESTINATION_PASSING_ATTR,
+    convert_to_destination_passing,
+    is_destination_passing,
+)
+from .exports import record_exports
 from .mlir_passes import PassManager
+from .options import codegen_options, env_flag
+from .ownership import add_dealloc_entry_point
 
 # ## MLIR Backend Implementation
 #
@@ -27,20 +42,145 @@ from .mlir_passes import PassManager
 
 
 # _GlobalDebug.flag = True
-_DEBUG = True
+_logger = logging.getLogger(__name__)
+
+
+# A context created ahead of time by `prepare_context()`
+_spare_context: ir.Context | None = None
+_spare_context_lock = threading.Lock()
+
+
+def _new_context() -> ir.Context:
+    context = ir.Context()
+    context.load_all_available_dialects()
+    return context
+
+
+def prepare_context() -> None:
+    """Create the MLIR context of the next `Backend` now.
+
+    Used by the compile server (`nbcc.server`) to take the creation of the
+    context and the loading of the dialects off the critical path of the
+    next request. A context is only used by one backend.
+    """
+    global _spare_context
+    with _spare_context_lock:
+        if _spare_context is None:
+            _spare_context = _new_context()
+
+
+def _take_context() -> ir.Context:
+    global _spare_context
+    with _spare_context_lock:
+        context, _spare_context = _spare_context, None
+    # The same state as a prepared context
+    return context if context is not None else _new_context()
+
+
+# Arithmetic of the tensor op handlers, by element type
+_FLOAT_BINOPS = {
+    "add": arith.addf,
+    "sub": arith.subf,
+    "mul": arith.mulf,
+    "div": arith.divf,
+    "max": arith.maximumf,
+    "sum": arith.addf,
+}
+_INT_BINOPS = {
+    "add": arith.addi,
+    "sub": arith.subi,
+    "mul": arith.muli,
+    "div": arith.divsi,
+    "max": arith.maxsi,
+    "sum": arith.addi,
+}
+
+
+def _arith_binop(kind: str, dtype: ir.Type):
+    if ir.FloatType.isinstance(dtype):
+        return _FLOAT_BINOPS[kind]
+    if ir.IntegerType.isinstance(dtype):
+        return _INT_BINOPS[kind]
+    raise NotImplementedError(f"{kind} on elements of type {dtype}")
+
+
+def _neutral_constant(kind: str, dtype: ir.Type) -> ir.Value:
+    """Initial value of a "max" or "sum" reduction over `dtype`."""
+    if ir.FloatType.isinstance(dtype):
+        value: float | int = float("-inf") if kind == "max" else 0.0
+    else:
+        width = ir.IntegerType(dtype).width
+        value = -(1 << (width - 1)) if kind == "max" else 0
+    return arith.constant(dtype, value)
 
 
 class Backend(BackendInterface):
     _tu: TranslationUnit
     _context: ir.Context
+    pass_subprocess: bool
+    """Run the pass pipelines in an `mlir-opt` subprocess instead of
+    in-process. This is slower but isolates crashes in MLIR passes.
+    Defaults to `$NBCC_PASS_SUBPROCESS`."""
+    num_threads: int
+    """Threads used by MLIR to run function passes in parallel: 0 uses
+    MLIR's thread pool, which is sized to the hardware concurrency, and 1
+    disables multithreading. The Python bindings cannot size the pool, so
+    other counts are rejected. Defaults to `$NBCC_NUM_THREADS` or 0."""
+    openmp: bool
+    """Lower `scf.parallel` loops to OpenMP so kernels run on multiple
+    cores. Defaults to `$NBCC_OPENMP`."""
+    omp_num_threads: int
+    """Thread count of the OpenMP parallel regions. 0 leaves it to the
+    OpenMP runtime, i.e. `$OMP_NUM_THREADS` or
+    `nbcc.toolchain.set_omp_num_threads()`."""
+    bare_ptr_exports: bool
+    """Add bare-pointer entry points (``_nbcc_bare_*``) to the exported
+    functions without memref results; see `nbcc.mlir_backend.bare_ptr`.
+    Defaults to `$NBCC_BARE_PTR_EXPORTS`."""
+    allocator: str
+    """Allocator of the buffers: ``"malloc"`` or ``"pool"``, the size-class
+    pool of `nbcc.runtime`, linked into the library by the toolchain.
+    Defaults to `$NBCC_ALLOCATOR` or ``"malloc"``."""
 
     Location = ir.Location
     InsertionPoint = ir.InsertionPoint
 
-    def __init__(self, tu: TranslationUnit):
+    def __init__(
+        self,
+        tu: TranslationUnit,
+        *,
+        pass_subprocess: bool | None = None,
+        num_threads: int | None = None,
+        openmp: bool | None = None,
+        omp_num_threads: int = 0,
+        bare_ptr_exports: bool | None = None,
+        allocator: str | None = None,
+    ):
         self._tu = tu
-        self._context = context = ir.Context()
-        context.enable_multithreading(False)
+        codegen = self.codegen_options(
+            openmp=openmp,
+            omp_num_threads=omp_num_threads,
+            bare_ptr_exports=bare_ptr_exports,
+            allocator=allocator,
+        )
+        self.openmp = codegen["openmp"]
+        self.omp_num_threads = codegen["omp_num_threads"]
+        self.bare_ptr_exports = codegen["bare_ptr_exports"]
+        self.allocator = codegen["allocator"]
+        if pass_subprocess is None:
+            pass_subprocess = env_flag("NBCC_PASS_SUBPROCESS")
+        self.pass_subprocess = pass_subprocess
+        if num_threads is None:
+            num_threads = int(os.environ.get("NBCC_NUM_THREADS", "0"))
+        if num_threads not in (0, 1):
+            raise ValueError(
+                f"num_threads must be 0 (all cores) or 1 (no "
+                f"multithreading), not {num_threads}: the MLIR bindings "
+                f"cannot set the size of the thread pool"
+            )
+        self.num_threads = num_threads
+        self._context = context = _take_context()
+        context.enable_multithreading(num_threads == 0)
         # context.allow_unregistered_dialects = True
         with context, ir.Location.name("Backend.__init__"):
             self.f32 = ir.F32Type.get(context=context)
@@ -55,8 +195,10 @@ class Backend(BackendInterface):
             self._none_type = ir.Type.parse("!llvm.struct<()>")
 
     @classmethod
-    def create(cls, tu: TranslationUnit) -> Backend:
-        return cls(tu)
+    def create(cls, tu: TranslationUnit, **options) -> Backend:
+        return cls(tu, **options)
+
+    codegen_options = staticmethod(codegen_options)
 
     def finalize_const_block(self, const_entry, target):
         # Use a break to jump from the constant block to the function block.
@@ -123,13 +265,14 @@ class Backend(BackendInterface):
 
         else:
             attrs = None
-        print("DEBUG:", result_types)
+        _logger.debug("DEBUG: %s", result_types)
         op = ir.Operation.create(opname, result_types, args, attributes=attrs)
-        try:
-            op.verify()
-        except Exception:
-            print(op.get_asm())
-            raise
+        if not is_release_mode():
+            try:
+                op.verify()
+            except Exception:
+                _logger.error("%s", op.get_asm())
+                raise
         if result_types:
             return op.result
 
@@ -240,6 +383,8 @@ class Backend(BackendInterface):
         )
         if is_exporting:
             fun.attributes["llvm.emit_c_interface"] = ir.UnitAttr.get()
+        if is_destination_passing(fqn.symbol_name):
+            fun.attributes[DESTINATION_PASSING_ATTR] = ir.UnitAttr.get()
 
         # Define two blocks within the function, a constant block to
         # define all the constants and a function block for the
@@ -524,7 +669,8 @@ class Backend(BackendInterface):
             [lhs, rhs] = args
             index = arith.constant(self.index_type, 0)
             dim = tensor.dim(args[0], index)
-            out = tensor.empty([dim], element_type=self.f64)
+            dtype = ir.RankedTensorType(lhs.type).element_type
+            out = tensor.empty([dim], element_type=dtype)
             return linalg.add(lhs, rhs, outs=[out])
 
         @disp.case(mlir_op_matches("linalg.add"))
@@ -574,79 +720,123 @@ class Backend(BackendInterface):
 
         @disp.case(mlir_op_matches("mlir_linalg_reduce_sum_inner_keepdims"))
         def _handle_reduce_sum_inner_keepdims(self, mlir_op: str, resty, args):
-            from mlir import ir
-            from mlir.dialects import arith, linalg, tensor
-
             [arg] = args
-            dtype = arg.type.element_type
-            c0 = arith.constant(self.index_type, 0)
-            dim = tensor.dim(arg, c0)
-            init = tensor.empty(sizes=[dim], element_type=dtype)
-            neg_inf = arith.constant(self.f64, float(0))
-            init_filled = linalg.fill(neg_inf, outs=[init])
-            max_reduce = linalg.reduce(
-                result=[init.type],
-                inputs=[arg],
-                inits=[init_filled],
-                dimensions=[1],
-            )
+            return self._broadcast_inner(self._reduce(arg, "sum", 1), arg)
 
-            body = max_reduce.owner.regions[0].blocks.append(dtype, dtype)
-            with self.InsertionPoint(body):
-                linalg.YieldOp(
-                    [arith.addf(body.arguments[0], body.arguments[1])]
-                )
+        @disp.case(mlir_op_matches("mlir_linalg_reduce_max_inner_keepdims"))
+        def _handle_reduce_max_inner_keepdims(self, mlir_op: str, resty, args):
+            [arg] = args
+            return self._broadcast_inner(self._reduce(arg, "max", 1), arg)
 
-            assert max_reduce.owner.verify()
+        # Rank-reducing reductions and broadcast-on-use binary ops. The axis
+        # is part of the op name, e.g. "mlir_linalg_reduce_max_axis1" and
+        # "mlir_linalg_sub_bcast_axis1". The reduced operand of a binary op
+        # is indexed through a projected affine map instead of being
+        # broadcast into a full-size tensor.
 
-            c1 = arith.constant(self.index_type, 1)
-            dim1 = tensor.dim(arg, c1)
-            output = tensor.empty(sizes=(dim, dim1), element_type=dtype)
-            assert output.owner.verify()
+        def mlir_op_fullmatch(pattern: re.Pattern):
+            def wrap(self, mlir_op: str, resty, args) -> bool:
+                return pattern.fullmatch(mlir_op) is not None
 
-            bc = linalg.broadcast(
-                input=max_reduce, outs=[output], dimensions=[1]
-            )
-            assert bc.verify()
-            return bc
+            return wrap
 
-        @disp.case(mlir_op_matches("mlir_linalg_reduce_max_inner_keepdims"))
-        def _handle_reduce_max_inner_keepdims(self, mlir_op: str, resty, args):
-            from mlir import ir
-            from mlir.dialects import arith, linalg, tensor
+        reduce_axis = re.compile(r"mlir_linalg_reduce_(max|sum)_axis(\d+)")
 
+        @disp.case(mlir_op_fullmatch(reduce_axis))
+        def _handle_reduce_axis(self, mlir_op: str, resty, args):
+            kind, axis = reduce_axis.fullmatch(mlir_op).groups()
             [arg] = args
-            dtype = arg.type.element_type
-            c0 = arith.constant(self.index_type, 0)
-            dim = tensor.dim(arg, c0)
-            init = tensor.empty(sizes=[dim], element_type=dtype)
-            neg_inf = arith.constant(self.f64, float("-inf"))
-            init_filled = linalg.fill(neg_inf, outs=[init])
-            max_reduce = linalg.reduce(
-                result=[init.type],
-                inputs=[arg],
-                inits=[init_filled],
-                dimensions=[1],
-            )
-
-            body = max_reduce.owner.regions[0].blocks.append(dtype, dtype)
-            with self.InsertionPoint(body):
-                linalg.YieldOp(
-                    [arith.maximumf(body.arguments[0], body.arguments[1])]
-                )
+            return self._reduce(arg, kind, int(axis))
 
-            assert max_reduce.owner.verify()
+        bcast_axis = re.compile(
+            r"mlir_linalg_(add|sub|mul|div)_bcast_axis(\d+)"
+        )
 
-            c1 = arith.constant(self.index_type, 1)
-            dim1 = tensor.dim(arg, c1)
-            output = tensor.empty(sizes=(dim, dim1), element_type=dtype)
-            assert output.owner.verify()
+        @disp.case(mlir_op_fullmatch(bcast_axis))
+        def _handle_bcast_axis(self, mlir_op: str, resty, args):
+            from mlir.dialects import linalg
 
-            bc = linalg.broadcast(
-                input=max_reduce, outs=[output], dimensions=[1]
+            kind, axis_str = bcast_axis.fullmatch(mlir_op).groups()
+            axis = int(axis_str)
+            [lhs, rhs, res] = args
+            resty = ir.RankedTensorType(res.type)
+            rank = resty.rank
+            if ir.RankedTensorType(rhs.type).rank != rank - 1:
+                raise ValueError(f"{mlir_op}: rhs must have rank {rank - 1}")
+            identity = ir.AffineMap.get_identity(rank)
+            projected = ir.AffineMap.get(
+                rank,
+                0,
+                [ir.AffineDimExpr.get(d) for d in range(rank) if d != axis],
+            )
+            parallel = ir.Attribute.parse("#linalg.iterator_type<parallel>")
+            op = linalg.GenericOp(
+                result_tensors=[resty],
+                inputs=[lhs, rhs],
+                outputs=[res],
+                indexing_maps=ir.ArrayAttr.get(
+                    [
+                        ir.AffineMapAttr.get(m)
+                        for m in (identity, projected, identity)
+                    ]
+                ),
+                iterator_types=ir.ArrayAttr.get([parallel] * rank),
             )
-            assert bc.verify()
-            return bc
+            dtype = resty.element_type
+            body = op.regions[0].blocks.append(dtype, dtype, dtype)
+            with self.InsertionPoint(body):
+                binop = _arith_binop(kind, dtype)
+                linalg.YieldOp([binop(body.arguments[0], body.arguments[1])])
+            debug_verify(op)
+            return op.result
+
+    def _reduce(self, arg: ir.Value, kind: str, axis: int) -> ir.Value:
+        """Reduce `arg` along `axis`, dropping that dimension.
+
+        `kind` is "max" or "sum"; the element type of `arg` selects the
+        arithmetic.
+        """
+        from mlir.dialects import linalg, tensor
+
+        argty = ir.RankedTensorType(arg.type)
+        dtype = argty.element_type
+        if not 0 <= axis < argty.rank:
+            raise ValueError(f"reduction axis {axis} out of range for {argty}")
+        sizes = [
+            tensor.dim(arg, arith.constant(self.index_type, d))
+            for d in range(argty.rank)
+            if d != axis
+        ]
+        init = tensor.empty(sizes=sizes, element_type=dtype)
+        init_filled = linalg.fill(_neutral_constant(kind, dtype), outs=[init])
+        reduced = linalg.reduce(
+            result=[init.type],
+            inputs=[arg],
+            inits=[init_filled],
+            dimensions=[axis],
+        )
+        body = reduced.owner.regions[0].blocks.append(dtype, dtype)
+        with self.InsertionPoint(body):
+            combine = _arith_binop(kind, dtype)
+            linalg.YieldOp([combine(body.arguments[0], body.arguments[1])])
+        debug_verify(reduced.owner)
+        return reduced
+
+    def _broadcast_inner(self, reduced: ir.Value, like: ir.Value) -> ir.Value:
+        """Broadcast a row-wise reduction back to the 2D shape of `like`."""
+        from mlir.dialects import linalg, tensor
+
+        dtype = ir.RankedTensorType(like.type).element_type
+        c0 = arith.constant(self.index_type, 0)
+        c1 = arith.constant(self.index_type, 1)
+        output = tensor.empty(
+            sizes=(tensor.dim(like, c0), tensor.dim(like, c1)),
+            element_type=dtype,
+        )
+        debug_verify(output.owner)
+        bc = linalg.broadcast(input=reduced, outs=[output], dimensions=[1])
+        debug_verify(bc)
+        return bc
 
     def get_ll_type(self, expr: ase.SExpr, mdmap: MDMap) -> ir.Type:
         mds = mdmap.lookup_typeinfo(expr)
@@ -660,15 +850,18 @@ class Backend(BackendInterface):
         with self.context:
             return ir.Module.create(loc=ir.Location.name(module_name))
 
-    def _make_pass_pipeline(self, *passes, with_subprocess=True):
-        return PassManager(passes, with_subprocess=with_subprocess)
+    def _make_pass_pipeline(
+        self, *passes, with_subprocess=None, name="PassManager.run"
+    ):
+        if with_subprocess is None:
+            with_subprocess = self.pass_subprocess
+        return PassManager(passes, with_subprocess=with_subprocess, name=name)
 
-    def run_passes(
+    def run_transforms(
         self, module: ir.Module, transforms: dict[str, Sequence[str]]
     ) -> ir.Module:
-        """MLIR Pass Pipeline
-
-        Apply MLIR passes for optimization and lowering to LLVM IR.
+        """Phases 1 and 2 of `run_passes()`: inline, then apply to each
+        function of `transforms` its transform sequences.
         """
         from . import mlir_passes as mp
 
@@ -678,12 +871,30 @@ class Backend(BackendInterface):
         module = self._make_pass_pipeline(
             mp.Canonicalize(),
             mp.Inline(),
-        ).run(module.operation)
+            name="Phase 1",
+        ).run(module)
 
-        print("After Phase 1")
+        _logger.debug("After Phase 1")
+
+        # After inlining, so that the results of the callees are seen
+        with stage("destination_passing"):
+            convert_to_destination_passing(module)
 
         for fname, pass_seq in transforms.items():
-            self._run_per_function_transform(module, fname, pass_seq)
+            with stage("Phase 2 (transform)", "passes", fn=fname):
+                self._run_per_function_transform(module, fname, pass_seq)
+        return module
+
+    def run_passes(
+        self, module: ir.Module, transforms: dict[str, Sequence[str]]
+    ) -> ir.Module:
+        """MLIR Pass Pipeline
+
+        Apply MLIR passes for optimization and lowering to LLVM IR.
+        """
+        from . import mlir_passes as mp
+
+        module = self.run_transforms(module, transforms)
 
         module = self._make_pass_pipeline(
             mp.Canonicalize(),
@@ -696,8 +907,9 @@ class Backend(BackendInterface):
             mp.Canonicalize(),
             mp.FoldTensorSubsetOps(),  # folds tensor-slice into vector-transfer
             mp.Canonicalize(),
-        ).run(module.operation)
-        print("After Phase 3 (cleanup)")
+            name="Phase 3 (cleanup)",
+        ).run(module)
+        _logger.debug("After Phase 3 (cleanup)")
 
         module = self._make_pass_pipeline(
             mp.EliminateEmptyTensors(),
@@ -707,9 +919,10 @@ class Backend(BackendInterface):
             mp.ConvertVectorToSCF(),
             mp.Canonicalize(),
             mp.CSE(),
-        ).run(module.operation)
+            name="Phase 4 (bufferize)",
+        ).run(module)
 
-        print("After Phase 4 (bufferize)")
+        _logger.debug("After Phase 4 (bufferize)")
 
         module = self._make_pass_pipeline(
             # Affine passes goes after Bufferize
@@ -723,6 +936,7 @@ class Backend(BackendInterface):
             mp.AffineSimplifyStructures(),
             mp.AffineLoopFusion(mode="greedy", maximal=1),
             # mp.ConvertLinalgToParallelLoops(),
+            *self._parallelize_passes(),
             mp.LowerAffine(),
             mp.Canonicalize(),
             mp.PromoteBuffersToStack(),
@@ -732,19 +946,26 @@ class Backend(BackendInterface):
             # The CSE and canonicalize take care of the reminding redundant memref ops
             mp.CSE(),
             mp.Canonicalize(),
-        ).run(module.operation)
+            name="Phase 4.1 (SCF ops)",
+        ).run(module)
 
-        print("After Phase 4.1 (SCF ops)")
+        _logger.debug("After Phase 4.1 (SCF ops)")
 
         module = self._make_pass_pipeline(
             mp.ScfForLoopCanonicalization(),
             mp.ScfForLoopRangeFolding(),
+            # scf-forall-to-parallel, e.g. the row loops of the fuse_reduce
+            # transform
             mp.ScfForLoopToParallel(),
             mp.ScfParallelLoopFusion(),
             mp.Canonicalize(),
-        ).run(module.operation)
+            name="Phase 5 (prelower)",
+        ).run(module)
 
-        print("After Phase 5 (prelower)")
+        _logger.debug("After Phase 5 (prelower)")
+
+        # The signatures are lost in the lowering to LLVM
+        record_exports(module)
 
         module = self._make_pass_pipeline(
             mp.OwnershipBasedBufferDeallocation(),
@@ -753,18 +974,60 @@ class Backend(BackendInterface):
             mp.ConvertBufferizationToMemRef(),
             # Lowering
             mp.Canonicalize(),
+            *self._openmp_passes(),
             mp.ConvertSCFToCF(),
             mp.ConvertVectorToLLVM(enable_arm_neon=True),
-            mp.FinalizeMemRefToLLVM(),
+            mp.FinalizeMemRefToLLVM(
+                use_generic_functions=self.allocator == "pool"
+            ),
+            # libm has no f16/bf16 functions; compute those in f32
+            mp.MathExtendToSupportedTypes(),
             mp.ConvertMathToLibM(),
             mp.ConvertFuncToLLVM(),
             mp.ConvertIndexToLLVM(),
             mp.ConvertArithToLLVM(),
             mp.ConvertCFToLLVM(),
+            *([mp.ConvertOpenMPToLLVM()] if self.openmp else []),
             mp.ReconileUnrealizedCasts(),
-        ).run(module.operation)
+            name="Phase 6 (lower to LLVM)",
+        ).run(module)
+
+        add_dealloc_entry_point(
+            module, FREE_SYMBOL if self.allocator == "pool" else "free"
+        )
+        if self.bare_ptr_exports:
+            with stage("bare_ptr_wrappers"):
+                add_bare_ptr_wrappers(module)
         return module
 
+    def _parallelize_passes(self) -> list:
+        """Passes turning the affine loops without loop-carried
+        dependences into `affine.parallel`, which `LowerAffine` lowers to
+        the `scf.parallel` of `_openmp_passes()`.
+
+        Only the outermost parallel loop of a nest is parallelized: a
+        nested OpenMP region would run on a single thread anyway.
+        """
+        from . import mlir_passes as mp
+
+        if not self.openmp:
+            return []
+        return [mp.AffineParallelize(max_nested=1)]
+
+    def _openmp_passes(self) -> list:
+        """Passes turning `scf.parallel` into OpenMP worksharing loops.
+
+        Must run before `ConvertSCFToCF`, which would otherwise lower the
+        parallel loops to sequential ones.
+        """
+        from . import mlir_passes as mp
+
+        if not self.openmp:
+            return []
+        if self.omp_num_threads:
+            return [mp.ConvertSCFToOpenMP(num_threads=self.omp_num_threads)]
+        return [mp.ConvertSCFToOpenMP()]
+
     def _add_noinline_to_callsite(self, module: ir.Module, fname: str):
         def iterate_funcop(module: ir.Module):
             for blk in module.body.region.blocks:
@@ -804,5 +1067,5 @@ class Backend(BackendInterface):
 
             transform(fn_op.operation)
 
-            print(f"Transformed: {fname} after {pass_name}")
-            print(fn_op.operation.get_asm())
+            _logger.debug("Transformed: %s after %s", fname, pass_name)
+            _logger.debug("%s", Lazy(fn_op.operation.get_asm))
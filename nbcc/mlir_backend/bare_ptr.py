@@ -0,0 +1,147 @@
+"""
+Bare-pointer entry points of the exported functions.
+
+The C interface (`_mlir_ciface_*`) passes every memref as a pointer to a
+ranked memref descriptor. For contiguous arguments the descriptor is
+redundant, so with `Backend.bare_ptr_exports` every exported function
+without memref results (e.g. the ``export_into_*`` functions) also gets a
+thin wrapper taking each memref as its data pointer followed by its sizes:
+
+    void _nbcc_bare_<symbol>(double *a, int64_t a0, int64_t a1,
+                             double *out, int64_t out0, int64_t out1);
+
+The wrapper builds the descriptors of C-contiguous memrefs (offset 0,
+row-major strides) and calls the function; LLVM inlines the call. Static
+sizes are taken from the signature and the passed sizes are ignored.
+
+The wrappers are added to the LLVM-dialect module, next to the C interface,
+using the signatures recorded by `nbcc.mlir_backend.exports`.
+"""
+
+from __future__ import annotations
+
+import mlir.ir as ir
+
+from .exports import BARE_PTR_PREFIX, EXPORTS_ATTR, is_contiguous_memref
+
+
+def bare_ptr_symbol(symbol: str) -> str:
+    return BARE_PTR_PREFIX + symbol
+
+
+def add_bare_ptr_wrappers(module: ir.Module) -> list[str]:
+    """Add the wrappers to the LLVM-dialect `module`.
+
+    Returns:
+        The symbols of the wrapped functions.
+    """
+    attrs = module.operation.attributes
+    if EXPORTS_ATTR not in attrs:
+        return []
+    recorded = ir.DictAttr(attrs[EXPORTS_ATTR])
+    sources = []
+    wrapped = []
+    for i in range(len(recorded)):
+        named = recorded[i]
+        fnty = ir.FunctionType(ir.TypeAttr(named.attr).value)
+        source = _wrapper_source(named.name, fnty)
+        if source is not None:
+            sources.append(source)
+            wrapped.append(named.name)
+    if sources:
+        wrappers = ir.Module.parse("\n".join(sources), context=module.context)
+        for op in list(wrappers.body.operations):
+            # Skip the declarations of the wrapped functions
+            name = ir.StringAttr(op.attributes["sym_name"]).value
+            if name.startswith(BARE_PTR_PREFIX):
+                module.body.append(op)
+    return wrapped
+
+
+def _wrapper_source(symbol: str, fnty: ir.FunctionType) -> str | None:
+    results = list(fnty.results)
+    if len(results) > 1 or any(_is_memref(ty) for ty in results):
+        return None
+    if not all(
+        is_contiguous_memref(ty) or _is_scalar(ty) for ty in fnty.inputs
+    ):
+        return None
+
+    params: list[str] = []
+    body: list[str] = [
+        "%c0 = llvm.mlir.constant(0 : i64) : i64",
+        "%c1 = llvm.mlir.constant(1 : i64) : i64",
+    ]
+    call_args: list[str] = []
+    call_types: list[str] = []
+    for i, ty in enumerate(fnty.inputs):
+        if not _is_memref(ty):
+            llty = _llvm_scalar(ty)
+            params.append(f"%arg{i}: {llty}")
+            call_args.append(f"%arg{i}")
+            call_types.append(llty)
+            continue
+        memref_ty = ir.MemRefType(ty)
+        rank = memref_ty.rank
+        params.append(f"%arg{i}: !llvm.ptr")
+        sizes = []
+        for d, extent in enumerate(memref_ty.shape):
+            params.append(f"%arg{i}_{d}: i64")
+            if memref_ty.is_dynamic_dim(d):
+                sizes.append(f"%arg{i}_{d}")
+            else:
+                name = f"%arg{i}_{d}_static"
+                body.append(
+                    f"{name} = llvm.mlir.constant({extent} : i64) : i64"
+                )
+                sizes.append(name)
+        # Row-major strides of a contiguous memref
+        strides = ["%c1"] * rank
+        for d in reversed(range(rank - 1)):
+            strides[d] = f"%arg{i}_{d}_stride"
+            body.append(
+                f"{strides[d]} = llvm.mul {strides[d + 1]}, {sizes[d + 1]} : i64"
+            )
+        call_args += [f"%arg{i}", f"%arg{i}", "%c0", *sizes, *strides]
+        call_types += ["!llvm.ptr", "!llvm.ptr", "i64"] + ["i64"] * (2 * rank)
+
+    args = ", ".join(call_args)
+    types = ", ".join(call_types)
+    if results:
+        ret_type = _llvm_scalar(results[0])
+        body.append(
+            f'%r = llvm.call @"{symbol}"({args}) : ({types}) -> {ret_type}'
+        )
+        body.append(f"llvm.return %r : {ret_type}")
+        signature = f"({', '.join(params)}) -> {ret_type}"
+        callee = f"({types}) -> {ret_type}"
+    else:
+        body.append(f'llvm.call @"{symbol}"({args}) : ({types}) -> ()')
+        body.append("llvm.return")
+        signature = f"({', '.join(params)})"
+        callee = f"({types})"
+    lines = "\n  ".join(body)
+    # The declaration of the callee makes the snippet verify on its own
+    return (
+        f'llvm.func @"{symbol}"{callee}\n'
+        f'llvm.func @"{bare_ptr_symbol(symbol)}"{signature} {{\n'
+        f"  {lines}\n"
+        "}"
+    )
+
+
+def _is_memref(ty: ir.Type) -> bool:
+    return ir.MemRefType.isinstance(ty)
+
+
+def _is_scalar(ty: ir.Type) -> bool:
+    return (
+        ir.IntegerType.isinstance(ty)
+        or ir.FloatType.isinstance(ty)
+        or ir.IndexType.isinstance(ty)
+    )
+
+
+def _llvm_scalar(ty: ir.Type) -> str:
+    # index is lowered to i64
+    return "i64" if ir.IndexType.isinstance(ty) else str(ty)
@@ -0,0 +1,133 @@
+"""
+Destination-passing calling convention for exported functions.
+
+An exported function returning memrefs allocates its results inside the
+kernel, and the caller owns (and must free) the returned buffers. Exported
+functions named ``export_into_*`` use destination passing instead: every
+memref result becomes a trailing argument that the caller preallocates, and
+the function returns nothing.
+
+    def export_into_softmax(a: MemRefF64) -> MemRefF64: ...
+
+is compiled as if it were
+
+    func.func @...export_into_softmax(%a: memref<?x?xf64>,
+                                      %out: memref<?x?xf64>)
+
+Each returned ``bufferization.to_buffer %t`` is replaced with
+
+    bufferization.materialize_in_destination %t in restrict writable %out
+
+so that empty-tensor elimination and one-shot bufferization write the
+result straight into `%out`, with no allocation on the call path. Other
+returned memrefs are copied into the destination.
+
+The caller must pass output buffers of the result shape; this is not
+checked at runtime.
+"""
+
+from __future__ import annotations
+
+import mlir.dialects.func as func
+import mlir.ir as ir
+from mlir.dialects import bufferization, memref
+
+DESTINATION_PASSING_ATTR = "nbcc.destination_passing"
+"""Unit attribute marking the functions to convert."""
+
+DESTINATION_PASSING_PREFIX = "export_into_"
+
+
+def is_destination_passing(symbol_name: str) -> bool:
+    """True for the SPy names of destination-passing exports."""
+    return symbol_name.startswith(DESTINATION_PASSING_PREFIX)
+
+
+def convert_to_destination_passing(module: ir.Module) -> list[str]:
+    """Convert the marked functions of `module` in place.
+
+    Must run before bufferization.
+
+    Returns:
+        The symbol names of the converted functions.
+    """
+    converted = []
+    for op in module.body.operations:
+        if not isinstance(op, func.FuncOp):
+            continue
+        if DESTINATION_PASSING_ATTR not in op.attributes:
+            continue
+        _check_not_called(module, op.name.value)
+        with module.context, ir.Location.name("destination_passing"):
+            _convert_function(op)
+        converted.append(op.name.value)
+    return converted
+
+
+def _convert_function(fn: func.FuncOp) -> None:
+    fnty = fn.type
+    results = list(fnty.results)
+    for ty in results:
+        if not ir.MemRefType.isinstance(ty):
+            raise NotImplementedError(
+                f"{fn.name.value}: cannot pass a {ty} result by destination"
+            )
+    entry = fn.body.blocks[0]
+    loc = ir.Location.unknown()
+    outs = [entry.add_argument(ty, loc) for ty in results]
+
+    returns = [
+        op
+        for block in fn.body.blocks
+        for op in block.operations
+        if isinstance(op, func.ReturnOp)
+    ]
+    for ret in returns:
+        with ir.InsertionPoint(ret):
+            for value, out in zip(ret.operands, outs):
+                _store_into(value, out)
+            func.ReturnOp([])
+        ret.erase()
+
+    fn.attributes["function_type"] = ir.TypeAttr.get(
+        ir.FunctionType.get(list(fnty.inputs) + results, [])
+    )
+    del fn.attributes[DESTINATION_PASSING_ATTR]
+
+
+def _store_into(value: ir.Value, out: ir.Value) -> None:
+    if (
+        ir.OpResult.isinstance(value)
+        and value.owner.operation.name == "bufferization.to_buffer"
+    ):
+        [tensor_value] = value.owner.operation.operands
+        bufferization.MaterializeInDestinationOp(
+            None, tensor_value, out, restrict=True, writable=True
+        )
+    else:
+        memref.copy(value, out)
+
+
+def _check_not_called(module: ir.Module, symbol: str) -> None:
+    # The converted function changes signature, so it must not be called
+    # from the module. Calls from other exported functions survive the
+    # inliner.
+    for op in module.body.operations:
+        if not isinstance(op, func.FuncOp):
+            continue
+        for inner in _walk(op):
+            if isinstance(inner, func.CallOp) and inner.callee.value == symbol:
+                raise NotImplementedError(
+                    f"{symbol} is called from {op.name.value}; "
+                    "destination-passing exports cannot be called "
+                    "from other functions"
+                )
+
+
+def _walk(op: ir.OpView):
+    # Including the bodies of the loops and conditionals
+    for region in op.regions:
+        for block in region.blocks:
+            for child in block.operations:
+                yield child
+                yield from _walk(child)
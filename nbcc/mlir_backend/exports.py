@@ -0,0 +1,105 @@
+"""
+Record the signatures of the exported functions in the module.
+
+The C interface of an exported function only sees pointers to memref
+descriptors once the module is lowered to the LLVM dialect. The signatures
+are therefore recorded as the module attribute ``nbcc.exports`` before the
+lowering, when the arguments are still memrefs:
+
+    module attributes {nbcc.exports = {
+        "spy_llm_tensor$exported$export_softmax" =
+            (memref<?x?xf64>) -> memref<?x?xf64>}}
+
+`read_exports()` turns them into `nbcc.bindings.ExportSpec`.
+"""
+
+from __future__ import annotations
+
+import logging
+
+import mlir.dialects.func as func
+import mlir.ir as ir
+
+from nbcc.bindings import ExportSpec, Param, is_supported_element_type
+
+_logger = logging.getLogger(__name__)
+
+EXPORTS_ATTR = "nbcc.exports"
+
+# Prefix of the bare-pointer wrappers; see `nbcc.mlir_backend.bare_ptr`
+BARE_PTR_PREFIX = "_nbcc_bare_"
+
+
+def record_exports(module: ir.Module) -> None:
+    """Record the signature of every function with a C interface."""
+    signatures = {}
+    for op in module.body.operations:
+        if not isinstance(op, func.FuncOp):
+            continue
+        if "llvm.emit_c_interface" not in op.attributes:
+            continue
+        signatures[op.name.value] = ir.TypeAttr.get(op.type)
+    with module.context:
+        module.operation.attributes[EXPORTS_ATTR] = ir.DictAttr.get(signatures)
+
+
+def read_exports(module: ir.Module) -> list[ExportSpec]:
+    """Signatures recorded by `record_exports()`.
+
+    Functions with parameters or results that the bindings cannot pass are
+    skipped.
+    """
+    attrs = module.operation.attributes
+    if EXPORTS_ATTR not in attrs:
+        return []
+    symbols = {
+        ir.StringAttr(op.attributes["sym_name"]).value
+        for op in module.body.operations
+        if "sym_name" in op.attributes
+    }
+    exports = []
+    recorded = ir.DictAttr(attrs[EXPORTS_ATTR])
+    for i in range(len(recorded)):
+        named = recorded[i]
+        fnty = ir.FunctionType(ir.TypeAttr(named.attr).value)
+        bare_symbol = BARE_PTR_PREFIX + named.name
+        try:
+            spec = ExportSpec(
+                named.name,
+                tuple(_param(ty) for ty in fnty.inputs),
+                tuple(_param(ty) for ty in fnty.results),
+                bare_symbol=bare_symbol if bare_symbol in symbols else None,
+            )
+        except NotImplementedError as e:
+            _logger.warning("no binding for %s: %s", named.name, e)
+            continue
+        if len(spec.results) > 1:
+            _logger.warning("no binding for %s: multiple results", named.name)
+            continue
+        exports.append(spec)
+    return exports
+
+
+def _param(ty: ir.Type) -> Param:
+    if ir.MemRefType.isinstance(ty):
+        memref_ty = ir.MemRefType(ty)
+        rank, element_type = memref_ty.rank, memref_ty.element_type
+        if not is_contiguous_memref(ty):
+            raise NotImplementedError(f"non-identity layout: {ty}")
+    else:
+        rank, element_type = None, ty
+    name = str(element_type)
+    if not is_supported_element_type(name):
+        raise NotImplementedError(f"unsupported type: {ty}")
+    return Param(name, rank)
+
+
+def is_contiguous_memref(ty: ir.Type) -> bool:
+    """True for memrefs with the identity (row-major) layout."""
+    if not ir.MemRefType.isinstance(ty):
+        return False
+    memref_ty = ir.MemRefType(ty)
+    layout = memref_ty.layout
+    return ir.AffineMapAttr.isinstance(layout) and ir.AffineMapAttr(
+        layout
+    ).value == ir.AffineMap.get_identity(memref_ty.rank)
@@ -1,3 +1,4 @@
+import shlex
 import subprocess as subp
 from dataclasses import dataclass, field
 from typing import Any, Callable, Sequence, Union
@@ -5,18 +6,34 @@ from typing import Any, Callable, Sequence, Union
 import mlir.passmanager as passmanager
 from mlir import ir
 
+from nbcc.profiling import stage
+
 
 def module_pipeline(*passes) -> str:
+    """Build the textual pipeline running `passes` in order on a module.
+
+    Consecutive function passes share a single `func.func(...)` nest so
+    that each function is visited once for the whole group, and MLIR can
+    run the group on different functions in parallel.
+    """
     parts = []
+    nested: list[str] = []
+
+    def flush_nested():
+        if nested:
+            parts.append(f"{FunctionPass.anchor}({','.join(nested)})")
+            nested.clear()
+
     for ps in passes:
         match ps:
             case ModulePass() as mp:
-                pss = mp.get_unwrapped()
+                flush_nested()
+                parts.append(mp.get_unwrapped())
             case FunctionPass() as fp:
-                pss = fp.get_wrapped()
+                nested.append(fp.get_unwrapped())
             case _:
                 raise ValueError(ps)
-        parts.append(pss)
+    flush_nested()
 
     return f"{ModulePass.anchor}({','.join(parts)})"
 
@@ -31,6 +48,10 @@ def bool_ctor(x: bool) -> str:
     return str(int(bool(x)))
 
 
+def int_ctor(x: int) -> str:
+    return str(int(x))
+
+
 def double_ctor(x: float) -> str:
     return str(x)
 
@@ -201,6 +222,7 @@ class ConvertVectorToLLVM(ModulePass):
 
 class FinalizeMemRefToLLVM(ModulePass):
     passname = "finalize-memref-to-llvm"
+    use_generic_functions = PassOption("use-generic-functions", bool_ctor)
 
 
 class ConvertArithToLLVM(ModulePass):
@@ -211,6 +233,15 @@ class ConvertSCFToCF(ModulePass):
     passname = "convert-scf-to-cf"
 
 
+class ConvertSCFToOpenMP(ModulePass):
+    passname = "convert-scf-to-openmp"
+    num_threads = PassOption("num-threads", int_ctor)
+
+
+class ConvertOpenMPToLLVM(ModulePass):
+    passname = "convert-openmp-to-llvm"
+
+
 class ConvertCFToLLVM(ModulePass):
     passname = "convert-cf-to-llvm"
 
@@ -223,6 +254,10 @@ class ConvertFuncToLLVM(ModulePass):
     passname = "convert-func-to-llvm"
 
 
+class MathExtendToSupportedTypes(ModulePass):
+    passname = "math-extend-to-supported-types"
+
+
 class ConvertMathToLibM(ModulePass):
     passname = "convert-math-to-libm"
 
@@ -271,6 +306,12 @@ class AffineScalrep(FunctionPass):
     passname = "affine-scalrep"
 
 
+class AffineParallelize(FunctionPass):
+    passname = "affine-parallelize"
+    max_nested = PassOption("max-nested", int_ctor)
+    parallel_reductions = PassOption("parallel-reductions", bool_ctor)
+
+
 class AffineLoopFusion(ModulePass):
     passname = "affine-loop-fusion"
 
@@ -295,6 +336,13 @@ class ExpandStridedMetadata(ModulePass):
 
 @dataclass
 class SubProcessOpt:
+    """Run the passes with `mlir-opt` in a subprocess.
+
+    The module is serialized to text and parsed back, which is slow for
+    large modules. Use it for crash isolation: a crashing pass does not take
+    down the compiler and the IR after each pass is kept in `last_stderr`.
+    """
+
     passes: Sequence[Pass]
     _last_stderr: str = field(default="", init=False)
 
@@ -302,19 +350,23 @@ class SubProcessOpt:
         pipeline = module_pipeline(*self.passes)
         ir_mod = mod.operation.get_asm(enable_debug_info=True)
         # run mlir-opt as a subprocess
+        cmd = [
+            "mlir-opt",
+            "-mlir-print-ir-after-all",
+            "-mlir-disable-threading",
+            f"--pass-pipeline={pipeline}",
+        ]
         proc = subp.Popen(
-            [
-                "mlir-opt",
-                "-mlir-print-ir-after-all",
-                "-mlir-disable-threading",
-                f"--pass-pipeline={pipeline}",
-            ],
+            cmd,
             stdin=subp.PIPE,
             stdout=subp.PIPE,
             stderr=subp.PIPE,
         )
         # send the MLIR module to the stdin
-        stdout, stderr = proc.communicate(input=ir_mod.encode(), timeout=10)
+        with stage("mlir-opt", "subprocess", cmd=shlex.join(cmd)):
+            stdout, stderr = proc.communicate(
+                input=ir_mod.encode(), timeout=10
+            )
         self._last_stderr = stderr.decode()
         # the optimized module is printed to stdout
         opt_ir_mod = stdout.decode()
@@ -327,17 +379,24 @@ class SubProcessOpt:
 
 @dataclass
 class InProcessOpt:
+    """Run the passes in-process directly on the given module.
+
+    With `snapshot=True`, the module is first copied with `Operation.clone()`
+    and the copy is kept in `last_snapshot`, e.g. to produce a reproducer of
+    the input when a pass fails.
+    """
+
     passes: Sequence[Pass]
+    snapshot: bool = False
+    last_snapshot: ir.Operation | None = field(default=None, init=False)
 
     def run(self, mod: ir.Module) -> ir.Module:
         pipeline = module_pipeline(*self.passes)
-        # clone the module
-        ir_mod = mod.operation.get_asm(enable_debug_info=True)
-        cloned_mod = ir.Module.parse(ir_mod, context=mod.context)
-        # run the passes
+        if self.snapshot:
+            self.last_snapshot = mod.operation.clone()
         pm = passmanager.PassManager.parse(pipeline, context=mod.context)
-        pm.run(cloned_mod)
-        return cloned_mod
+        pm.run(mod.operation)
+        return mod
 
 
 class PassManager:
@@ -345,22 +404,32 @@ class PassManager:
     Note:
     - `get_log()` is only available when this class is initialized with
       `with_subprocess=True`.
+    - Without subprocess, `run()` modifies the module in place.
     """
 
     _opt: Union[SubProcessOpt, InProcessOpt]
 
-    def __init__(self, passes: Sequence[Pass], with_subprocess: bool):
+    def __init__(
+        self,
+        passes: Sequence[Pass],
+        with_subprocess: bool = False,
+        name: str = "PassManager.run",
+        snapshot: bool = False,
+    ):
         self._with_subprocess = with_subprocess
+        self.name = name
         if with_subprocess:
             self._opt = SubProcessOpt(passes)
         else:
-            self._opt = InProcessOpt(passes)
+            self._opt = InProcessOpt(passes, snapshot=snapshot)
 
     def run(self, mod: ir.Module) -> ir.Module:
         """
-        Returns a optimized clone of `mod`
+        Returns the optimized module. This is `mod` itself when running
+        in-process and a new module when running in a subprocess.
         """
-        return self._opt.run(mod)
+        with stage(self.name, "passes"):
+            return self._opt.run(mod)
 
     def get_log(self) -> str:
         if self._with_subprocess:
@@ -368,3 +437,9 @@ class PassManager:
             return self._opt.last_stderr
         else:
             return ""
+
+    def get_snapshot(self) -> ir.Operation | None:
+        """The module as it was before the last in-process `run()`."""
+        if isinstance(self._opt, InProcessOpt):
+            return self._opt.last_snapshot
+        return None
@@ -0,0 +1,51 @@
+"""
+Options of the MLIR backend that change the generated code.
+
+Kept free of MLIR imports: the artifact cache key is computed from them
+before the compiler is loaded, so a cache hit does not import MLIR.
+"""
+
+from __future__ import annotations
+
+import os
+from typing import Any
+
+# Qualified name of `Backend`, part of the cache key
+BACKEND_NAME = "nbcc.mlir_backend.backend.Backend"
+
+# See `Backend.allocator`
+ALLOCATORS = ("malloc", "pool")
+
+
+def env_flag(name: str) -> bool:
+    return os.environ.get(name, "0") not in ("", "0")
+
+
+def codegen_options(
+    *,
+    openmp: bool | None = None,
+    omp_num_threads: int = 0,
+    bare_ptr_exports: bool | None = None,
+    allocator: str | None = None,
+    **_,
+) -> dict[str, Any]:
+    """The options of `Backend.create()` that change the generated code,
+    with their defaults resolved. Used for the artifact cache key.
+    """
+    if openmp is None:
+        openmp = env_flag("NBCC_OPENMP")
+    if bare_ptr_exports is None:
+        bare_ptr_exports = env_flag("NBCC_BARE_PTR_EXPORTS")
+    if allocator is None:
+        allocator = os.environ.get("NBCC_ALLOCATOR") or "malloc"
+    if allocator not in ALLOCATORS:
+        raise ValueError(
+            f"unknown allocator {allocator!r}; expected one of"
+            f" {', '.join(ALLOCATORS)}"
+        )
+    return {
+        "openmp": openmp,
+        "omp_num_threads": omp_num_threads if openmp else 0,
+        "bare_ptr_exports": bare_ptr_exports,
+        "allocator": allocator,
+    }
@@ -0,0 +1,53 @@
+"""
+Deallocation entry point of the compiled libraries.
+
+Memrefs returned by exported functions are owned by the caller: the
+ownership-based buffer deallocation copies any buffer the function does
+not own before returning it. The caller releases a result by passing its
+`allocated` pointer to
+
+    void _nbcc_dealloc(void *allocated);
+
+which calls the same function the generated code uses to free buffers, so
+the result is released by the allocator that created it, e.g. the one of
+the shared library rather than the one of the host process.
+`nbcc.bindings.take_memref()` wraps a result as a NumPy array that calls it
+when collected.
+"""
+
+from __future__ import annotations
+
+import mlir.ir as ir
+
+from nbcc.bindings import DEALLOC_SYMBOL
+
+
+def add_dealloc_entry_point(
+    module: ir.Module, free_symbol: str = "free"
+) -> None:
+    """Add `_nbcc_dealloc` to the LLVM-dialect `module`.
+
+    Args:
+        free_symbol: The deallocation function used by the lowering of
+            `memref.dealloc`.
+    """
+    symbols = {
+        ir.StringAttr(op.attributes["sym_name"]).value
+        for op in module.body.operations
+        if "sym_name" in op.attributes
+    }
+    if DEALLOC_SYMBOL in symbols:
+        return
+    source = [
+        f'llvm.func @"{free_symbol}"(!llvm.ptr)',
+        f'llvm.func @"{DEALLOC_SYMBOL}"(%arg0: !llvm.ptr) {{',
+        f'  llvm.call @"{free_symbol}"(%arg0) : (!llvm.ptr) -> ()',
+        "  llvm.return",
+        "}",
+    ]
+    snippet = ir.Module.parse("\n".join(source), context=module.context)
+    for op in list(snippet.body.operations):
+        name = ir.StringAttr(op.attributes["sym_name"]).value
+        # Declare the free function unless the module already does
+        if name == DEALLOC_SYMBOL or name not in symbols:
+            module.body.append(op)
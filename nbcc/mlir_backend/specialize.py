@@ -0,0 +1,119 @@
+"""
+Static-shape specialization of exported functions.
+
+The exported kernels take `memref<?x?xf64>` arguments, so every loop bound
+is dynamic. `specialize_shapes()` pins the argument shapes of one function
+before the backend pass pipeline runs:
+
+    %s = memref.cast %arg : memref<?x?xf64> to memref<700x2000xf64>
+    %d = memref.cast %s : memref<700x2000xf64> to memref<?x?xf64>
+
+and replaces the uses of `%arg` with `%d`. The calling convention is
+unchanged, but canonicalization folds `memref.dim`/`tensor.dim` through the
+casts to constants and the static shapes propagate to the loop bounds.
+
+The caller must guarantee that the arguments have the given shapes; this is
+not checked at runtime.
+"""
+
+from __future__ import annotations
+
+from typing import Sequence
+
+import mlir.dialects.func as func
+import mlir.ir as ir
+from mlir.dialects import memref, tensor
+
+Shape = tuple[int, ...]
+
+
+def find_function(module: ir.Module, name: str) -> func.FuncOp:
+    """Find a function by symbol name, or by SPy name for exported
+    functions (e.g. ``"export_softmax"``).
+    """
+    for op in module.body.operations:
+        if not isinstance(op, func.FuncOp):
+            continue
+        sym_name = op.name.value
+        if sym_name == name or sym_name.endswith(f"${name}"):
+            return op
+    raise KeyError(f"no function {name!r} in module")
+
+
+def clone_module(module: ir.Module) -> ir.Module:
+    """Copy `module` so that it can be specialized and finished separately.
+
+    The backend pass pipelines modify the module in place.
+    """
+    # A clone of the module operation itself is not an `ir.Module`, which
+    # the execution engine requires; clone its body into a new one instead.
+    with module.context, module.operation.location:
+        clone = ir.Module.create()
+        for attr in module.operation.attributes:
+            clone.operation.attributes[attr.name] = attr.attr
+        with ir.InsertionPoint(clone.body):
+            for op in module.body.operations:
+                op.operation.clone()
+    return clone
+
+
+def specialize_shapes(
+    module: ir.Module, name: str, shapes: Sequence[Shape | None]
+) -> func.FuncOp:
+    """Specialize function `name` for arguments of the given shapes.
+
+    Args:
+        module: Module returned by `nbcc.compiler.lower_to_mlir`, before the
+            pass pipeline.
+        name: See `find_function()`.
+        shapes: Static shape per argument; None leaves the argument
+            unchanged. Only ranked memref and tensor arguments can be
+            specialized.
+
+    Returns:
+        The specialized function.
+    """
+    fn = find_function(module, name)
+    entry = fn.body.blocks[0]
+    if len(shapes) != len(entry.arguments):
+        raise ValueError(
+            f"{name}: expected {len(entry.arguments)} shapes,"
+            f" got {len(shapes)}"
+        )
+    with module.context, ir.Location.name("specialize_shapes"):
+        for arg, shape in zip(entry.arguments, shapes):
+            if shape is None:
+                continue
+            uses = [(use.owner, use.operand_number) for use in arg.uses]
+            with ir.InsertionPoint.at_block_begin(entry):
+                dynamic = _cast_to_static_and_back(arg, tuple(shape))
+            for owner, index in uses:
+                owner.operands[index] = dynamic
+        fn.attributes["nbcc.specialized_shapes"] = ir.StringAttr.get(
+            repr(tuple(shapes))
+        )
+    return fn
+
+
+def _cast_to_static_and_back(arg: ir.Value, shape: Shape) -> ir.Value:
+    if ir.MemRefType.isinstance(arg.type):
+        ty = ir.MemRefType(arg.type)
+        _check_rank(ty, shape)
+        static_ty = ir.MemRefType.get(
+            shape,
+            ty.element_type,
+            layout=ty.layout,
+            memory_space=ty.memory_space,
+        )
+        return memref.cast(ty, memref.cast(static_ty, arg))
+    if ir.RankedTensorType.isinstance(arg.type):
+        ty = ir.RankedTensorType(arg.type)
+        _check_rank(ty, shape)
+        static_ty = ir.RankedTensorType.get(shape, ty.element_type)
+        return tensor.cast(ty, tensor.cast(static_ty, arg))
+    raise TypeError(f"cannot specialize the shape of {arg.type}")
+
+
+def _check_rank(ty: ir.ShapedType, shape: Shape) -> None:
+    if ty.rank != len(shape):
+        raise ValueError(f"shape {shape} does not match {ty}")
@@ -1,33 +1,35 @@
-// This is trying to implement fusion for binop(A, broadcast(reduce(A)))
-// However, the transformed loop is not fusing the binop and reduce.
+// Row-wise fusion of binop(A, broadcast(reduce(A))) chains, e.g. softmax:
+//
+//   %max = reduce_max(A)                  // fill + linalg.reduce
+//   %e   = exp(A - broadcast(%max))       // linalg.broadcast, sub, exp
+//   %sum = reduce_sum(%e)                 // fill + linalg.reduce
+//   out  = %e / broadcast(%sum)           // linalg.broadcast, div
+//
+// The final elementwise op is tiled along the rows and every producer is
+// fused into the row loop, so each row is read from memory once and the
+// reduced and broadcast values only exist for the current row. The
+// elementwise ops in the loop body are fused further by
+// LinalgFuseElementwiseOps in Phase 3.
 
 module attributes {transform.with_named_sequence} {
   transform.named_sequence @__transform_main(%input: !transform.any_op) {
-    // First find linalg.sub
-    %reduce_ops = transform.structured.match ops{["linalg.reduce"]} in %input : (!transform.any_op) -> !transform.any_op
-    %broadcast_ops = transform.structured.match ops{["linalg.broadcast"]} in %input : (!transform.any_op) -> !transform.any_op
-    %sub_ops = transform.structured.match ops{["linalg.sub"]} in %input : (!transform.any_op) -> !transform.any_op
-
-    // transform.print %reduce_ops : !transform.any_op
-    // transform.print %broadcast_ops : !transform.any_op
-    // transform.print %sub_ops : !transform.any_op
-
-    %red1, %red2 = transform.split_handle %reduce_ops : (!transform.any_op) -> (!transform.any_op, !transform.any_op)
-    %bc1, %bc2 = transform.split_handle %broadcast_ops : (!transform.any_op) -> (!transform.any_op, !transform.any_op)
-    %sub1 = transform.split_handle %sub_ops : (!transform.any_op) -> !transform.any_op
-
-
-    // transform.print %red1 : !transform.any_op
-    // transform.print %bc1 : !transform.any_op
-    // transform.print %sub1 : !transform.any_op
-
-    %tiled_op, %forall_op = transform.structured.tile_using_forall %sub1 tile_sizes [1, 0] : (!transform.any_op) -> (!transform.any_op, !transform.any_op)
-
-
-    // transform.print %forall_op : !transform.any_op
-    %fused_op2, %loop2 =  transform.structured.fuse_into_containing_op %bc1 into %forall_op : (!transform.any_op, !transform.any_op) -> (!transform.any_op, !transform.any_op)
-    transform.structured.fuse_into_containing_op %red1 into %loop2 : (!transform.any_op, !transform.any_op) -> (!transform.any_op, !transform.any_op)
-
+    // The consumer ending the chain
+    %div = transform.structured.match ops{["linalg.div"]} in %input : (!transform.any_op) -> !transform.any_op
+
+    // One row per iteration
+    %tiled_op, %forall_op = transform.structured.tile_using_forall %div tile_sizes [1, 0] : (!transform.any_op) -> (!transform.any_op, !transform.any_op)
+
+    // Fuse the producers into the row loop. The op picks, one at a time, a
+    // producer that has a use inside the loop, so the order of the handle
+    // does not matter.
+    %producers = transform.structured.match ops{["linalg.fill", "linalg.reduce", "linalg.broadcast", "linalg.exp", "linalg.sub"]} in %input : (!transform.any_op) -> !transform.any_op
+    %fused, %loop = transform.structured.fuse_into_containing_op %producers into %forall_op : (!transform.any_op, !transform.any_op) -> (!transform.any_op, !transform.any_op)
+
+    // Remove the unfused producers and fold the row slices of tensor.empty
+    transform.apply_patterns to %input {
+      transform.apply_patterns.canonicalization
+    } : !transform.any_op
+    transform.apply_cse to %input : !transform.any_op
 
     transform.yield
   }
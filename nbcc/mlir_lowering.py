@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import logging
 from abc import ABC, abstractmethod
 from collections import defaultdict
 from contextlib import contextmanager
@@ -19,10 +20,12 @@ from sealir.rvsdg import grammar as rg
 from sealir.rvsdg import internal_prefix
 from spy.fqn import FQN
 
-from nbcc.developer import TODO
+from nbcc.developer import TODO, Lazy, debug_verify, is_release_mode
 from nbcc.mlir_utils import decode_type_name, decode_asm_operation
 from nbcc.frontend import grammar as sg, TranslationUnit
 
+_logger = logging.getLogger(__name__)
+
 
 @dataclass(frozen=True)
 class LowerStates(ase.TraverseState):
@@ -81,7 +84,7 @@ class BackendInterface(ABC):
 
     @classmethod
     @abstractmethod
-    def create(cls, tu: TranslationUnit) -> BackendInterface:
+    def create(cls, tu: TranslationUnit, **options) -> BackendInterface:
         raise NotImplementedError
 
     @abstractmethod
@@ -356,8 +359,9 @@ class Lowering:
         with context, loc:
             self.be.finalize_const_block(constant_entry, func_block)
 
-        print(fun.operation.get_asm())
-        fun.operation.verify()
+        _logger.debug("%s", Lazy(fun.operation.get_asm))
+        if not is_release_mode():
+            fun.operation.verify()
         return fun
 
     def _cast_return_value(self, val):
@@ -609,7 +613,7 @@ class Lowering:
                     )
                     owner = getattr(res, "owner", None)
                     if owner is not None:
-                        assert owner.verify()
+                        debug_verify(owner)
                     return [io_val, res]
                     # self.declare_builtins(c_name, argtys, [resty])
                 elif callee_fqn_obj.namespace.fullname == "mlir::asm":
@@ -0,0 +1,278 @@
+"""
+Compile-time and memory profiling of the compiler stages.
+
+Stages are recorded into the active `CompileStats` with the `stage()`
+context manager. Recording is a no-op when no statistics are being
+collected, so the instrumentation can stay on the compile path:
+
+    stats = CompileStats()
+    with collect(stats):
+        module = compile_to_mlir("llm_tensor.spy")
+    print(stats.format())
+    stats.write_chrome_trace("trace.json")
+
+The Chrome trace-event file can be opened in Perfetto (ui.perfetto.dev) or
+`chrome://tracing`.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import resource
+import shlex
+import subprocess as subp
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Sequence
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+@dataclass(frozen=True)
+class StageRecord:
+    """Measurements of one execution of a stage.
+
+    Times are in seconds. `start` is a `time.perf_counter()` timestamp,
+    which is system-wide on the supported platforms so records from worker
+    processes can be merged. `peak_rss` is the high-water mark in bytes of
+    the process (or of its waited-for children for subprocess stages) when
+    the stage ended.
+    """
+
+    name: str
+    category: str
+    start: float
+    wall: float
+    cpu: float
+    peak_rss: int
+    depth: int
+    pid: int
+    tid: int
+    args: dict[str, Any] = field(default_factory=dict)
+
+
+class CompileStats:
+    """Collection of `StageRecord` for a compilation."""
+
+    def __init__(self) -> None:
+        self.records: list[StageRecord] = []
+        self._depth = 0
+
+    @contextmanager
+    def stage(
+        self, name: str, category: str = "stage", **args: Any
+    ) -> Iterator[None]:
+        children = category == "subprocess"
+        who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+        ru_before = resource.getrusage(who)
+        start = time.perf_counter()
+        depth = self._depth
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            wall = time.perf_counter() - start
+            ru_after = resource.getrusage(who)
+            cpu = (ru_after.ru_utime - ru_before.ru_utime) + (
+                ru_after.ru_stime - ru_before.ru_stime
+            )
+            self.records.append(
+                StageRecord(
+                    name=name,
+                    category=category,
+                    start=start,
+                    wall=wall,
+                    cpu=cpu,
+                    peak_rss=ru_after.ru_maxrss * _MAXRSS_UNIT,
+                    depth=depth,
+                    pid=os.getpid(),
+                    tid=threading.get_ident(),
+                    args={k: str(v) for k, v in args.items()},
+                )
+            )
+
+    def extend(self, records: Iterable[StageRecord]) -> None:
+        """Add records collected elsewhere, e.g. in a worker process."""
+        self.records.extend(records)
+
+    def total(self, name: str) -> float:
+        """Total wall time in seconds of all executions of stage `name`."""
+        return sum(r.wall for r in self.records if r.name == name)
+
+    def summary(self) -> list[dict[str, Any]]:
+        """Aggregate the records by stage, in order of first execution."""
+        groups: dict[tuple[str, str], list[StageRecord]] = defaultdict(list)
+        for rec in sorted(self.records, key=lambda r: r.start):
+            groups[rec.category, rec.name].append(rec)
+        return [
+            {
+                "name": name,
+                "category": category,
+                "count": len(recs),
+                "wall": sum(r.wall for r in recs),
+                "cpu": sum(r.cpu for r in recs),
+                "peak_rss": max(r.peak_rss for r in recs),
+                "depth": min(r.depth for r in recs),
+            }
+            for (category, name), recs in groups.items()
+        ]
+
+    def format(self) -> str:
+        """Human readable report of the time spent in each stage."""
+        mib = 1024**2
+        lines = [
+            f"{'stage':<44} {'count':>5} {'wall (s)':>9} {'cpu (s)':>9}"
+            f" {'peak RSS (MiB)':>14}"
+        ]
+        for row in self.summary():
+            label = "  " * row["depth"] + row["name"]
+            if row["category"] == "subprocess":
+                label += " [subprocess]"
+            lines.append(
+                f"{label:<44} {row['count']:>5} {row['wall']:>9.3f}"
+                f" {row['cpu']:>9.3f} {row['peak_rss'] / mib:>14.1f}"
+            )
+        commands = self.commands()
+        if commands:
+            lines.append("")
+            lines.append("tool invocations:")
+            lines.extend(f"  {cmd}" for cmd in commands)
+        return "\n".join(lines)
+
+    def commands(self) -> list[str]:
+        """Command lines of the external tools, in order of execution."""
+        return [
+            r.args["cmd"]
+            for r in sorted(self.records, key=lambda r: r.start)
+            if r.category == "subprocess" and "cmd" in r.args
+        ]
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "summary": self.summary(),
+            "commands": self.commands(),
+            "records": [asdict(r) for r in self.records],
+        }
+
+    def to_chrome_trace(self) -> dict[str, Any]:
+        """Convert to the Chrome trace-event format (complete events)."""
+        t0 = min((r.start for r in self.records), default=0.0)
+        events = []
+        for rec in self.records:
+            events.append(
+                {
+                    "name": rec.name,
+                    "cat": rec.category,
+                    "ph": "X",
+                    "ts": (rec.start - t0) * 1e6,
+                    "dur": rec.wall * 1e6,
+                    "pid": rec.pid,
+                    "tid": rec.tid,
+                    "args": {
+                        **rec.args,
+                        "cpu_ms": rec.cpu * 1e3,
+                        "peak_rss_mib": rec.peak_rss / 1024**2,
+                    },
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path: str | Path) -> None:
+        with open(path, "w") as fout:
+            json.dump(self.to_chrome_trace(), fout)
+
+
+# The statistics being collected in this process, if any
+_active: CompileStats | None = None
+
+
+def active_stats() -> CompileStats | None:
+    return _active
+
+
+@contextmanager
+def collect(stats: CompileStats | None) -> Iterator[CompileStats | None]:
+    """Record the stages executed in this block into `stats`.
+
+    Passing None leaves the currently active statistics, if any, in place.
+    """
+    global _active
+    if stats is None:
+        yield _active
+        return
+    saved = _active
+    _active = stats
+    try:
+        yield stats
+    finally:
+        _active = saved
+
+
+@contextmanager
+def stage(name: str, category: str = "stage", **args: Any) -> Iterator[None]:
+    """Record a stage into the active statistics.
+
+    Args:
+        name: Name of the stage, e.g. ``"redshift"``.
+        category: ``"stage"`` for work done in this process, ``"subprocess"``
+            for an external tool. CPU time and peak RSS of subprocess stages
+            are taken from the waited-for children.
+        args: Extra information shown in the trace, e.g. the function name.
+    """
+    if _active is None:
+        yield
+        return
+    with _active.stage(name, category, **args):
+        yield
+
+
+def check_call(cmd: Sequence[str], **kwargs: Any) -> int:
+    """`subprocess.check_call` recorded as a stage named after the tool.
+
+    In a worker of the compile server, the output of the tool is written to
+    `sys.stdout` and `sys.stderr`, which are relayed to the client, rather
+    than to the file descriptors of the server.
+    """
+    with stage(os.path.basename(cmd[0]), "subprocess", cmd=shlex.join(cmd)):
+        if not _relay_output(kwargs, "stdout", "stderr"):
+            return subp.check_call(cmd, **kwargs)
+        proc = subp.run(cmd, capture_output=True, **kwargs)
+        _write(sys.stdout, proc.stdout)
+        _write(sys.stderr, proc.stderr)
+        proc.check_returncode()
+        return proc.returncode
+
+
+def check_output(cmd: Sequence[str], **kwargs: Any) -> Any:
+    """`subprocess.check_output` recorded as a stage named after the tool.
+
+    Like `check_call()`, relays the standard error of the tool in a worker
+    of the compile server.
+    """
+    with stage(os.path.basename(cmd[0]), "subprocess", cmd=shlex.join(cmd)):
+        if not _relay_output(kwargs, "stderr"):
+            return subp.check_output(cmd, **kwargs)
+        proc = subp.run(cmd, stdout=subp.PIPE, stderr=subp.PIPE, **kwargs)
+        _write(sys.stderr, proc.stderr)
+        proc.check_returncode()
+        return proc.stdout
+
+
+def _relay_output(kwargs: dict[str, Any], *streams: str) -> bool:
+    from nbcc.server import in_worker
+
+    return in_worker() and not any(name in kwargs for name in streams)
+
+
+def _write(stream: Any, data: str | bytes) -> None:
+    if isinstance(data, bytes):
+        data = data.decode(errors="replace")
+    stream.write(data)
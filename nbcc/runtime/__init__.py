@@ -0,0 +1,144 @@
+"""
+Runtime support linked into the compiled libraries.
+
+`nbcc_alloc.c` is the pool allocator used by ``Backend(allocator="pool")``
+(see its header for the design and the environment variables). It is
+compiled by the toolchain with the generated code; this module builds it and
+reads its counters from Python:
+
+    lib = CDLL("out.so")
+    reset_alloc_stats(lib)
+    softmax(A)
+    print(alloc_stats(lib).format())
+
+Like `nbcc.bindings`, this module does not depend on MLIR.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import hashlib
+import os
+import sys
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+from nbcc import profiling
+from nbcc.cache import default_cache_dir
+
+ALLOCATOR_SOURCE = Path(__file__).parent / "nbcc_alloc.c"
+
+# The generic allocation functions of `finalize-memref-to-llvm`
+ALLOC_SYMBOL = "_mlir_memref_to_llvm_alloc"
+ALIGNED_ALLOC_SYMBOL = "_mlir_memref_to_llvm_aligned_alloc"
+FREE_SYMBOL = "_mlir_memref_to_llvm_free"
+ALLOCATOR_SYMBOLS = frozenset(
+    [ALLOC_SYMBOL, ALIGNED_ALLOC_SYMBOL, FREE_SYMBOL]
+)
+
+_shlib_suffix = ".dylib" if sys.platform == "darwin" else ".so"
+
+
+@dataclass(frozen=True)
+class AllocStats:
+    """Counters of the pool allocator of a library."""
+
+    allocations: int
+    frees: int
+    pool_hits: int
+    system_allocations: int
+    system_frees: int
+    huge_page_allocations: int
+    bytes_in_use: int
+    peak_bytes_in_use: int
+    bytes_cached: int
+
+    def format(self) -> str:
+        width = max(len(f.name) for f in fields(self))
+        return "\n".join(
+            f"{f.name:<{width}}  {getattr(self, f.name)}" for f in fields(self)
+        )
+
+
+class _CAllocStats(ctypes.Structure):
+    _fields_ = [(f.name, ctypes.c_int64) for f in fields(AllocStats)]
+
+
+def _function(library: ctypes.CDLL, name: str, *argtypes: Any) -> Any:
+    try:
+        fn = getattr(library, name)
+    except AttributeError:
+        raise ValueError(
+            f"{library._name} was not built with the pool allocator"
+        ) from None
+    fn.argtypes = list(argtypes)
+    fn.restype = None
+    return fn
+
+
+def alloc_stats(library: ctypes.CDLL) -> AllocStats:
+    """Counters of the pool allocator linked into `library`.
+
+    Raises:
+        ValueError: The library was built without the pool allocator.
+    """
+    out = _CAllocStats()
+    get = _function(
+        library, "nbcc_alloc_get_stats", ctypes.POINTER(_CAllocStats)
+    )
+    get(ctypes.byref(out))
+    return AllocStats(*(getattr(out, f.name) for f in fields(AllocStats)))
+
+
+def reset_alloc_stats(library: ctypes.CDLL) -> None:
+    """Zero the counters, except for the bytes in use and cached."""
+    _function(library, "nbcc_alloc_reset_stats")()
+
+
+def trim_pool(library: ctypes.CDLL) -> None:
+    """Release the cached blocks of the pool back to the system."""
+    _function(library, "nbcc_alloc_trim")()
+
+
+def compile_allocator(
+    out_path: str | Path,
+    *,
+    shared: bool = False,
+    cc: str = "clang",
+    opt_level: int = 3,
+) -> Path:
+    """Compile the pool allocator.
+
+    Args:
+        out_path: Object file, or shared library with `shared`.
+        shared: Build a shared library exporting the allocation functions,
+            e.g. for the JIT.
+        cc: C compiler.
+    """
+    cmd = [cc, f"-O{opt_level}", "-fPIC"]
+    if shared:
+        cmd += ["-shared", "-DNBCC_ALLOC_EXPORT"]
+    else:
+        cmd.append("-c")
+    cmd += [str(ALLOCATOR_SOURCE), "-o", str(out_path)]
+    if sys.platform != "darwin":
+        cmd.append("-pthread")
+    profiling.check_call(cmd)
+    return Path(out_path)
+
+
+@lru_cache(maxsize=None)
+def allocator_shared() -> str:
+    """Path to a shared build of the pool allocator that the JIT can load,
+    stored in the nbcc cache directory."""
+    digest = hashlib.sha256(ALLOCATOR_SOURCE.read_bytes()).hexdigest()[:16]
+    outdir = default_cache_dir() / "jit"
+    outdir.mkdir(parents=True, exist_ok=True)
+    out = outdir / f"libnbcc_alloc-{digest}{_shlib_suffix}"
+    if not out.exists():
+        tmp = out.with_name(f".tmp{os.getpid()}-{out.name}")
+        compile_allocator(tmp, shared=True)
+        os.replace(tmp, out)
+    return str(out)
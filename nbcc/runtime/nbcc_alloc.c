@@ -0,0 +1,270 @@
+/*
+ * Pool allocator of the buffers of the generated code.
+ *
+ * With `Backend(allocator="pool")` the lowering of `memref.alloc` and
+ * `memref.dealloc` calls the generic allocation functions of MLIR instead of
+ * malloc and free:
+ *
+ *     void *_mlir_memref_to_llvm_alloc(size_t size);
+ *     void *_mlir_memref_to_llvm_aligned_alloc(size_t alignment, size_t size);
+ *     void _mlir_memref_to_llvm_free(void *ptr);
+ *
+ * `Toolchain.make_shared` links this file into the library. Freed blocks are
+ * kept in free lists, one per size class, and reused by the next allocation
+ * of the same class, so the temporaries of a kernel called in a loop are not
+ * returned to the system (and faulted in again) on every call. The classes
+ * are 4 per power of two, so a block wastes at most 25% of its size. Requests
+ * above MAX_CLASS_SIZE are not pooled.
+ *
+ * The pool is shared by all threads and guarded by a mutex; the kernels
+ * allocate a few large buffers per call, so the lock is not contended.
+ *
+ * Configuration, read from the environment at the first allocation:
+ *
+ *   NBCC_POOL_CACHE_LIMIT      Bytes kept in the free lists (default 256
+ *                              MiB); blocks freed beyond it are released.
+ *   NBCC_HUGE_PAGES            1 to back large blocks with huge pages:
+ *                              MAP_HUGETLB if huge pages are reserved,
+ *                              transparent huge pages otherwise.
+ *   NBCC_HUGE_PAGE_THRESHOLD   Smallest block using huge pages (default 2
+ *                              MiB).
+ *
+ * The counters are read with `nbcc_alloc_get_stats`; see `nbcc.runtime`.
+ * Only the `nbcc_alloc_*` functions are exported from the library, unless
+ * built with -DNBCC_ALLOC_EXPORT (the shared build loaded by the JIT).
+ */
+#define _GNU_SOURCE
+#include <pthread.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+
+#ifdef NBCC_ALLOC_EXPORT
+#define ALLOC_API __attribute__((visibility("default")))
+#else
+#define ALLOC_API __attribute__((visibility("hidden")))
+#endif
+#define STATS_API __attribute__((visibility("default")))
+
+/* Keep in sync with `nbcc.runtime.AllocStats` */
+typedef struct {
+    int64_t allocations;           /* calls of the alloc functions */
+    int64_t frees;                 /* calls of the free function */
+    int64_t pool_hits;             /* allocations served from the pool */
+    int64_t system_allocations;    /* blocks obtained from malloc/mmap */
+    int64_t system_frees;          /* blocks returned to free/munmap */
+    int64_t huge_page_allocations; /* system allocations using huge pages */
+    int64_t bytes_in_use;          /* block bytes held by live buffers */
+    int64_t peak_bytes_in_use;
+    int64_t bytes_cached;          /* block bytes in the free lists */
+} nbcc_alloc_stats;
+
+enum { BLOCK_MALLOC, BLOCK_MMAP };
+
+/* Placed before every buffer; 64 bytes keeps the buffers cache-line
+ * aligned. */
+typedef struct block {
+    struct block *next; /* free list link */
+    size_t size;        /* usable bytes */
+    size_t offset;      /* from the start of the allocation to the buffer */
+    size_t map_size;    /* bytes mapped, for BLOCK_MMAP */
+    int32_t cls;        /* size class, -1 for blocks not pooled */
+    int32_t kind;
+} block;
+
+#define HEADER 64
+#define MIN_CLASS_SIZE 64
+/* 256 TiB; larger requests get a block of their own */
+#define MAX_CLASS_SIZE ((size_t)1 << 48)
+/* The last class, 1 + (47 - 6) * 4 + 3, is the one of MAX_CLASS_SIZE */
+#define NUM_CLASSES 169
+#define HUGE_PAGE_SIZE (2u << 20)
+
+static block *free_lists[NUM_CLASSES];
+static nbcc_alloc_stats stats;
+static pthread_mutex_t lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_once_t config_once = PTHREAD_ONCE_INIT;
+static int64_t cache_limit = 256 << 20;
+static int huge_pages = 0;
+static size_t huge_page_threshold = HUGE_PAGE_SIZE;
+
+static int64_t env_int(const char *name, int64_t fallback) {
+    const char *value = getenv(name);
+    if (value == NULL || *value == '\0')
+        return fallback;
+    return strtoll(value, NULL, 0);
+}
+
+static void read_config(void) {
+    cache_limit = env_int("NBCC_POOL_CACHE_LIMIT", cache_limit);
+    huge_pages = env_int("NBCC_HUGE_PAGES", huge_pages) != 0;
+    huge_page_threshold =
+        (size_t)env_int("NBCC_HUGE_PAGE_THRESHOLD", huge_page_threshold);
+}
+
+/* Size class of a request: 64 bytes, then 4 classes per power of two; -1
+ * above MAX_CLASS_SIZE. */
+static int size_class(size_t size, size_t *class_size) {
+    if (size > MAX_CLASS_SIZE) {
+        *class_size = size;
+        return -1;
+    }
+    if (size <= MIN_CLASS_SIZE) {
+        *class_size = MIN_CLASS_SIZE;
+        return 0;
+    }
+    size_t n = size - 1;
+    int e = 63 - __builtin_clzll(n);
+    size_t sub = (n >> (e - 2)) & 3;
+    *class_size = (4 + sub + 1) << (e - 2);
+    return 1 + (e - 6) * 4 + (int)sub;
+}
+
+static block *system_alloc(size_t size, int cls) {
+    if (size > SIZE_MAX - HEADER - HUGE_PAGE_SIZE)
+        return NULL;
+    size_t total = HEADER + size;
+    block *b;
+    if (huge_pages && size >= huge_page_threshold) {
+        size_t map_size = (total + HUGE_PAGE_SIZE - 1) & ~(HUGE_PAGE_SIZE - 1);
+        void *p = mmap(NULL, map_size, PROT_READ | PROT_WRITE,
+                       MAP_PRIVATE | MAP_ANONYMOUS | MAP_HUGETLB, -1, 0);
+        if (p == MAP_FAILED) {
+            /* No reserved huge pages; ask for transparent ones */
+            p = mmap(NULL, map_size, PROT_READ | PROT_WRITE,
+                     MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+            if (p == MAP_FAILED)
+                return NULL;
+            madvise(p, map_size, MADV_HUGEPAGE);
+        }
+        b = p;
+        b->kind = BLOCK_MMAP;
+        b->map_size = map_size;
+        stats.huge_page_allocations++;
+    } else {
+        void *p;
+        if (posix_memalign(&p, HEADER, total) != 0)
+            return NULL;
+        b = p;
+        b->kind = BLOCK_MALLOC;
+        b->map_size = 0;
+    }
+    b->size = size;
+    b->offset = HEADER;
+    b->cls = cls;
+    b->next = NULL;
+    stats.system_allocations++;
+    return b;
+}
+
+static void system_free(block *b) {
+    stats.system_frees++;
+    if (b->kind == BLOCK_MMAP)
+        munmap(b, b->map_size);
+    else
+        free((char *)b + HEADER - b->offset);
+}
+
+static block *header_of(void *ptr) {
+    return (block *)((char *)ptr - HEADER);
+}
+
+static void note_in_use(int64_t size) {
+    stats.bytes_in_use += size;
+    if (stats.bytes_in_use > stats.peak_bytes_in_use)
+        stats.peak_bytes_in_use = stats.bytes_in_use;
+}
+
+ALLOC_API void *_mlir_memref_to_llvm_alloc(size_t size) {
+    pthread_once(&config_once, read_config);
+    size_t class_size;
+    int cls = size_class(size, &class_size);
+    pthread_mutex_lock(&lock);
+    stats.allocations++;
+    block *b = cls < 0 ? NULL : free_lists[cls];
+    if (b != NULL) {
+        free_lists[cls] = b->next;
+        stats.pool_hits++;
+        stats.bytes_cached -= b->size;
+    } else {
+        b = system_alloc(class_size, cls);
+    }
+    if (b != NULL)
+        note_in_use(b->size);
+    pthread_mutex_unlock(&lock);
+    return b == NULL ? NULL : (char *)b + HEADER;
+}
+
+ALLOC_API void *_mlir_memref_to_llvm_aligned_alloc(size_t alignment,
+                                                   size_t size) {
+    if (alignment <= HEADER)
+        return _mlir_memref_to_llvm_alloc(size);
+    /* Rare; not pooled. The header sits right before the buffer, which is
+     * `alignment` bytes into the allocation. */
+    pthread_once(&config_once, read_config);
+    void *p;
+    if (posix_memalign(&p, alignment, alignment + size) != 0)
+        return NULL;
+    char *ptr = (char *)p + alignment;
+    block *b = header_of(ptr);
+    b->size = size;
+    b->offset = alignment;
+    b->map_size = 0;
+    b->cls = -1;
+    b->kind = BLOCK_MALLOC;
+    pthread_mutex_lock(&lock);
+    stats.allocations++;
+    stats.system_allocations++;
+    note_in_use(size);
+    pthread_mutex_unlock(&lock);
+    return ptr;
+}
+
+ALLOC_API void _mlir_memref_to_llvm_free(void *ptr) {
+    if (ptr == NULL)
+        return;
+    block *b = header_of(ptr);
+    pthread_mutex_lock(&lock);
+    stats.frees++;
+    stats.bytes_in_use -= b->size;
+    if (b->cls >= 0 && stats.bytes_cached + (int64_t)b->size <= cache_limit) {
+        b->next = free_lists[b->cls];
+        free_lists[b->cls] = b;
+        stats.bytes_cached += b->size;
+    } else {
+        system_free(b);
+    }
+    pthread_mutex_unlock(&lock);
+}
+
+STATS_API void nbcc_alloc_get_stats(nbcc_alloc_stats *out) {
+    pthread_mutex_lock(&lock);
+    *out = stats;
+    pthread_mutex_unlock(&lock);
+}
+
+/* Reset the counters; the byte counts describe the current state and are
+ * kept. */
+STATS_API void nbcc_alloc_reset_stats(void) {
+    pthread_mutex_lock(&lock);
+    int64_t in_use = stats.bytes_in_use, cached = stats.bytes_cached;
+    memset(&stats, 0, sizeof(stats));
+    stats.bytes_in_use = stats.peak_bytes_in_use = in_use;
+    stats.bytes_cached = cached;
+    pthread_mutex_unlock(&lock);
+}
+
+/* Release the blocks in the free lists. */
+STATS_API void nbcc_alloc_trim(void) {
+    pthread_mutex_lock(&lock);
+    for (int i = 0; i < NUM_CLASSES; i++) {
+        while (free_lists[i] != NULL) {
+            block *b = free_lists[i];
+            free_lists[i] = b->next;
+            stats.bytes_cached -= b->size;
+            system_free(b);
+        }
+    }
+    pthread_mutex_unlock(&lock);
+}
@@ -0,0 +1,317 @@
+"""
+Persistent compile server.
+
+Every `nbcc` invocation pays for the Python startup, the imports of `mlir`,
+`egglog`, `spy` and `sealir`, a new `SPyVM` and a new MLIR context before
+doing any work. `nbcc serve` starts a daemon that pays this once: it listens
+on a Unix socket and runs the compile commands in a pool of worker processes
+that have already imported the compiler and keep their in-process caches
+(tool versions, compiler fingerprint) between requests. After each request
+a worker prepares the `SPyVM` and the MLIR context of the next one while it
+is idle; see `nbcc.frontend.frontend.prepare_vm()` and
+`nbcc.mlir_backend.backend.prepare_context()`.
+
+While a server is running, `nbcc compile|shared|mlir ...` sends its command
+line to it instead of compiling in-process (disable with `--no-server`;
+`--server` fails if no server is running). If the server fails, e.g. because
+a worker died, the client warns and compiles in-process; the server replaces
+the pool of a dead worker. The output of the command, with
+that of the external tools it runs, and its exit code are relayed by the
+client. The worker runs the command in the
+working directory and with the `NBCC_*` environment variables of the client;
+the external tools are found on the `PATH` of the server.
+
+The protocol is one JSON object per line in each direction, one request per
+connection:
+
+    {"op": "run", "argv": [...], "cwd": "...", "env": {...}}
+        -> {"exit_code": 0, "stdout": "...", "stderr": "..."}
+    {"op": "ping"}      -> {"pid": 123, "workers": 4}
+    {"op": "shutdown"}  -> {}
+
+This module only imports the compiler and the process pool in the server,
+so the client side is cheap to import.
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Sequence
+
+from nbcc.cache import default_cache_dir
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+_logger = logging.getLogger(__name__)
+
+# The commands that are sent to a running server
+SERVER_COMMANDS = frozenset(["compile", "shared", "mlir"])
+
+
+def default_socket_path() -> Path:
+    """Socket of the server; `$NBCC_SERVER_SOCKET` or ``server.sock`` in the
+    cache directory."""
+    if path := os.environ.get("NBCC_SERVER_SOCKET"):
+        return Path(path)
+    return default_cache_dir() / "server.sock"
+
+
+def default_workers() -> int:
+    return max(1, (os.cpu_count() or 1) // 2)
+
+
+@dataclass(frozen=True)
+class RunResult:
+    exit_code: int
+    stdout: str
+    stderr: str
+
+
+class ServerError(RuntimeError):
+    """The server failed to handle a request."""
+
+
+def server_request(
+    request: dict[str, Any],
+    socket_path: str | Path | None = None,
+    *,
+    timeout: float | None = None,
+) -> dict[str, Any] | None:
+    """Send `request` to the server and return its response.
+
+    Returns:
+        None if no server is listening on the socket.
+
+    Raises:
+        ServerError: The server reported an error.
+    """
+    path = str(socket_path or default_socket_path())
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as fin:
+            line = fin.readline()
+    if not line:
+        raise ServerError("the server closed the connection")
+    response = json.loads(line)
+    if "error" in response:
+        raise ServerError(response["error"])
+    return response
+
+
+def run_on_server(
+    argv: Sequence[str], socket_path: str | Path | None = None
+) -> RunResult | None:
+    """Run the `nbcc` command line `argv` on the server.
+
+    Returns:
+        None if no server is running.
+    """
+    env = {k: v for k, v in os.environ.items() if k.startswith("NBCC_")}
+    response = server_request(
+        {"op": "run", "argv": list(argv), "cwd": os.getcwd(), "env": env},
+        socket_path,
+    )
+    if response is None:
+        return None
+    return RunResult(
+        response["exit_code"], response["stdout"], response["stderr"]
+    )
+
+
+def is_server_running(socket_path: str | Path | None = None) -> bool:
+    try:
+        return (
+            server_request({"op": "ping"}, socket_path, timeout=5) is not None
+        )
+    except (OSError, ServerError):
+        return False
+
+
+class CompileServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    """The daemon of `nbcc serve`.
+
+    Each connection is handled in a thread that waits for a worker of the
+    process pool, so at most `workers` commands compile at the same time and
+    the others queue.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: str | Path | None = None,
+        *,
+        workers: int | None = None,
+    ):
+        self.socket_path = Path(socket_path or default_socket_path())
+        self.workers = workers or default_workers()
+        if self.socket_path.exists():
+            if is_server_running(self.socket_path):
+                raise ServerError(
+                    f"a server is already running on {self.socket_path}"
+                )
+            # Left over by a server that was killed
+            self.socket_path.unlink()
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        self._pool = self._new_pool()
+        self._pool_lock = threading.Lock()
+        super().__init__(str(self.socket_path), _RequestHandler)
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Spawn: the workers import MLIR themselves rather than inheriting
+        # the state of the server
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    def run(self, request: dict[str, Any]) -> dict[str, Any]:
+        from concurrent.futures.process import BrokenProcessPool
+
+        pool = self._pool
+        try:
+            code, out, err = pool.submit(
+                _run_command, request["argv"], request["cwd"], request["env"]
+            ).result()
+        except BrokenProcessPool:
+            # A worker died, e.g. of a crash in MLIR; the commands that were
+            # running fail and the next ones get a new pool
+            with self._pool_lock:
+                if self._pool is pool:
+                    _logger.warning("a worker died; starting a new pool")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self._pool = self._new_pool()
+            raise
+        return {"exit_code": code, "stdout": out, "stderr": err}
+
+    def server_close(self) -> None:
+        super().server_close()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        self.socket_path.unlink(missing_ok=True)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: CompileServer
+
+    def handle(self) -> None:
+        try:
+            request = json.loads(self.rfile.readline())
+            response = self._dispatch(request)
+        except Exception as e:
+            _logger.exception("request failed")
+            response = {"error": f"{type(e).__name__}: {e}"}
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    def _dispatch(self, request: dict[str, Any]) -> dict[str, Any]:
+        match request.get("op"):
+            case "run":
+                return self.server.run(request)
+            case "ping":
+                return {"pid": os.getpid(), "workers": self.server.workers}
+            case "shutdown":
+                # shutdown() waits for serve_forever(), which runs in
+                # another thread
+                threading.Thread(target=self.server.shutdown).start()
+                return {}
+            case op:
+                raise ValueError(f"unknown request {op!r}")
+
+
+# True in the worker processes of the server
+_in_worker = False
+# Prepares the next request of the worker; see `_run_command()`
+_prepare_thread: threading.Thread | None = None
+
+
+def in_worker() -> bool:
+    return _in_worker
+
+
+def _init_worker() -> None:
+    global _in_worker
+    _in_worker = True
+    # Import the compiler once; `nbcc.compiler` itself imports it lazily
+    import nbcc.cli.cli  # noqa: F401
+    import nbcc.middle_end  # noqa: F401
+    import nbcc.mlir_backend.backend  # noqa: F401
+    import nbcc.mlir_lowering  # noqa: F401
+
+    _prepare_next()
+
+
+def _prepare_next() -> None:
+    from nbcc.frontend.frontend import prepare_vm
+    from nbcc.mlir_backend.backend import prepare_context
+
+    prepare_vm()
+    prepare_context()
+
+
+def _run_command(
+    argv: list[str], cwd: str, env: dict[str, str]
+) -> tuple[int, str, str]:
+    import click
+
+    from nbcc.cli.cli import main
+    from nbcc.developer import is_release_mode, set_release_mode
+
+    global _prepare_thread
+    # The command may fork, e.g. the middle-end with `-j N`; a thread
+    # running at that time could leave a lock held in the child
+    if _prepare_thread is not None:
+        _prepare_thread.join()
+    saved_env = {k: v for k, v in os.environ.items() if k.startswith("NBCC_")}
+    saved_cwd = os.getcwd()
+    release = is_release_mode()
+    out, err = io.StringIO(), io.StringIO()
+    _set_nbcc_env(env)
+    try:
+        os.chdir(cwd)
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                main.main(args=argv, prog_name="nbcc")
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else int(bool(e.code))
+            except click.exceptions.Abort:
+                code = 1
+            except Exception:
+                traceback.print_exc()
+                code = 1
+    finally:
+        os.chdir(saved_cwd)
+        _set_nbcc_env(saved_env)
+        set_release_mode(release)
+    # Build the VM and the context of the next request while idle
+    _prepare_thread = threading.Thread(target=_prepare_next, daemon=True)
+    _prepare_thread.start()
+    return code, out.getvalue(), err.getvalue()
+
+
+def _set_nbcc_env(env: dict[str, str]) -> None:
+    for key in [k for k in os.environ if k.startswith("NBCC_")]:
+        if key not in env:
+            del os.environ[key]
+    os.environ.update(env)
@@ -0,0 +1,22 @@
+import numpy as np
+
+
+def to_bf16(A):
+    """Truncate float32 values to bf16 bit patterns (stored as uint16)."""
+    return (A.astype(np.float32).view(np.uint32) >> 16).astype(np.uint16)
+
+
+def from_bf16(A):
+    return (A.astype(np.uint32) << 16).view(np.float32)
+
+
+def openmp_functions(module) -> set[str]:
+    """The names of the functions of an LLVM-dialect module with OpenMP
+    worksharing loops."""
+    from mlir import ir
+
+    return {
+        ir.StringAttr(op.attributes["sym_name"]).value
+        for op in module.body.operations
+        if op.operation.name == "llvm.func" and "omp.wsloop" in str(op)
+    }
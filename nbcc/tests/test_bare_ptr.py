@@ -0,0 +1,56 @@
+from mlir import ir
+
+from nbcc.mlir_backend.bare_ptr import add_bare_ptr_wrappers, bare_ptr_symbol
+from nbcc.mlir_backend.exports import EXPORTS_ATTR, read_exports
+
+# The lowered (expanded descriptor) signatures of the exported functions
+SOURCE = """
+llvm.func @"spy_k$exported$export_into_f"(
+    %0: !llvm.ptr, %1: !llvm.ptr, %2: i64, %3: i64, %4: i64, %5: i64, %6: i64,
+    %7: !llvm.ptr, %8: !llvm.ptr, %9: i64, %10: i64, %11: i64, %12: i64,
+    %13: i64) {
+  llvm.return
+}
+
+llvm.func @"spy_k$exported$export_g"(
+    %0: !llvm.ptr, %1: !llvm.ptr, %2: i64, %3: i64, %4: i64)
+    -> !llvm.struct<(ptr, ptr, i64, array<1 x i64>, array<1 x i64>)> {
+  %r = llvm.mlir.poison
+      : !llvm.struct<(ptr, ptr, i64, array<1 x i64>, array<1 x i64>)>
+  llvm.return %r
+      : !llvm.struct<(ptr, ptr, i64, array<1 x i64>, array<1 x i64>)>
+}
+"""
+
+
+def test_wrappers_for_functions_without_memref_results():
+    with ir.Context() as context, ir.Location.unknown():
+        module = ir.Module.parse(SOURCE, context=context)
+        f64 = ir.F64Type.get()
+        dyn = ir.ShapedType.get_dynamic_size()
+        arg_2d = ir.MemRefType.get([dyn, 4], f64)
+        arg_1d = ir.MemRefType.get([dyn], f64)
+        module.operation.attributes[EXPORTS_ATTR] = ir.DictAttr.get(
+            {
+                "spy_k$exported$export_into_f": ir.TypeAttr.get(
+                    ir.FunctionType.get([arg_2d, arg_2d], [])
+                ),
+                "spy_k$exported$export_g": ir.TypeAttr.get(
+                    ir.FunctionType.get([arg_1d], [arg_1d])
+                ),
+            }
+        )
+
+        wrapped = add_bare_ptr_wrappers(module)
+        assert wrapped == ["spy_k$exported$export_into_f"]
+        module.operation.verify()
+
+        text = str(module)
+        bare = bare_ptr_symbol("spy_k$exported$export_into_f")
+        assert bare in text
+        # The static size is a constant
+        assert "llvm.mlir.constant(4 : i64)" in text
+
+        specs = {spec.name: spec for spec in read_exports(module)}
+        assert specs["export_into_f"].bare_symbol == bare
+        assert specs["export_g"].bare_symbol is None
@@ -0,0 +1,216 @@
+import ctypes
+import dataclasses
+import gc
+import importlib.util
+import resource
+import shutil
+import subprocess as subp
+
+import numpy as np
+import pytest
+
+from nbcc.bindings import (
+    BarePtrKernel,
+    ExportSpec,
+    Kernel,
+    Param,
+    bind,
+    bindings_path,
+    generate_bindings,
+    memref_descriptor_class,
+    take_memref,
+    write_bindings,
+)
+
+# Stand-ins for the C interface of the kernels generated by the backend
+KERNELS_C = r"""
+#include <stdint.h>
+#include <stdlib.h>
+
+typedef struct {
+    double *allocated, *aligned;
+    int64_t offset, shape[2], strides[2];
+} memref_2d_f64;
+
+void _mlir_ciface_spy_k$exported$export_twice(memref_2d_f64 *out,
+                                              memref_2d_f64 *a) {
+    int64_t n = a->shape[0] * a->shape[1];
+    double *buf = malloc(n * sizeof(double));
+    for (int64_t i = 0; i < n; i++)
+        buf[i] = 2 * a->aligned[a->offset + i];
+    out->allocated = out->aligned = buf;
+    out->offset = 0;
+    out->shape[0] = a->shape[0];
+    out->shape[1] = a->shape[1];
+    out->strides[0] = a->shape[1];
+    out->strides[1] = 1;
+}
+
+void _mlir_ciface_spy_k$exported$export_into_twice(memref_2d_f64 *a,
+                                                   memref_2d_f64 *out) {
+    int64_t n = a->shape[0] * a->shape[1];
+    for (int64_t i = 0; i < n; i++)
+        out->aligned[out->offset + i] = 2 * a->aligned[a->offset + i];
+}
+
+int32_t _mlir_ciface_spy_k$exported$export_add(int32_t a, int32_t b) {
+    return a + b;
+}
+
+void _nbcc_bare_spy_k$exported$export_into_twice(double *a, int64_t a0,
+                                                 int64_t a1, double *out,
+                                                 int64_t out0, int64_t out1) {
+    for (int64_t i = 0; i < a0 * a1; i++)
+        out[i] = 2 * a[i];
+}
+
+int64_t freed = 0;
+
+void _nbcc_dealloc(void *allocated) {
+    freed++;
+    free(allocated);
+}
+"""
+
+EXPORTS = [
+    ExportSpec(
+        "spy_k$exported$export_twice", (Param("f64", 2),), (Param("f64", 2),)
+    ),
+    ExportSpec(
+        "spy_k$exported$export_into_twice",
+        (Param("f64", 2), Param("f64", 2)),
+        (),
+    ),
+    ExportSpec(
+        "spy_k$exported$export_add",
+        (Param("i32"), Param("i32")),
+        (Param("i32"),),
+    ),
+]
+
+
+@pytest.fixture(scope="module")
+def bindings(tmp_path_factory):
+    cc = shutil.which("cc") or shutil.which("clang")
+    if cc is None:
+        pytest.skip("no C compiler")
+    tmp_path = tmp_path_factory.mktemp("bindings")
+    source = tmp_path / "k.c"
+    source.write_text(KERNELS_C)
+    lib = tmp_path / "k.so"
+    subp.check_call([cc, "-shared", "-fPIC", "-o", str(lib), str(source)])
+    path = write_bindings(EXPORTS, lib)
+    spec = importlib.util.spec_from_file_location("k_bindings", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_bindings_path():
+    assert bindings_path("/x/llm_tensor.so").name == "llm_tensor_bindings.py"
+
+
+def test_generated_source_lists_exports():
+    source = generate_bindings(EXPORTS, "k.so")
+    compile(source, "k_bindings.py", "exec")
+    assert "__all__ = ['export_twice', 'export_into_twice', 'export_add']" in (
+        source
+    )
+
+
+def test_spec_round_trips_through_json():
+    for spec in EXPORTS:
+        assert ExportSpec.from_json(spec.to_json()) == spec
+    assert EXPORTS[0].format() == "export_twice(f64[:, :]) -> f64[:, :]"
+
+
+def test_call_returning_memref(bindings):
+    A = np.arange(12.0).reshape(3, 4)
+    np.testing.assert_array_equal(bindings.export_twice(A), 2 * A)
+
+
+def test_call_into_output(bindings):
+    A = np.arange(12.0).reshape(3, 4)
+    out = np.empty_like(A)
+    assert bindings.export_into_twice(A, out) is None
+    np.testing.assert_array_equal(out, 2 * A)
+
+
+def test_call_scalars(bindings):
+    assert bindings.export_add(2, 3) == 5
+
+
+@pytest.mark.parametrize(
+    "arg, message",
+    [
+        (np.zeros((3, 4), dtype=np.float32), "2-d float32 array"),
+        (np.zeros(4), "1-d float64 array"),
+        (np.zeros((4, 3)).T, "non-contiguous"),
+        ([[1.0]], "got list"),
+    ],
+)
+def test_bad_argument(bindings, arg, message):
+    with pytest.raises(TypeError, match=message):
+        bindings.export_twice(arg)
+
+
+def test_bad_argument_count(bindings):
+    with pytest.raises(TypeError, match="takes 1 arguments, got 2"):
+        bindings.export_twice(np.zeros((1, 1)), np.zeros((1, 1)))
+
+
+def test_bare_ptr_kernel(bindings):
+    lib = ctypes.CDLL(bindings._lib._name)
+    spec = dataclasses.replace(
+        EXPORTS[1], bare_symbol="_nbcc_bare_spy_k$exported$export_into_twice"
+    )
+    assert ExportSpec.from_json(spec.to_json()) == spec
+    kernel = bind(lib, spec)
+    assert isinstance(kernel, BarePtrKernel)
+    A = np.arange(12.0).reshape(3, 4)
+    out = np.empty_like(A)
+    kernel(A, out)
+    np.testing.assert_array_equal(out, 2 * A)
+    with pytest.raises(TypeError, match="non-contiguous"):
+        kernel(A, np.empty((4, 3)).T)
+    # Without a bare-pointer entry point the C interface is used
+    assert type(bind(lib, EXPORTS[1])) is Kernel
+
+
+def test_result_frees_buffer(bindings):
+    freed = ctypes.c_int64.in_dll(bindings._lib, "freed")
+    before = freed.value
+    out = bindings.export_twice(np.ones((3, 4)))
+    view = out[1:]
+    del out
+    gc.collect()
+    # The view keeps the buffer alive
+    assert freed.value == before
+    np.testing.assert_array_equal(view, 2)
+    del view
+    gc.collect()
+    assert freed.value == before + 1
+
+
+def test_take_memref_without_dealloc():
+    buf = np.arange(6.0)
+    desc = memref_descriptor_class(2)()
+    desc.allocated = desc.aligned = buf.ctypes.data
+    desc.offset = 1
+    desc.shape = (2, 2)
+    desc.strides = (3, 1)
+    out = take_memref(desc, dtype=np.float64)
+    np.testing.assert_array_equal(out, [[1.0, 2.0], [4.0, 5.0]])
+
+
+def test_repeated_calls_do_not_leak(bindings):
+    """The RSS stays flat over 100k calls returning 8 kB arrays."""
+    A = np.ones((32, 32))
+    for _ in range(1000):
+        bindings.export_twice(A)
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for _ in range(100_000):
+        bindings.export_twice(A)
+    growth_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start
+    # Leaking every result would grow it by ~800 MB
+    assert growth_kb < 50_000
@@ -0,0 +1,192 @@
+import json
+import os
+import subprocess as subp
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from graphlib import CycleError
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+from nbcc.build import (
+    Target,
+    TargetResult,
+    _Pool,
+    _schedule,
+    build,
+    dependency_graph,
+    load_manifest,
+    targets_from_sources,
+)
+from nbcc.cli.cli import main
+
+
+def _write(path: Path, text: str) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    return path
+
+
+def test_targets_from_sources(tmp_path):
+    a = _write(tmp_path / "src" / "a.spy", "")
+    b = _write(tmp_path / "src" / "sub" / "b.spy", "")
+    targets = targets_from_sources(
+        [str(tmp_path / "src" / "**" / "*.spy"), str(a)], tmp_path / "out"
+    )
+    assert [t.source for t in targets] == [a.resolve(), b.resolve()]
+    assert targets[0].output.parent == tmp_path / "out"
+    assert targets[0].output.stem == "a"
+    binary = targets_from_sources([str(a)], tmp_path, kind="binary")
+    assert binary[0].output == tmp_path / "a"
+    with pytest.raises(ValueError, match="no source"):
+        targets_from_sources([str(tmp_path / "*.missing")], tmp_path)
+
+
+def test_load_manifest(tmp_path):
+    _write(tmp_path / "k" / "softmax.spy", "")
+    _write(tmp_path / "tool.spy", "")
+    manifest = _write(
+        tmp_path / "nbcc-build.json",
+        json.dumps(
+            {
+                "output_dir": "out",
+                "targets": [
+                    {"source": "k/softmax.spy", "bindings": True},
+                    {"source": "tool.spy", "kind": "binary", "output": "t"},
+                ],
+            }
+        ),
+    )
+    softmax, tool = load_manifest(manifest)
+    assert softmax.source == tmp_path / "k" / "softmax.spy"
+    assert softmax.kind == "shared" and softmax.bindings
+    assert tool.output == tmp_path / "out" / "t"
+    assert tool.kind == "binary"
+
+    _write(manifest, json.dumps({"targets": [{"source": "x.spy"}]}))
+    with pytest.raises(ValueError, match="no source"):
+        load_manifest(manifest)
+    _write(
+        manifest,
+        json.dumps({"targets": [{"source": "tool.spy", "kind": "static"}]}),
+    )
+    with pytest.raises(ValueError, match="kind"):
+        load_manifest(manifest)
+
+
+def test_dependency_graph(tmp_path):
+    main_src = _write(tmp_path / "main.spy", "from helper import f\n")
+    _write(tmp_path / "helper.spy", "import leaf\n")
+    leaf = _write(tmp_path / "leaf.spy", "")
+    other = _write(tmp_path / "other.spy", "")
+    main_t, leaf_t, other_t = targets_from_sources(
+        map(str, [main_src, leaf, other]), tmp_path / "out"
+    )
+    graph = dependency_graph([main_t, leaf_t, other_t])
+    # `helper` is not a target; `main` depends on `leaf` through it
+    assert graph == {main_t: {leaf_t}, leaf_t: set(), other_t: set()}
+
+
+def test_build_rejects_cycles_and_duplicate_outputs(tmp_path):
+    a = _write(tmp_path / "a.spy", "import b\n")
+    b = _write(tmp_path / "b.spy", "import a\n")
+    with pytest.raises(CycleError):
+        build(targets_from_sources([str(a), str(b)], tmp_path), jobs=1)
+    out = tmp_path / "out.so"
+    with pytest.raises(ValueError, match="same output"):
+        build([Target(a, out), Target(b, out)], jobs=1)
+
+
+def test_dependents_of_failed_target_are_skipped(tmp_path):
+    broken = _write(tmp_path / "broken.spy", "def f(:\n")
+    user = _write(tmp_path / "user.spy", "from broken import f\n")
+    targets = targets_from_sources([str(user), str(broken)], tmp_path / "o")
+    seen = []
+    summary = build(
+        targets,
+        jobs=1,
+        use_cache=False,
+        progress=lambda result, i, n: seen.append((result.status, i, n)),
+    )
+    user_result, broken_result = summary.results
+    assert broken_result.status == "failed"
+    assert broken_result.error
+    assert user_result.status == "skipped"
+    assert "broken.spy" in user_result.error
+    assert seen == [("failed", 1, 2), ("skipped", 2, 2)]
+    assert len(summary.failed) == 2
+    assert "1 failed, 1 skipped" in summary.format()
+
+
+def test_dead_worker_fails_its_target(tmp_path):
+    crash = _write(tmp_path / "crash.spy", "")
+    user = _write(tmp_path / "user.spy", "import crash\n")
+    other = _write(tmp_path / "other.spy", "")
+    targets = targets_from_sources(map(str, [crash, user, other]), tmp_path)
+
+    def submit(target, options):
+        future = Future()
+        if target.source == crash.resolve():
+            future.set_exception(BrokenProcessPool("worker died"))
+        else:
+            future.set_result(TargetResult(target, "built"))
+        return future
+
+    results = _schedule(dependency_graph(targets), submit, None, None)
+    status = {r.target.source.name: (r.status, r.error) for r in results}
+    assert status["crash.spy"][0] == "failed"
+    assert status["crash.spy"][1].endswith("BrokenProcessPool: worker died")
+    assert status["user.spy"][0] == "skipped"
+    assert status["other.spy"] == ("built", None)
+
+
+def test_pool_replaces_dead_workers():
+    pool = _Pool(1)
+    try:
+        with pytest.raises(BrokenProcessPool):
+            pool.submit(os._exit, 1).result()
+        assert pool.submit(abs, -2).result() == 2
+    finally:
+        pool.shutdown()
+
+
+def test_cli_requires_targets():
+    result = CliRunner().invoke(main, ["build"])
+    assert result.exit_code == 2
+    assert "SOURCES or --manifest" in result.output
+
+
+KERNEL = """
+def export_scale(a: i32) -> i32:
+    return a * {factor}
+"""
+
+PROGRAM = """
+def main() -> int:
+    print(42)
+    return 0
+"""
+
+
+def test_build_in_parallel(tmp_path, monkeypatch):
+    monkeypatch.setenv("NBCC_CACHE_DIR", str(tmp_path / "cache"))
+    for factor in range(3):
+        _write(tmp_path / f"k{factor}.spy", KERNEL.format(factor=factor))
+    _write(tmp_path / "prog.spy", PROGRAM)
+    targets = targets_from_sources(
+        [str(tmp_path / "k*.spy")], tmp_path / "out"
+    ) + targets_from_sources(
+        [str(tmp_path / "prog.spy")], tmp_path / "out", kind="binary"
+    )
+
+    summary = build(targets, jobs=2)
+    assert [r.status for r in summary.results] == ["built"] * 4
+    assert all(r.stages["codegen"] > 0 for r in summary.results)
+    assert all(t.output.exists() for t in targets)
+    out = subp.check_output([str(tmp_path / "out" / "prog")], text=True)
+    assert out == "42\n"
+
+    # The second build copies the outputs from the artifact cache
+    summary = build(targets, jobs=2)
+    assert [r.status for r in summary.results] == ["cached"] * 4
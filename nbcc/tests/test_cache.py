@@ -0,0 +1,141 @@
+import os
+import time
+from pathlib import Path
+
+import nbcc.cache
+from nbcc.cache import (
+    ArtifactCache,
+    compute_key,
+    find_imports,
+    package_fingerprint,
+)
+
+
+class FakeBackend:
+    pass
+
+
+def _write(path: Path, text: str) -> Path:
+    path.write_text(text)
+    return path
+
+
+def _make_artifact(path: Path, size: int) -> Path:
+    path.write_bytes(b"x" * size)
+    return path
+
+
+def test_find_imports(tmp_path):
+    main = _write(tmp_path / "main.spy", "from helper import f\nimport mlir\n")
+    helper = _write(tmp_path / "helper.spy", "import leaf\n")
+    leaf = _write(tmp_path / "leaf.spy", "")
+    assert find_imports(main) == sorted([helper.resolve(), leaf.resolve()])
+
+
+def test_key_depends_on_imports(tmp_path):
+    main = _write(tmp_path / "main.spy", "from helper import f\n")
+    helper = _write(tmp_path / "helper.spy", "def f() -> None:\n    pass\n")
+
+    def key(**kwargs):
+        return compute_key(main, kind="shared", be_type=FakeBackend, **kwargs)
+
+    before = key()
+    assert key() == before
+    assert key(options={"opt_level": 2}) != before
+    assert compute_key(main, kind="binary", be_type=FakeBackend) != before
+
+    _write(helper, "def f() -> None:\n    return\n")
+    assert key() != before
+
+
+def test_key_with_source_digest(tmp_path, monkeypatch):
+    main = _write(tmp_path / "main.spy", "")
+
+    def key(digest):
+        return compute_key(
+            main, kind="shared", be_type=FakeBackend, source_digest=digest
+        )
+
+    before = key("module-1")
+    assert key("module-2") != before
+    # Replaces the hash of the sources
+    _write(main, "def f() -> None:\n    pass\n")
+    assert key("module-1") == before
+    # The rest of the components still count
+    monkeypatch.setattr(
+        nbcc.cache, "transform_sequences_fingerprint", lambda: "edited"
+    )
+    edited = key("module-1")
+    assert edited != before
+    monkeypatch.setattr(nbcc.cache, "tool_versions", lambda: {"llc": "99"})
+    assert key("module-1") != edited
+
+
+def test_package_fingerprint(tmp_path, monkeypatch):
+    pkg = tmp_path / "fakepkg"
+    (pkg / "lib").mkdir(parents=True)
+    _write(pkg / "__init__.py", "")
+    module = _write(pkg / "lib" / "builtins.spy", "def f() -> None:\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    before = package_fingerprint("fakepkg")
+    package_fingerprint.cache_clear()
+    assert package_fingerprint("fakepkg") == before
+    # Same version, new commit
+    _write(module, "def g() -> None:\n")
+    package_fingerprint.cache_clear()
+    assert package_fingerprint("fakepkg") != before
+    assert package_fingerprint("no_such_package") == "<missing>"
+
+
+def test_store_and_fetch(tmp_path):
+    cache = ArtifactCache(tmp_path / "cache", max_size=1024)
+    artifact = _make_artifact(tmp_path / "lib.so", 10)
+    os.chmod(artifact, 0o755)
+
+    assert not cache.fetch("k1", tmp_path / "out.so")
+    cache.store("k1", artifact)
+    assert cache.fetch("k1", tmp_path / "out.so")
+    out = tmp_path / "out.so"
+    assert out.read_bytes() == artifact.read_bytes()
+    assert os.access(out, os.X_OK)
+
+    stats = cache.stats()
+    assert stats.entries == 1
+    assert stats.total_size == 10
+    assert stats.hits == 1
+    assert stats.misses == 1
+
+
+def test_metadata(tmp_path):
+    cache = ArtifactCache(tmp_path / "cache", max_size=1024)
+    artifact = _make_artifact(tmp_path / "lib.so", 10)
+    assert cache.metadata("k1") is None
+    cache.store("k1", artifact, metadata={"exports": [{"symbol": "f"}]})
+    assert cache.metadata("k1")["exports"] == [{"symbol": "f"}]
+
+
+def test_lru_eviction(tmp_path):
+    cache = ArtifactCache(tmp_path / "cache", max_size=250)
+    for i, key in enumerate(["a", "b"]):
+        cache.store(key, _make_artifact(tmp_path / key, 100))
+        past = time.time() - 100 + i
+        os.utime(cache.directory / "artifacts" / key, (past, past))
+
+    # Touch "a" so that "b" becomes the least recently used entry
+    assert cache.lookup("a") is not None
+    cache.store("c", _make_artifact(tmp_path / "c", 100))
+
+    assert cache.lookup("a") is not None
+    assert cache.lookup("b") is None
+    assert cache.lookup("c") is not None
+    assert cache.stats().total_size == 200
+
+
+def test_clear(tmp_path):
+    cache = ArtifactCache(tmp_path / "cache")
+    cache.store("a", _make_artifact(tmp_path / "a", 10))
+    cache.store("b", _make_artifact(tmp_path / "b", 10))
+    assert cache.clear() == 2
+    stats = cache.stats()
+    assert stats.entries == 0
+    assert stats.hits == 0
@@ -0,0 +1,25 @@
+import math
+
+import pytest
+
+from benchmarks.compile_throughput import slope
+from benchmarks.generators import GENERATORS
+from nbcc.frontend import frontend
+
+
+def _compile(tmp_path, source):
+    path = tmp_path / "bench.spy"
+    path.write_text(source)
+    return frontend(str(path))
+
+
+@pytest.mark.parametrize("axis", sorted(GENERATORS))
+def test_generated_programs_compile(tmp_path, axis):
+    _compile(tmp_path, GENERATORS[axis](2))
+
+
+def test_slope():
+    sizes = [1, 2, 4, 8]
+    assert slope(sizes, [3.0 * s for s in sizes]) == pytest.approx(1.0)
+    assert slope(sizes, [s**2 for s in sizes]) == pytest.approx(2.0)
+    assert math.isnan(slope([4], [1.0]))
@@ -0,0 +1,67 @@
+import pytest
+from mlir import ir
+
+from nbcc.mlir_backend.destination_passing import (
+    DESTINATION_PASSING_ATTR,
+    convert_to_destination_passing,
+)
+
+SOURCE = """
+func.func @export_into_f(%arg0: memref<?xf64>) -> memref<?xf64>
+    attributes {nbcc.destination_passing} {
+  %t = bufferization.to_tensor %arg0 restrict : memref<?xf64> to tensor<?xf64>
+  %0 = linalg.add ins(%t, %t : tensor<?xf64>, tensor<?xf64>)
+                  outs(%t : tensor<?xf64>) -> tensor<?xf64>
+  %1 = bufferization.to_buffer %0 : tensor<?xf64> to memref<?xf64>
+  return %1 : memref<?xf64>
+}
+
+func.func @export_g(%arg0: memref<?xf64>) -> memref<?xf64> {
+  return %arg0 : memref<?xf64>
+}
+"""
+
+
+def test_results_become_output_arguments():
+    with ir.Context() as context:
+        module = ir.Module.parse(SOURCE, context=context)
+        assert convert_to_destination_passing(module) == ["export_into_f"]
+        module.operation.verify()
+
+        f, g = module.body.operations
+        assert str(f.type) == "(memref<?xf64>, memref<?xf64>) -> ()"
+        assert DESTINATION_PASSING_ATTR not in f.attributes
+        text = str(f)
+        assert "bufferization.materialize_in_destination" in text
+        # Unmarked functions are unchanged
+        assert str(g.type) == "(memref<?xf64>) -> memref<?xf64>"
+
+
+CALLER = """
+func.func @caller(%arg0: memref<?xf64>) -> memref<?xf64> {
+  %0 = call @export_into_f(%arg0) : (memref<?xf64>) -> memref<?xf64>
+  return %0 : memref<?xf64>
+}
+"""
+
+NESTED_CALLER = """
+func.func @caller(%arg0: memref<?xf64>, %c: i1) -> memref<?xf64> {
+  %0 = scf.if %c -> memref<?xf64> {
+    %1 = func.call @export_into_f(%arg0)
+        : (memref<?xf64>) -> memref<?xf64>
+    scf.yield %1 : memref<?xf64>
+  } else {
+    scf.yield %arg0 : memref<?xf64>
+  }
+  return %0 : memref<?xf64>
+}
+"""
+
+
+@pytest.mark.parametrize("caller", [CALLER, NESTED_CALLER])
+def test_called_function_is_rejected(caller):
+    source = SOURCE + caller
+    with ir.Context() as context:
+        module = ir.Module.parse(source, context=context)
+        with pytest.raises(NotImplementedError, match="called from caller"):
+            convert_to_destination_passing(module)
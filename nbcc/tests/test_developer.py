@@ -0,0 +1,55 @@
+import io
+import logging
+from contextlib import redirect_stdout
+
+import pytest
+
+from nbcc import developer
+from nbcc.developer import Lazy, is_release_mode, set_release_mode
+
+_logger = logging.getLogger("nbcc.tests")
+
+
+@pytest.fixture
+def restore_mode():
+    saved = is_release_mode()
+    yield
+    set_release_mode(saved)
+
+
+def test_release_mode_skips_formatting(restore_mode):
+    calls = []
+
+    def dump():
+        calls.append(1)
+        return "IR"
+
+    set_release_mode(True)
+    buf = io.StringIO()
+    with redirect_stdout(buf):
+        _logger.debug("%s", Lazy(dump))
+    assert calls == []
+    assert buf.getvalue() == ""
+
+    set_release_mode(False)
+    with redirect_stdout(buf):
+        _logger.debug("%s", Lazy(dump))
+    assert calls
+    assert buf.getvalue() == "IR\n"
+
+
+def test_debug_verify(restore_mode):
+    class Op:
+        verified = False
+
+        def verify(self):
+            self.verified = True
+            return True
+
+    op = Op()
+    set_release_mode(True)
+    developer.debug_verify(op)
+    assert not op.verified
+    set_release_mode(False)
+    developer.debug_verify(op)
+    assert op.verified
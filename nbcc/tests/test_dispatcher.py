@@ -0,0 +1,79 @@
+import os.path
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import nbcc
+from nbcc.dispatcher import ShapeDispatcher
+
+example_dir = Path(os.path.dirname(nbcc.__file__)) / ".." / "examples"
+
+
+def golden_softmax(A):
+    exp_x = np.exp(A - A.max(axis=-1, keepdims=True))
+    return exp_x / exp_x.sum(axis=-1, keepdims=True)
+
+
+@pytest.fixture
+def softmax():
+    return ShapeDispatcher(
+        str(example_dir / "llm_tensor.spy"),
+        "export_softmax",
+        max_variants=2,
+        specialize_after=2,
+    )
+
+
+def test_specialize_hot_shapes(softmax):
+    A = np.random.random((7, 20))
+    for _ in range(3):
+        np.testing.assert_allclose(softmax(A), golden_softmax(A))
+    stats = softmax.stats()
+    assert (stats.misses, stats.hits, stats.compiles) == (1, 2, 1)
+
+
+def test_lru_eviction(softmax):
+    arrays = [np.random.random((n, 16)) for n in (3, 5, 7)]
+    for A in arrays:
+        for _ in range(2):
+            np.testing.assert_allclose(softmax(A), golden_softmax(A))
+    stats = softmax.stats()
+    assert stats.compiles == 3
+    assert stats.evictions == 1
+    assert stats.variants == 2
+
+
+def test_non_contiguous_uses_generic(softmax):
+    A = np.random.random((20, 7)).T
+    for _ in range(3):
+        np.testing.assert_allclose(softmax(A), golden_softmax(A))
+    assert softmax.stats().compiles == 0
+    assert softmax.stats().misses == 3
+
+
+def test_argument_check(softmax):
+    with pytest.raises(TypeError):
+        softmax(np.zeros((3, 3), dtype=np.float32))
+
+
+def test_clone_module_is_independent():
+    from mlir import ir
+
+    from nbcc.mlir_backend.specialize import clone_module
+
+    with ir.Context():
+        module = ir.Module.parse(
+            """
+            module attributes {nbcc.test} {
+              func.func @f(%arg0: memref<?xf64>) {
+                return
+              }
+            }
+            """
+        )
+        clone = clone_module(module)
+        assert str(clone) == str(module)
+        clone.body.operations[0].operation.erase()
+        assert "func.func @f" in str(module)
+        assert "nbcc.test" in str(clone)
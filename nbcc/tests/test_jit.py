@@ -0,0 +1,107 @@
+import os
+import os.path
+import tempfile
+from contextlib import contextmanager
+from ctypes import CDLL, byref, c_double, c_int64
+from pathlib import Path
+from typing import Generator
+
+import numpy as np
+import pytest
+from mlir import ir
+from mlir.runtime import (
+    get_ranked_memref_descriptor,
+    make_nd_memref_descriptor,
+    ranked_memref_to_numpy,
+)
+
+import nbcc
+from nbcc.compiler import compile_to_mlir, make_shared
+from nbcc.jit import jit_compile
+
+example_dir = Path(os.path.dirname(nbcc.__file__)) / ".." / "examples"
+
+SOFTMAX = "_mlir_ciface_spy_llm_tensor$exported$export_softmax"
+
+compile_benchmark_config = dict(rounds=5, iterations=1, warmup_rounds=0)
+
+
+@contextmanager
+def make_temp_directory() -> Generator[Path, None, None]:
+    with tempfile.TemporaryDirectory(delete=False) as dirpath:
+        yield Path(dirpath)
+
+
+@pytest.fixture(scope="module")
+def llm_tensor_module():
+    return compile_to_mlir(str(example_dir / "llm_tensor.spy"))
+
+
+def golden_softmax(A):
+    exp_x = np.exp(A - A.max(axis=-1, keepdims=True))
+    return exp_x / exp_x.sum(axis=-1, keepdims=True)
+
+
+def call_softmax(export_function, A):
+    memref_2d_f64 = make_nd_memref_descriptor(2, c_double)
+    argA = get_ranked_memref_descriptor(A)
+    out_memref = (memref_2d_f64 * 1)()
+    export_function(out_memref, byref(argA))
+    return ranked_memref_to_numpy(out_memref)
+
+
+def test_jit_softmax(llm_tensor_module):
+    lib = jit_compile(llm_tensor_module)
+    assert SOFTMAX in lib.exported_names
+    export_function = getattr(lib, SOFTMAX)
+
+    A = np.random.random((70, 200))
+    np.testing.assert_allclose(
+        call_softmax(export_function, A), golden_softmax(A)
+    )
+
+
+@pytest.mark.parametrize("opt_level", [0, 2, 3])
+def test_jit_opt_levels(llm_tensor_module, opt_level):
+    lib = jit_compile(llm_tensor_module, opt_level=opt_level)
+    A = np.random.random((7, 20))
+    np.testing.assert_allclose(
+        call_softmax(lib.get_function(SOFTMAX), A), golden_softmax(A)
+    )
+
+
+SCALE = """
+llvm.func @_mlir_ciface_scale(%a: i64, %x: f64) -> f64
+    attributes {llvm.emit_c_interface} {
+  %0 = llvm.sitofp %a : i64 to f64
+  %1 = llvm.fmul %0, %x : f64
+  llvm.return %1 : f64
+}
+"""
+
+
+def test_jit_scalar_arguments():
+    with ir.Context(), ir.Location.unknown():
+        module = ir.Module.parse(SCALE)
+        lib = jit_compile(module, shared_libs=[])
+    out = c_double()
+    lib.get_function("scale")(c_int64(3), c_double(1.5), out)
+    assert out.value == 4.5
+
+
+def test_bench_compile_make_shared(benchmark, llm_tensor_module):
+    with make_temp_directory() as dir:
+        outpath = str(dir / "llm_tensor.so")
+
+        def build():
+            make_shared(llm_tensor_module, outpath)
+            return getattr(CDLL(outpath), SOFTMAX)
+
+        benchmark.pedantic(build, **compile_benchmark_config)
+
+
+def test_bench_compile_jit(benchmark, llm_tensor_module):
+    def build():
+        return jit_compile(llm_tensor_module).get_function(SOFTMAX)
+
+    benchmark.pedantic(build, **compile_benchmark_config)
@@ -1,12 +1,15 @@
+import importlib.util
 import os
 import os.path
+import resource
 import tempfile
 from contextlib import contextmanager
-from ctypes import CDLL, byref, c_double
+from ctypes import CDLL, byref, c_double, c_float, c_uint16
 from pathlib import Path
 from typing import Generator
 
 import numpy as np
+import pytest
 from mlir.runtime import (
     get_ranked_memref_descriptor,
     make_nd_memref_descriptor,
@@ -14,8 +17,16 @@ from mlir.runtime import (
 )
 
 import nbcc
-from nbcc.compiler import compile_shared_lib
-
+from nbcc.bindings import BarePtrKernel, bindings_path
+from nbcc.compiler import (
+    compile_shared_lib,
+    compile_to_mlir,
+    lower_to_mlir,
+    make_shared,
+)
+from nbcc.runtime import alloc_stats, reset_alloc_stats
+from nbcc.tests import from_bf16, openmp_functions, to_bf16
+from nbcc.toolchain import set_omp_num_threads, uses_openmp
 
 example_dir = Path(os.path.dirname(nbcc.__file__)) / ".." / "examples"
 
@@ -27,12 +38,19 @@ def make_temp_directory() -> Generator[Path, None, None]:
 
 
 @contextmanager
-def compile_lib(filename: str, libname: str) -> Generator[Path, None, None]:
+def compile_lib(
+    filename: str, libname: str, bindings: bool = False, **backend_options
+) -> Generator[Path, None, None]:
     path = example_dir / filename
     assert path.exists()
     with make_temp_directory() as dir:
         outpath = dir / libname
-        compile_shared_lib(str(path), str(outpath))
+        compile_shared_lib(
+            str(path),
+            str(outpath),
+            backend_options=backend_options,
+            bindings=bindings,
+        )
         yield outpath
 
 
@@ -159,3 +177,392 @@ def test_bench_nbcc_softmax_fused(benchmark):
         benchmark.pedantic(
             export_function, args=args, teardown=cleanup, **benchmark_config
         )
+
+
+def _walk_loops(op, in_loop=False):
+    """Yield the operations nested in `op`, and whether they are in an
+    `scf.forall`."""
+    for region in op.regions:
+        for block in region.blocks:
+            for inner in block.operations:
+                yield inner.operation, in_loop
+                yield from _walk_loops(
+                    inner.operation,
+                    in_loop or inner.operation.name == "scf.forall",
+                )
+
+
+def test_fuse_reduce_fuses_softmax_rows():
+    be, module, transforms = lower_to_mlir(str(example_dir / "llm_tensor.spy"))
+    fname = "spy_llm_tensor$exported$export_softmax$transformed"
+    assert fname in transforms
+    module = be.run_transforms(module, transforms)
+    [fn] = [
+        op
+        for op in module.body.operations
+        if op.operation.name == "func.func" and op.name.value == fname
+    ]
+    ops = list(_walk_loops(fn.operation))
+
+    [loop] = [op for op, _ in ops if op.name == "scf.forall"]
+    inside = [op.name for op, in_loop in ops if in_loop]
+    outside = [op for op, in_loop in ops if not in_loop]
+    # Both reductions run on one row per iteration
+    assert inside.count("linalg.reduce") == 2
+    assert not [op.name for op in outside if op.name.startswith("linalg.")]
+    # The only full-size tensor is the output of the loop
+    [empty] = [op for op in outside if op.name == "tensor.empty"]
+    assert empty.result in list(loop.operands)
+
+
+def call_2d(export_function, A):
+    memref_2d_f64 = make_nd_memref_descriptor(2, c_double)
+    argA = get_ranked_memref_descriptor(A)
+    out_memref = (memref_2d_f64 * 1)()
+    export_function(out_memref, byref(argA))
+    return ranked_memref_to_numpy(out_memref)
+
+
+@pytest.mark.parametrize(
+    "name, axis",
+    [("export_softmax_bcast", -1), ("export_softmax_axis0", 0)],
+)
+def test_softmax_rank_reduced(name, axis):
+    with compile_lib("llm_tensor.spy", "llm_tensor.so") as libname:
+        lib = CDLL(libname)
+        export_function = getattr(
+            lib, f"_mlir_ciface_spy_llm_tensor$exported${name}"
+        )
+        A = np.random.random((DIM0, DIM1))
+        exp_x = np.exp(A - A.max(axis=axis, keepdims=True))
+        expected = exp_x / exp_x.sum(axis=axis, keepdims=True)
+        np.testing.assert_allclose(call_2d(export_function, A), expected)
+
+
+def test_bench_nbcc_softmax_bcast(benchmark):
+    with compile_lib("llm_tensor.spy", "llm_tensor.so") as libname:
+        lib = CDLL(libname)
+        export_function = getattr(
+            lib, "_mlir_ciface_spy_llm_tensor$exported$export_softmax_bcast"
+        )
+        memref_2d_f64 = make_nd_memref_descriptor(2, c_double)
+        A = np.random.random((DIM0, DIM1)).astype(dtype=np.float64)
+        argA = get_ranked_memref_descriptor(A)
+        out_memref = (memref_2d_f64 * 1)()
+        args = [out_memref, byref(argA)]
+        export_function(*args)
+        np.testing.assert_allclose(
+            ranked_memref_to_numpy(out_memref), golden_softmax(A)
+        )
+
+        def cleanup(*args):
+            ranked_memref_to_numpy(args[0])  # cleanup
+
+        # Requires pytest-benchmark >= 5.2.0 for teardown
+        benchmark.pedantic(
+            export_function, args=args, teardown=cleanup, **benchmark_config
+        )
+
+
+def test_softmax_into():
+    with compile_lib("llm_tensor.spy", "llm_tensor.so") as libname:
+        lib = CDLL(libname)
+        export_function = getattr(
+            lib, "_mlir_ciface_spy_llm_tensor$exported$export_into_softmax"
+        )
+        A = np.random.random((DIM0, DIM1))
+        Out = np.zeros_like(A)
+        argA = get_ranked_memref_descriptor(A)
+        argOut = get_ranked_memref_descriptor(Out)
+        # The output buffer is the last argument; nothing is returned
+        export_function(byref(argA), byref(argOut))
+        np.testing.assert_allclose(Out, golden_softmax(A))
+
+        # The same buffer is reused across calls
+        B = np.random.random((DIM0, DIM1))
+        export_function(byref(get_ranked_memref_descriptor(B)), byref(argOut))
+        np.testing.assert_allclose(Out, golden_softmax(B))
+
+
+def test_bench_nbcc_softmax_into(benchmark):
+    """Compare with test_bench_nbcc_softmax_bcast, which allocates and frees
+    the result in every call."""
+    with compile_lib("llm_tensor.spy", "llm_tensor.so") as libname:
+        lib = CDLL(libname)
+        export_function = getattr(
+            lib, "_mlir_ciface_spy_llm_tensor$exported$export_into_softmax"
+        )
+        A = np.random.random((DIM0, DIM1)).astype(dtype=np.float64)
+        Out = np.empty_like(A)
+        argA = get_ranked_memref_descriptor(A)
+        argOut = get_ranked_memref_descriptor(Out)
+        args = [byref(argA), byref(argOut)]
+        export_function(*args)
+        np.testing.assert_allclose(Out, golden_softmax(A))
+
+        benchmark.pedantic(export_function, args=args, **benchmark_config)
+
+
+@pytest.fixture(scope="module")
+def llm_tensor_bindings():
+    with compile_lib("llm_tensor.spy", "llm_tensor.so", bindings=True) as p:
+        path = bindings_path(p)
+        spec = importlib.util.spec_from_file_location(path.stem, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+
+
+def test_softmax_bindings(llm_tensor_bindings):
+    A = np.random.random((DIM0, DIM1))
+    np.testing.assert_allclose(
+        llm_tensor_bindings.export_softmax(A), golden_softmax(A)
+    )
+    Out = np.empty_like(A)
+    llm_tensor_bindings.export_into_softmax(A, Out)
+    np.testing.assert_allclose(Out, golden_softmax(A))
+    with pytest.raises(TypeError):
+        llm_tensor_bindings.export_softmax(A.astype(np.float32))
+
+
+def test_softmax_bindings_do_not_leak(llm_tensor_bindings):
+    """Results are freed through `_nbcc_dealloc`; the RSS stays flat."""
+    assert llm_tensor_bindings._lib._nbcc_dealloc
+    A = np.random.random((32, 32))
+    for _ in range(1000):
+        llm_tensor_bindings.export_softmax(A)
+    start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for _ in range(100_000):
+        llm_tensor_bindings.export_softmax(A)
+    growth_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start
+    assert growth_kb < 50_000
+
+
+# Small enough for the call overhead to dominate
+SMALL = (4, 8)
+
+
+def test_bench_call_overhead_ctypes(benchmark):
+    """The manual ctypes pattern, rebuilding the descriptors every call."""
+    with compile_lib("llm_tensor.spy", "llm_tensor.so") as libname:
+        lib = CDLL(libname)
+        A = np.random.random(SMALL)
+        Out = np.empty_like(A)
+
+        def call():
+            export_function = getattr(
+                lib, "_mlir_ciface_spy_llm_tensor$exported$export_into_softmax"
+            )
+            export_function(
+                byref(get_ranked_memref_descriptor(A)),
+                byref(get_ranked_memref_descriptor(Out)),
+            )
+
+        call()
+        np.testing.assert_allclose(Out, golden_softmax(A))
+        benchmark.pedantic(call, rounds=10000, iterations=1, warmup_rounds=10)
+
+
+def test_bench_call_overhead_bindings(benchmark, llm_tensor_bindings):
+    A = np.random.random(SMALL)
+    Out = np.empty_like(A)
+    call = llm_tensor_bindings.export_into_softmax
+    call(A, Out)
+    np.testing.assert_allclose(Out, golden_softmax(A))
+    benchmark.pedantic(
+        call, args=(A, Out), rounds=10000, iterations=1, warmup_rounds=10
+    )
+
+
+@pytest.fixture(scope="module")
+def llm_tensor_bare_ptr_bindings():
+    with compile_lib(
+        "llm_tensor.spy",
+        "llm_tensor_bare.so",
+        bindings=True,
+        bare_ptr_exports=True,
+    ) as p:
+        path = bindings_path(p)
+        spec = importlib.util.spec_from_file_location(path.stem, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+
+
+def test_bench_call_overhead_bare_ptr(benchmark, llm_tensor_bare_ptr_bindings):
+    """Compare with test_bench_call_overhead_bindings, which passes memref
+    descriptors."""
+    call = llm_tensor_bare_ptr_bindings.export_into_softmax
+    assert isinstance(call, BarePtrKernel)
+    A = np.random.random(SMALL)
+    Out = np.empty_like(A)
+    call(A, Out)
+    np.testing.assert_allclose(Out, golden_softmax(A))
+    # The C interface is still there
+    np.testing.assert_allclose(
+        llm_tensor_bare_ptr_bindings.export_softmax(A), golden_softmax(A)
+    )
+    benchmark.pedantic(
+        call, args=(A, Out), rounds=10000, iterations=1, warmup_rounds=10
+    )
+
+
+# (suffix, ctype of the memref elements, rtol)
+REDUCED_PRECISION = [
+    ("f32", c_float, 1e-5),
+    ("bf16", c_uint16, 2e-2),
+]
+
+
+def reduced_precision_args(ctype, A):
+    A = to_bf16(A) if ctype is c_uint16 else A.astype(np.float32)
+    argA = get_ranked_memref_descriptor(A)
+    out_memref = (make_nd_memref_descriptor(2, ctype) * 1)()
+    return A, [out_memref, byref(argA)]
+
+
+@pytest.mark.parametrize("suffix, ctype, rtol", REDUCED_PRECISION)
+def test_softmax_reduced_precision(suffix, ctype, rtol):
+    with compile_lib("llm_tensor.spy", "llm_tensor.so") as libname:
+        lib = CDLL(libname)
+        export_function = getattr(
+            lib,
+            f"_mlir_ciface_spy_llm_tensor$exported$export_softmax_{suffix}",
+        )
+        A = np.random.random((DIM0, DIM1))
+        A, args = reduced_precision_args(ctype, A)
+        export_function(*args)
+        output = ranked_memref_to_numpy(args[0])
+        if ctype is c_uint16:
+            output, A = from_bf16(output), from_bf16(A)
+        assert output.dtype == np.float32
+        np.testing.assert_allclose(
+            output, golden_softmax(A.astype(np.float64)), rtol=rtol
+        )
+
+
+@pytest.mark.parametrize("suffix, ctype, rtol", REDUCED_PRECISION)
+def test_bench_nbcc_softmax_reduced_precision(benchmark, suffix, ctype, rtol):
+    """Compare with test_bench_nbcc_softmax_bcast: the kernels are memory
+    bound, so the time scales with the element size."""
+    with compile_lib("llm_tensor.spy", "llm_tensor.so") as libname:
+        lib = CDLL(libname)
+        export_function = getattr(
+            lib,
+            f"_mlir_ciface_spy_llm_tensor$exported$export_softmax_{suffix}",
+        )
+        A = np.random.random((DIM0, DIM1))
+        A, args = reduced_precision_args(ctype, A)
+        export_function(*args)
+        ranked_memref_to_numpy(args[0])  # cleanup
+        benchmark.extra_info["bytes_per_element"] = A.itemsize
+
+        def cleanup(*args):
+            ranked_memref_to_numpy(args[0])  # cleanup
+
+        # Requires pytest-benchmark >= 5.2.0 for teardown
+        benchmark.pedantic(
+            export_function, args=args, teardown=cleanup, **benchmark_config
+        )
+
+
+@pytest.fixture(scope="module")
+def pool_llm_tensor_bindings():
+    with compile_lib(
+        "llm_tensor.spy", "llm_tensor_pool.so", bindings=True, allocator="pool"
+    ) as p:
+        path = bindings_path(p)
+        spec = importlib.util.spec_from_file_location(path.stem, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+
+
+def test_softmax_pool_allocator(pool_llm_tensor_bindings):
+    lib = pool_llm_tensor_bindings._lib
+    A = np.random.random((DIM0, DIM1))
+    np.testing.assert_allclose(
+        pool_llm_tensor_bindings.export_softmax(A), golden_softmax(A)
+    )
+    reset_alloc_stats(lib)
+    for _ in range(3):
+        out = pool_llm_tensor_bindings.export_softmax(A)
+        del out
+    stats = alloc_stats(lib)
+    # Every buffer, including the freed results, comes from the pool
+    assert stats.allocations > 0
+    assert stats.pool_hits == stats.allocations
+    assert stats.system_allocations == 0
+    assert stats.bytes_in_use == 0
+
+
+@pytest.mark.parametrize("allocator", ["malloc", "pool"])
+def test_bench_nbcc_softmax_allocator(
+    benchmark, allocator, llm_tensor_bindings, pool_llm_tensor_bindings
+):
+    """Allocation and release of the temporaries and the result."""
+    if allocator == "pool":
+        softmax = pool_llm_tensor_bindings.export_softmax
+    else:
+        softmax = llm_tensor_bindings.export_softmax
+    A = np.random.random((DIM0, DIM1))
+    np.testing.assert_allclose(softmax(A), golden_softmax(A))
+    benchmark.pedantic(softmax, args=(A,), **benchmark_config)
+
+
+OMP_THREADS = [1, 2, 4, 8, 16]
+
+
+@pytest.fixture(scope="module")
+def openmp_llm_tensor_module():
+    return compile_to_mlir(
+        str(example_dir / "llm_tensor.spy"), backend_options={"openmp": True}
+    )
+
+
+def test_openmp_softmax_has_parallel_loops(openmp_llm_tensor_module):
+    assert uses_openmp(openmp_llm_tensor_module)
+    assert "spy_llm_tensor$exported$export_softmax" in openmp_functions(
+        openmp_llm_tensor_module
+    )
+
+
+@pytest.fixture(scope="module")
+def openmp_llm_tensor_lib(openmp_llm_tensor_module):
+    # Otherwise every thread count below runs the same serial code
+    assert "spy_llm_tensor$exported$export_softmax" in openmp_functions(
+        openmp_llm_tensor_module
+    )
+    with make_temp_directory() as dir:
+        outpath = dir / "llm_tensor_omp.so"
+        make_shared(openmp_llm_tensor_module, str(outpath))
+        yield CDLL(outpath)
+
+
+@pytest.mark.parametrize("num_threads", OMP_THREADS)
+def test_bench_nbcc_softmax_openmp(
+    benchmark, openmp_llm_tensor_lib, num_threads
+):
+    export_function = getattr(
+        openmp_llm_tensor_lib,
+        "_mlir_ciface_spy_llm_tensor$exported$export_softmax",
+    )
+    set_omp_num_threads(num_threads)
+
+    memref_2d_f64 = make_nd_memref_descriptor(2, c_double)
+    A = np.random.random((DIM0, DIM1)).astype(dtype=np.float64)
+    argA = get_ranked_memref_descriptor(A)
+    out_memref = (memref_2d_f64 * 1)()
+    args = [out_memref, byref(argA)]
+    export_function(*args)
+
+    output = ranked_memref_to_numpy(out_memref)
+    np.testing.assert_allclose(output, golden_softmax(A))
+
+    def cleanup(*args):
+        ranked_memref_to_numpy(args[0])  # cleanup
+
+    # Requires pytest-benchmark >= 5.2.0 for teardown
+    benchmark.pedantic(
+        export_function, args=args, teardown=cleanup, **benchmark_config
+    )
@@ -0,0 +1,23 @@
+import os.path
+import warnings
+from pathlib import Path
+
+import pytest
+
+import nbcc
+from nbcc.compiler import compile_to_mlir
+
+example_dir = Path(os.path.dirname(nbcc.__file__)) / ".." / "examples"
+
+
+@pytest.mark.parametrize(
+    "filename", ["e2e/e2e_ifelse.spy", "e2e/e2e_class.spy", "llm_tensor.spy"]
+)
+def test_parallel_middle_end_matches_serial(filename):
+    path = str(example_dir / filename)
+    serial = compile_to_mlir(path, jobs=1)
+    # The fallback to serial warns; make it fail the test instead
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        parallel = compile_to_mlir(path, jobs=2)
+    assert parallel.operation.get_asm() == serial.operation.get_asm()
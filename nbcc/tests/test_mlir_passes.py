@@ -0,0 +1,86 @@
+import shutil
+
+import pytest
+from mlir import ir
+
+from nbcc.mlir_backend import mlir_passes as mp
+
+SOURCE = """
+func.func @f(%arg0: i32) -> i32 {
+  %c0 = arith.constant 0 : i32
+  %0 = arith.addi %arg0, %c0 : i32
+  %1 = arith.addi %0, %c0 : i32
+  return %1 : i32
+}
+"""
+
+
+def _parse(context):
+    return ir.Module.parse(SOURCE, context=context)
+
+
+def test_in_process_runs_on_live_module():
+    with ir.Context() as context:
+        module = _parse(context)
+        pm = mp.PassManager([mp.Canonicalize()], snapshot=True)
+        out = pm.run(module)
+        assert out is module
+        assert "arith.addi" not in str(module)
+        # The snapshot holds the IR before the passes ran
+        assert "arith.addi" in str(pm.get_snapshot())
+
+
+@pytest.mark.skipif(
+    shutil.which("mlir-opt") is None, reason="mlir-opt not available"
+)
+def test_in_process_matches_subprocess():
+    with ir.Context() as context:
+        passes = [mp.Canonicalize(), mp.CSE(), mp.LowerAffine()]
+        expected = mp.PassManager(passes, with_subprocess=True).run(
+            _parse(context)
+        )
+        got = mp.PassManager(passes).run(_parse(context))
+        assert str(got) == str(expected)
+
+
+def test_module_pipeline_nests_function_passes():
+    pipeline = mp.module_pipeline(
+        mp.Canonicalize(),
+        mp.LowerAffine(),
+        mp.BufferHoisting(),
+        mp.BufferLoopHoisting(),
+        mp.CSE(),
+        mp.PromoteBuffersToStack(),
+    )
+    assert pipeline == (
+        "builtin.module(canonicalize{},"
+        "func.func(lower-affine{},buffer-hoisting{},buffer-loop-hoisting{}),"
+        "cse{},"
+        "func.func(promote-buffers-to-stack{}))"
+    )
+
+
+PARALLEL_SOURCE = """
+func.func @scale(%arg0: memref<?xf64>, %n: index) {
+  %c0 = arith.constant 0 : index
+  %c1 = arith.constant 1 : index
+  %cst = arith.constant 2.0 : f64
+  scf.parallel (%i) = (%c0) to (%n) step (%c1) {
+    %v = memref.load %arg0[%i] : memref<?xf64>
+    %w = arith.mulf %v, %cst : f64
+    memref.store %w, %arg0[%i] : memref<?xf64>
+    scf.reduce
+  }
+  return
+}
+"""
+
+
+def test_scf_parallel_to_openmp():
+    with ir.Context() as context:
+        module = ir.Module.parse(PARALLEL_SOURCE, context=context)
+        mp.PassManager([mp.ConvertSCFToOpenMP(num_threads=4)]).run(module)
+        asm = str(module)
+        assert "scf.parallel" not in asm
+        assert "omp.parallel num_threads" in asm
+        assert "omp.wsloop" in asm
@@ -2,11 +2,12 @@ import os
 import os.path
 import tempfile
 from contextlib import contextmanager
-from ctypes import CDLL, byref, c_double
+from ctypes import CDLL, byref, c_double, c_float, c_uint16
 from pathlib import Path
 from typing import Generator
 
 import numpy as np
+import pytest
 from mlir.runtime import (
     get_ranked_memref_descriptor,
     make_nd_memref_descriptor,
@@ -14,8 +15,9 @@ from mlir.runtime import (
 )
 
 import nbcc
-from nbcc.compiler import compile_shared_lib
-
+from nbcc.compiler import compile_shared_lib, compile_to_mlir, make_shared
+from nbcc.tests import from_bf16, openmp_functions, to_bf16
+from nbcc.toolchain import set_omp_num_threads
 
 example_dir = Path(os.path.dirname(nbcc.__file__)) / ".." / "examples"
 
@@ -27,12 +29,16 @@ def make_temp_directory() -> Generator[Path, None, None]:
 
 
 @contextmanager
-def compile_lib(filename: str, libname: str) -> Generator[Path, None, None]:
+def compile_lib(
+    filename: str, libname: str, **backend_options
+) -> Generator[Path, None, None]:
     path = example_dir / filename
     assert path.exists()
     with make_temp_directory() as dir:
         outpath = dir / libname
-        compile_shared_lib(str(path), str(outpath))
+        compile_shared_lib(
+            str(path), str(outpath), backend_options=backend_options
+        )
         yield outpath
 
 
@@ -334,3 +340,127 @@ def test_bench_mlir_tensor_lib_arrayexpr_out(benchmark):
         np.testing.assert_allclose(Out, (A + B) * (C + A))
 
         benchmark.pedantic(func, args=args, **benchmark_config)
+
+
+def test_mlir_tensor_lib_add_f32():
+    with compile_lib("mlir_tensor_lib.spy", "lib_mlir_tensor.so") as libname:
+        lib = CDLL(libname)
+        func = getattr(
+            lib,
+            "_mlir_ciface_spy_mlir_tensor_lib$exported$export_tensor_f32_add",
+        )
+        A = np.arange(NELEM, dtype=np.float32) / NELEM
+        B = np.arange(NELEM, dtype=np.float32) / NELEM
+        argA = get_ranked_memref_descriptor(A)
+        argB = get_ranked_memref_descriptor(B)
+        out_memref = (make_nd_memref_descriptor(1, c_float) * 1)()
+        func(out_memref, byref(argA), byref(argB))
+
+        output = ranked_memref_to_numpy(out_memref)
+        assert output.dtype == np.float32
+        np.testing.assert_allclose(output, A + B)
+
+
+def test_mlir_tensor_lib_add_bf16():
+    with compile_lib("mlir_tensor_lib.spy", "lib_mlir_tensor.so") as libname:
+        lib = CDLL(libname)
+        func = getattr(
+            lib,
+            "_mlir_ciface_spy_mlir_tensor_lib$exported$export_tensor_bf16_add",
+        )
+        A = to_bf16(np.arange(NELEM, dtype=np.float32) / NELEM)
+        B = to_bf16(np.arange(NELEM, dtype=np.float32) / NELEM)
+        argA = get_ranked_memref_descriptor(A)
+        argB = get_ranked_memref_descriptor(B)
+        out_memref = (make_nd_memref_descriptor(1, c_uint16) * 1)()
+        func(out_memref, byref(argA), byref(argB))
+
+        output = from_bf16(ranked_memref_to_numpy(out_memref))
+        np.testing.assert_allclose(
+            output, from_bf16(A) + from_bf16(B), rtol=1e-2
+        )
+
+
+@pytest.mark.parametrize("dtype", ["f64", "f32", "bf16"])
+def test_bench_mlir_tensor_lib_arrayexpr_out_dtype(benchmark, dtype):
+    """The kernel is memory bound: compare the time per element size."""
+    with compile_lib("mlir_tensor_lib.spy", "lib_mlir_tensor.so") as libname:
+        lib = CDLL(libname)
+        func = getattr(
+            lib,
+            "_mlir_ciface_spy_mlir_tensor_lib$exported$"
+            f"export_tensor_{dtype}_arrayexpr_out",
+        )
+        values = np.arange(NELEM, dtype=np.float64) / NELEM
+        if dtype == "bf16":
+            A, B, C = (to_bf16(values) for _ in range(3))
+            Out = np.zeros(NELEM, dtype=np.uint16)
+        else:
+            npdtype = np.float64 if dtype == "f64" else np.float32
+            A, B, C = (values.astype(npdtype) for _ in range(3))
+            Out = np.zeros(NELEM, dtype=npdtype)
+
+        argA = get_ranked_memref_descriptor(A)
+        argB = get_ranked_memref_descriptor(B)
+        argC = get_ranked_memref_descriptor(C)
+        argOut = get_ranked_memref_descriptor(Out)
+
+        args = [byref(argA), byref(argB), byref(argC), byref(argOut)]
+        func(*args)
+        if dtype == "bf16":
+            a, b, c = from_bf16(A), from_bf16(B), from_bf16(C)
+            np.testing.assert_allclose(
+                from_bf16(Out), (a + b) * (c + a), rtol=2e-2
+            )
+        else:
+            np.testing.assert_allclose(Out, (A + B) * (C + A), rtol=1e-6)
+        benchmark.extra_info["bytes_per_element"] = Out.itemsize
+
+        benchmark.pedantic(func, args=args, **benchmark_config)
+
+
+OMP_THREADS = [1, 2, 4, 8, 16]
+
+
+@pytest.fixture(scope="module")
+def openmp_tensor_lib():
+    module = compile_to_mlir(
+        str(example_dir / "mlir_tensor_lib.spy"),
+        backend_options={"openmp": True},
+    )
+    # Otherwise every thread count below runs the same serial code
+    assert (
+        "spy_mlir_tensor_lib$exported$export_tensor_f64_arrayexpr_out"
+        in openmp_functions(module)
+    )
+    with make_temp_directory() as dir:
+        outpath = dir / "lib_mlir_tensor_omp.so"
+        make_shared(module, str(outpath))
+        yield CDLL(outpath)
+
+
+@pytest.mark.parametrize("num_threads", OMP_THREADS)
+def test_bench_mlir_tensor_lib_arrayexpr_out_openmp(
+    benchmark, openmp_tensor_lib, num_threads
+):
+    func = getattr(
+        openmp_tensor_lib,
+        "_mlir_ciface_spy_mlir_tensor_lib$exported$export_tensor_f64_arrayexpr_out",
+    )
+    set_omp_num_threads(num_threads)
+
+    A = np.arange(NELEM, dtype=np.float64) / NELEM
+    B = np.arange(NELEM, dtype=np.float64) / NELEM
+    C = np.arange(NELEM, dtype=np.float64) / NELEM
+    Out = np.zeros(NELEM, dtype=np.float64)
+
+    argA = get_ranked_memref_descriptor(A)
+    argB = get_ranked_memref_descriptor(B)
+    argC = get_ranked_memref_descriptor(C)
+    argOut = get_ranked_memref_descriptor(Out)
+
+    args = [byref(argA), byref(argB), byref(argC), byref(argOut)]
+    func(*args)
+    np.testing.assert_allclose(Out, (A + B) * (C + A))
+
+    benchmark.pedantic(func, args=args, **benchmark_config)
@@ -0,0 +1,60 @@
+import json
+import sys
+
+from nbcc import profiling
+from nbcc.profiling import CompileStats, collect, stage
+
+
+def test_stage_is_noop_without_stats():
+    assert profiling.active_stats() is None
+    with stage("unused"):
+        pass
+    assert profiling.active_stats() is None
+
+
+def test_nested_stages():
+    stats = CompileStats()
+    with collect(stats):
+        with stage("outer"):
+            for fn in ["f", "g"]:
+                with stage("inner", fn=fn):
+                    sum(range(10000))
+    assert profiling.active_stats() is None
+
+    names = [(r.name, r.depth) for r in stats.records]
+    assert names == [("inner", 1), ("inner", 1), ("outer", 0)]
+    assert [r.args for r in stats.records[:2]] == [{"fn": "f"}, {"fn": "g"}]
+    outer = stats.records[-1]
+    assert outer.wall >= sum(r.wall for r in stats.records[:2])
+    assert outer.peak_rss > 0
+
+    [outer_row, inner_row] = sorted(
+        stats.summary(), key=lambda row: row["depth"]
+    )
+    assert inner_row["count"] == 2
+    assert "inner" in stats.format()
+
+
+def test_subprocess_stage():
+    stats = CompileStats()
+    with collect(stats):
+        profiling.check_call([sys.executable, "-c", "sum(range(10**6))"])
+    [rec] = stats.records
+    assert rec.category == "subprocess"
+    assert rec.name.startswith("python")
+    assert rec.cpu > 0
+    assert stats.commands() == [rec.args["cmd"]]
+    assert rec.args["cmd"] in stats.format()
+
+
+def test_chrome_trace(tmp_path):
+    stats = CompileStats()
+    with collect(stats), stage("compile", fn="main"):
+        pass
+    path = tmp_path / "trace.json"
+    stats.write_chrome_trace(path)
+    [event] = json.loads(path.read_text())["traceEvents"]
+    assert event["ph"] == "X"
+    assert event["name"] == "compile"
+    assert event["args"]["fn"] == "main"
+    assert {"ts", "dur", "pid", "tid"} <= event.keys()
@@ -0,0 +1,95 @@
+import importlib
+import os
+from pathlib import Path
+
+import pytest
+from sealir.rvsdg import format_rvsdg
+
+import nbcc
+from nbcc.frontend import frontend, redshifted
+from nbcc.frontend.frontend import redshift, redshift_key
+from nbcc.frontend.spy_ast import Node
+from nbcc.profiling import CompileStats, collect
+
+examples_dir = Path(os.path.dirname(nbcc.__file__)) / ".." / "examples"
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("NBCC_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("NBCC_DISABLE_CACHE", raising=False)
+
+
+def _summary(tu):
+    return {
+        fqn.fullname: (
+            fi.ast_hash,
+            format_rvsdg(fi.region),
+            len(fi.metadata),
+        )
+        for fqn in tu.list_functions()
+        for fi in [tu.get_function(fqn)]
+    }
+
+
+@pytest.mark.parametrize(
+    "source", ["e2e/e2e_class.spy", "e2e/e2e_loops.spy", "llm_tensor.spy"]
+)
+def test_warm_frontend_skips_vm(monkeypatch, source):
+    path = str(examples_dir / source)
+    cold = frontend(path)
+
+    def no_vm():
+        raise AssertionError("the VM was created on a warm compile")
+
+    # `nbcc.frontend.frontend` is the function; get the module
+    module = importlib.import_module("nbcc.frontend.frontend")
+    monkeypatch.setattr(module, "_new_vm", no_vm)
+    stats = CompileStats()
+    with collect(stats):
+        warm = frontend(path)
+    assert stats.total("redshift_cache_load") > 0
+    assert _summary(warm) == _summary(cold)
+    assert list(warm._structs) == list(cold._structs)
+    assert list(warm.list_builtins()) == list(cold.list_builtins())
+
+
+def test_key_depends_on_imports(tmp_path):
+    main = tmp_path / "main.spy"
+    main.write_text("from helper import f\n")
+    helper = tmp_path / "helper.spy"
+    helper.write_text("def f() -> i32:\n    return 1\n")
+    before = redshift_key(main)
+    assert redshift_key(main) == before
+    helper.write_text("def f() -> i32:\n    return 2\n")
+    assert redshift_key(main) != before
+
+
+def test_disabled_cache_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.setenv("NBCC_DISABLE_CACHE", "1")
+    frontend(str(examples_dir / "e2e" / "e2e_class.spy"))
+    assert not (tmp_path / "cache" / "artifacts").exists()
+
+
+def test_dump_rejects_vm_objects(tmp_path):
+    vm, w_mod = redshift(examples_dir / "e2e" / "e2e_class.spy")
+    mod = redshifted.snapshot(vm, w_mod)
+    path = tmp_path / "mod.pickle"
+    redshifted.dump(mod, path)
+    loaded = redshifted.load(path)
+    assert [fn.fqn for fn in loaded.functions] == [
+        fn.fqn for fn in mod.functions
+    ]
+
+    # A literal holding a VM object
+    fn = mod.functions[0]
+    fn.node._attrdict["extra"] = Node("literal", {"value": w_mod})
+    with pytest.raises(redshifted.UnserializableError):
+        redshifted.dump(mod, path)
+
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path / "garbage"
+    path.write_bytes(b"not a pickle")
+    with pytest.raises(ValueError):
+        redshifted.load(path)
@@ -0,0 +1,146 @@
+import ctypes
+import shutil
+
+import numpy as np
+import pytest
+
+from nbcc.runtime import (
+    AllocStats,
+    alloc_stats,
+    compile_allocator,
+    reset_alloc_stats,
+    trim_pool,
+)
+
+MiB = 1 << 20
+
+
+@pytest.fixture
+def allocator(tmp_path):
+    """A fresh instance of the pool, with the allocation functions
+    exported."""
+    cc = shutil.which("cc") or shutil.which("clang")
+    if cc is None:
+        pytest.skip("no C compiler")
+    lib = ctypes.CDLL(
+        str(compile_allocator(tmp_path / "alloc.so", shared=True, cc=cc))
+    )
+    lib._mlir_memref_to_llvm_alloc.argtypes = [ctypes.c_size_t]
+    lib._mlir_memref_to_llvm_alloc.restype = ctypes.c_void_p
+    lib._mlir_memref_to_llvm_aligned_alloc.argtypes = [
+        ctypes.c_size_t,
+        ctypes.c_size_t,
+    ]
+    lib._mlir_memref_to_llvm_aligned_alloc.restype = ctypes.c_void_p
+    lib._mlir_memref_to_llvm_free.argtypes = [ctypes.c_void_p]
+    lib._mlir_memref_to_llvm_free.restype = None
+    return lib
+
+
+def _fill(ptr, size):
+    buf = np.ctypeslib.as_array((ctypes.c_uint8 * size).from_address(ptr))
+    buf[:] = 7
+    assert buf.sum() == 7 * size
+
+
+def test_freed_blocks_are_reused(allocator):
+    alloc = allocator._mlir_memref_to_llvm_alloc
+    free = allocator._mlir_memref_to_llvm_free
+    p = alloc(1000)
+    assert p % 64 == 0
+    _fill(p, 1000)
+    free(p)
+    # Same size class
+    assert alloc(900) == p
+    stats = alloc_stats(allocator)
+    assert stats.allocations == 2
+    assert stats.frees == 1
+    assert stats.pool_hits == 1
+    assert stats.system_allocations == 1
+    # 900 and 1000 bytes round up to the 1024-byte class
+    assert stats.bytes_in_use == 1024
+    assert stats.bytes_cached == 0
+    free(p)
+    assert alloc(2000) != p
+
+
+def test_trim_and_reset(allocator):
+    alloc = allocator._mlir_memref_to_llvm_alloc
+    free = allocator._mlir_memref_to_llvm_free
+    ptrs = [alloc(n * 100) for n in range(1, 50)]
+    for p in ptrs:
+        free(p)
+    stats = alloc_stats(allocator)
+    assert stats.bytes_in_use == 0
+    assert stats.peak_bytes_in_use > 0
+    assert stats.bytes_cached > 0
+    trim_pool(allocator)
+    stats = alloc_stats(allocator)
+    assert stats.bytes_cached == 0
+    assert stats.system_frees == stats.system_allocations
+    reset_alloc_stats(allocator)
+    assert alloc_stats(allocator) == AllocStats(*[0] * 9)
+
+
+def test_cache_limit(allocator, monkeypatch):
+    # Read at the first allocation of the library
+    monkeypatch.setenv("NBCC_POOL_CACHE_LIMIT", str(4 * MiB))
+    alloc = allocator._mlir_memref_to_llvm_alloc
+    free = allocator._mlir_memref_to_llvm_free
+    ptrs = [alloc(3 * MiB) for _ in range(3)]
+    for p in ptrs:
+        free(p)
+    stats = alloc_stats(allocator)
+    assert stats.bytes_cached == 3 * MiB
+    assert stats.system_frees == 2
+
+
+def test_aligned_alloc(allocator):
+    p = allocator._mlir_memref_to_llvm_aligned_alloc(4096, 10000)
+    assert p % 4096 == 0
+    _fill(p, 10000)
+    allocator._mlir_memref_to_llvm_free(p)
+    stats = alloc_stats(allocator)
+    assert stats.frees == stats.system_frees == 1
+
+
+def test_huge_pages(allocator, monkeypatch):
+    monkeypatch.setenv("NBCC_HUGE_PAGES", "1")
+    alloc = allocator._mlir_memref_to_llvm_alloc
+    free = allocator._mlir_memref_to_llvm_free
+    small = alloc(MiB)
+    large = alloc(5 * MiB)
+    _fill(large, 5 * MiB)
+    free(small)
+    free(large)
+    stats = alloc_stats(allocator)
+    assert stats.huge_page_allocations == 1
+    # Mapped blocks are pooled like the others
+    assert alloc(5 * MiB) == large
+    trim_pool(allocator)
+
+
+def test_oversized_requests_are_not_pooled(allocator):
+    alloc = allocator._mlir_memref_to_llvm_alloc
+    # Beyond the largest size class; malloc fails
+    for size in [(1 << 48) + 1, 1 << 63, 2**64 - 1]:
+        assert alloc(size) is None
+    stats = alloc_stats(allocator)
+    assert stats.allocations == 3
+    assert stats.system_allocations == stats.bytes_in_use == 0
+    # The last size class
+    if p := alloc(1 << 48):
+        allocator._mlir_memref_to_llvm_free(p)
+    p = alloc(1000)
+    allocator._mlir_memref_to_llvm_free(p)
+    assert alloc(1000) == p
+
+
+def test_library_without_pool():
+    with pytest.raises(ValueError, match="pool allocator"):
+        alloc_stats(ctypes.CDLL(None))
+
+
+def test_stats_format():
+    text = AllocStats(*range(9)).format()
+    assert text.splitlines()[2] == "pool_hits              2"
@@ -0,0 +1,160 @@
+import io
+import os
+import socket
+import subprocess as subp
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+from pathlib import Path
+
+import pytest
+from click.testing import CliRunner
+
+import nbcc
+import nbcc.server
+from nbcc import profiling
+from nbcc.cli import cli
+from nbcc.server import (
+    CompileServer,
+    ServerError,
+    is_server_running,
+    run_on_server,
+    server_request,
+)
+
+example_dir = Path(os.path.dirname(nbcc.__file__)) / ".." / "examples"
+
+
+@contextmanager
+def running_server(socket_path, workers=1):
+    server = CompileServer(socket_path, workers=workers)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+
+def test_no_server(tmp_path):
+    path = tmp_path / "none.sock"
+    assert run_on_server(["shared", "a.spy", "a.so"], path) is None
+    assert not is_server_running(path)
+
+
+def test_ping_and_shutdown(tmp_path):
+    path = tmp_path / "s.sock"
+    server = CompileServer(path, workers=2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    assert server_request({"op": "ping"}, path) == {
+        "pid": os.getpid(),
+        "workers": 2,
+    }
+    with pytest.raises(ServerError, match="already running"):
+        CompileServer(path)
+    with pytest.raises(ServerError, match="unknown request"):
+        server_request({"op": "bogus"}, path)
+    assert server_request({"op": "shutdown"}, path) == {}
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    server.server_close()
+    assert not path.exists()
+
+
+def test_stale_socket(tmp_path):
+    path = tmp_path / "s.sock"
+    # Left over by a killed server
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(path))
+    stale.close()
+    assert path.exists()
+    with running_server(path):
+        assert is_server_running(path)
+
+
+TOOL = """
+import sys
+print("out")
+sys.stderr.write("error: bad input\\n")
+sys.exit(1)
+"""
+
+
+def test_worker_relays_tool_output(monkeypatch):
+    monkeypatch.setattr(nbcc.server, "_in_worker", True)
+    out, err = io.StringIO(), io.StringIO()
+    with redirect_stdout(out), redirect_stderr(err):
+        with pytest.raises(subp.CalledProcessError):
+            profiling.check_call([sys.executable, "-c", TOOL])
+        with pytest.raises(subp.CalledProcessError):
+            profiling.check_output([sys.executable, "-c", TOOL])
+    assert out.getvalue() == "out\n"
+    assert err.getvalue() == "error: bad input\n" * 2
+
+
+def _crash_or_echo(argv, cwd, env):
+    if argv == ["crash"]:
+        os._exit(1)
+    return 0, " ".join(argv), ""
+
+
+def test_server_replaces_dead_workers(tmp_path, monkeypatch):
+    from concurrent.futures import ProcessPoolExecutor
+
+    # Without the compiler in the workers
+    monkeypatch.setattr(
+        CompileServer, "_new_pool", lambda self: ProcessPoolExecutor(1)
+    )
+    monkeypatch.setattr(nbcc.server, "_run_command", _crash_or_echo)
+    path = tmp_path / "s.sock"
+    with running_server(path):
+        with pytest.raises(ServerError, match="BrokenProcessPool"):
+            run_on_server(["crash"], path)
+        result = run_on_server(["shared", "a.spy", "a.so"], path)
+        assert result.exit_code == 0
+        assert result.stdout == "shared a.spy a.so"
+
+
+def test_cli_falls_back_when_server_fails(monkeypatch):
+    def fail(argv):
+        raise ServerError("BrokenProcessPool: worker died")
+
+    monkeypatch.setattr(cli, "run_on_server", fail)
+    argv = ["shared", "missing.spy", "a.so"]
+    with pytest.warns(RuntimeWarning, match="compiling in-process"):
+        result = CliRunner().invoke(cli.main, argv)
+    # Compiled in-process, which rejects the missing source
+    assert result.exit_code == 2
+    assert "missing.spy" in result.output
+
+    result = CliRunner().invoke(cli.main, ["--server", *argv])
+    assert result.exit_code == 1
+    assert "worker died" in result.output
+
+
+def test_compile_on_server(tmp_path, monkeypatch):
+    source = str(example_dir / "llm_tensor.spy")
+    path = tmp_path / "s.sock"
+    monkeypatch.chdir(tmp_path)
+    with running_server(path, workers=2):
+        argv = ["--release", "shared", "--no-cache", source]
+        with ThreadPoolExecutor(2) as pool:
+            results = list(
+                pool.map(
+                    lambda out: run_on_server([*argv, out], path),
+                    ["a.so", "b.so"],
+                )
+            )
+        for result in results:
+            assert result.exit_code == 0, result.stderr
+        # Relative to the working directory of the client
+        assert (tmp_path / "a.so").exists()
+        assert (tmp_path / "b.so").exists()
+
+        result = run_on_server(["shared", "missing.spy", "c.so"], path)
+        assert result.exit_code == 2
+        assert "missing.spy" in result.stderr
@@ -0,0 +1,101 @@
+import os
+import subprocess as subp
+import sys
+import textwrap
+
+# Imported only by the commands that compile
+HEAVY_MODULES = (
+    "mlir",
+    "spy",
+    "sealir",
+    "egglog",
+    "numba_scfg",
+    "numpy",
+    "nbcc.middle_end",
+    "nbcc.frontend",
+    "nbcc.mlir_backend.backend",
+    "nbcc.cutile_backend",
+)
+
+# Cumulative import time of the CLI, in seconds. Generous: it guards
+# against the compiler being imported again, which takes several seconds.
+CLI_IMPORT_BUDGET = 0.5
+
+
+def import_times(args, env=None):
+    """Run Python with `-X importtime` and return the exit code and the
+    cumulative import time of every module, in seconds."""
+    proc = subp.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        encoding="utf8",
+        env={**os.environ, **(env or {})},
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line.removeprefix("import time:").split("|")
+        # Skip the header
+        if fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1]) / 1e6
+    return proc.returncode, times
+
+
+def heavy_imports(times, allowed=()):
+    return sorted(
+        name
+        for name in times
+        if any(
+            name == heavy or name.startswith(heavy + ".")
+            for heavy in HEAVY_MODULES
+            if heavy not in allowed
+        )
+    )
+
+
+def test_help_is_light():
+    code, times = import_times(["-m", "nbcc.cli", "--help"])
+    assert code == 0
+    assert heavy_imports(times) == []
+    assert times["nbcc.cli"] < CLI_IMPORT_BUDGET
+
+
+def test_bad_arguments_are_light():
+    code, times = import_times(["-m", "nbcc.cli", "shared", "missing.spy"])
+    assert code == 2
+    assert heavy_imports(times) == []
+
+
+def test_cache_hit_is_light(tmp_path):
+    source = tmp_path / "k.spy"
+    source.write_text("def main() -> None:\n    pass\n")
+    out = tmp_path / "k.so"
+    script = textwrap.dedent(f"""
+        import sys
+        from pathlib import Path
+        from nbcc.cache import ArtifactCache
+        from nbcc.compiler import artifact_key, compile_shared_lib
+
+        artifact = Path({str(tmp_path)!r}) / "cached.so"
+        artifact.write_bytes(b"artifact")
+        key = artifact_key({str(source)!r}, "shared")
+        ArtifactCache().store(key, artifact, metadata={{"exports": []}})
+        compile_shared_lib({str(source)!r}, {str(out)!r}, bindings=True)
+        """)
+    code, times = import_times(
+        ["-c", script], env={"NBCC_CACHE_DIR": str(tmp_path / "cache")}
+    )
+    assert code == 0
+    assert out.read_bytes() == b"artifact"
+    # Writing the bindings imports NumPy
+    assert heavy_imports(times, allowed=("numpy",)) == []
+
+
+def test_bench_cli_startup(benchmark):
+    def run():
+        subp.check_call(
+            [sys.executable, "-m", "nbcc.cli", "--help"], stdout=subp.DEVNULL
+        )
+
+    benchmark.pedantic(run, rounds=10, iterations=1, warmup_rounds=1)
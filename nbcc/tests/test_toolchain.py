@@ -0,0 +1,62 @@
+import subprocess as subp
+
+import pytest
+from mlir import ir
+
+from nbcc.compiler import compile
+from nbcc.profiling import CompileStats
+from nbcc.tests.test_e2e import e2e_dir
+from nbcc.toolchain import Toolchain, ToolchainOptions
+
+
+def test_invalid_opt_level():
+    with pytest.raises(ValueError, match="opt_level"):
+        ToolchainOptions(opt_level=4)
+
+
+def test_cache_key_distinguishes_options():
+    keys = {
+        repr(ToolchainOptions().cache_key()),
+        repr(ToolchainOptions(opt_level=0).cache_key()),
+        repr(ToolchainOptions(fast_math=True).cache_key()),
+        repr(ToolchainOptions(target_cpu="skylake").cache_key()),
+    }
+    assert len(keys) == 4
+
+
+@pytest.mark.parametrize("opt_level", [0, 3])
+def test_compile_report_lists_tools(tmp_path, opt_level):
+    outpath = tmp_path / "a.out"
+    stats = CompileStats()
+    compile(
+        str(e2e_dir / "e2e_ifelse.spy"),
+        str(outpath),
+        use_cache=False,
+        stats=stats,
+        toolchain=ToolchainOptions(opt_level=opt_level),
+    )
+    tools = [cmd.split()[0] for cmd in stats.commands()]
+    assert tools[-4:] == ["mlir-translate", "opt", "llc", "clang"]
+    assert f"-passes=default<O{opt_level}>" in stats.format()
+    assert subp.check_output([str(outpath)], encoding="utf8").endswith("389\n")
+
+
+SUM = """
+llvm.func @sum(%arg0: f64, %arg1: f64, %arg2: f64) -> f64 {
+  %0 = llvm.fadd %arg0, %arg1 : f64
+  %1 = llvm.fadd %0, %arg2 : f64
+  llvm.return %1 : f64
+}
+"""
+
+
+@pytest.mark.parametrize("fast_math", [False, True])
+def test_fast_math_flags_reach_opt(tmp_path, fast_math):
+    with ir.Context():
+        module = ir.Module.parse(SUM)
+        toolchain = Toolchain(ToolchainOptions(fast_math=fast_math))
+        ll_file = toolchain.translate(module, tmp_path)
+        optimized = toolchain.optimize(ll_file, tmp_path).read_text()
+        # The module is left as is
+        assert "fastmath" not in str(module)
+    assert ("fadd fast double" in optimized) == fast_math
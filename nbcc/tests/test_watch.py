@@ -0,0 +1,173 @@
+import subprocess as subp
+from dataclasses import dataclass
+
+import pytest
+
+from nbcc.profiling import CompileStats
+from nbcc.watch import IncrementalBuilder, RebuildReport, function_keys, watch
+
+
+@dataclass(frozen=True)
+class FakeFunction:
+    ast_hash: str
+    callees: frozenset[str] = frozenset()
+
+
+class FakeUnit:
+    def __init__(self, **functions: FakeFunction):
+        self._functions = functions
+        self._structs = {}
+
+    def list_functions(self):
+        return list(self._functions)
+
+    def get_function(self, fqn):
+        return self._functions[fqn]
+
+
+def test_function_keys_propagate_to_callers():
+    before = function_keys(
+        FakeUnit(
+            leaf=FakeFunction("1"),
+            other=FakeFunction("2"),
+            main=FakeFunction("3", frozenset(["leaf", "builtins::print"])),
+        )
+    )
+    after = function_keys(
+        FakeUnit(
+            leaf=FakeFunction("changed"),
+            other=FakeFunction("2"),
+            main=FakeFunction("3", frozenset(["leaf", "builtins::print"])),
+        )
+    )
+    assert list(after) == ["leaf", "other", "main"]
+    assert after["leaf"] != before["leaf"]
+    assert after["main"] != before["main"]
+    assert after["other"] == before["other"]
+
+
+def test_function_keys_with_recursion():
+    keys = function_keys(
+        FakeUnit(
+            even=FakeFunction("1", frozenset(["odd"])),
+            odd=FakeFunction("2", frozenset(["even"])),
+        )
+    )
+    assert len(set(keys.values())) == 2
+
+
+def test_report_format():
+    stats = CompileStats()
+    with stats.stage("frontend"):
+        pass
+    report = RebuildReport(
+        seconds=0.25,
+        functions=5,
+        recompiled=["m::f", "m::main"],
+        linked=True,
+        stats=stats,
+    )
+    assert report.reused == 3
+    text = report.format()
+    assert text.startswith("rebuilt in 250 ms: 2 function(s) recompiled")
+    assert "frontend" in text
+    assert "toolchain" not in text
+
+
+class StopWatching(Exception):
+    pass
+
+
+class FakeBuilder:
+    def __init__(self, source, failures=0, checks=3):
+        self.source = source
+        self.failures = failures
+        self.checks = checks
+        self.builds = 0
+
+    def sources(self):
+        self.checks -= 1
+        if self.checks < 0:
+            raise StopWatching
+        return [self.source]
+
+    def build(self):
+        self.builds += 1
+        if self.failures:
+            self.failures -= 1
+            raise ValueError("bad source")
+        return RebuildReport(0.1, 1, [], True, CompileStats())
+
+
+def test_watch_rebuilds_on_change(tmp_path):
+    source = tmp_path / "main.spy"
+    source.write_text("")
+    builder = FakeBuilder(source, failures=1)
+    messages = []
+    with pytest.raises(StopWatching):
+        watch(builder, interval=0, echo=messages.append)
+    # The failure is reported, and there is nothing to do until the source
+    # changes
+    assert builder.builds == 1
+    assert messages == ["build failed: ValueError: bad source"]
+
+
+def test_watch_once(tmp_path):
+    source = tmp_path / "main.spy"
+    source.write_text("")
+    messages = []
+    watch(FakeBuilder(source), once=True, echo=messages.append)
+    assert len(messages) == 1
+    with pytest.raises(ValueError):
+        watch(FakeBuilder(source, failures=1), once=True)
+
+
+PROGRAM = """
+def add(a: i32, b: i32) -> i32:
+    return a + b
+
+
+def scale(a: i32) -> i32:
+    return a * {factor}
+
+
+def main() -> int:
+    print(add(1, 2))
+    print(scale(5))
+    return 0
+"""
+
+
+def test_incremental_rebuild(tmp_path, monkeypatch):
+    monkeypatch.setenv("NBCC_CACHE_DIR", str(tmp_path / "cache"))
+    source = tmp_path / "prog.spy"
+    out = tmp_path / "prog"
+    builder = IncrementalBuilder(source, out, kind="binary")
+
+    source.write_text(PROGRAM.format(factor=2))
+    report = builder.build()
+    assert len(report.recompiled) == report.functions == 3
+    assert subp.check_output([str(out)], encoding="utf-8") == "3\n10\n"
+
+    # Only the changed function and its caller are recompiled
+    source.write_text(PROGRAM.format(factor=3))
+    report = builder.build()
+    assert sorted(name.split("::")[-1] for name in report.recompiled) == [
+        "main",
+        "scale",
+    ]
+    assert report.linked
+    assert subp.check_output([str(out)], encoding="utf-8") == "3\n15\n"
+
+    # Moving code around changes no function; the output is restored
+    source.write_text("# moved\n\n" + PROGRAM.format(factor=3))
+    report = builder.build()
+    assert report.recompiled == []
+    assert not report.linked
+
+    # Undoing an edit restores the output of the first build
+    source.write_text(PROGRAM.format(factor=2))
+    report = builder.build()
+    assert len(report.recompiled) == 2
+    assert not report.linked
+    assert subp.check_output([str(out)], encoding="utf-8") == "3\n10\n"
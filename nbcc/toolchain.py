@@ -0,0 +1,388 @@
+"""
+Native toolchain driver.
+
+Turns the LLVM-dialect module produced by `nbcc.compiler.compile_to_mlir`
+into an executable or a shared library:
+
+    mlir-translate -> opt -> llc -> clang (link)
+
+With ThinLTO, `opt` emits summary bitcode instead and `clang -flto=thin`
+does the code generation at link time.
+
+The behaviour is controlled by `ToolchainOptions`, which is also part of the
+artifact cache key.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import logging
+import os
+import re
+import tempfile
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from nbcc import profiling
+from nbcc.developer import Lazy
+from nbcc.runtime import ALLOCATOR_SYMBOLS, compile_allocator
+
+if TYPE_CHECKING:
+    from mlir import ir
+
+_logger = logging.getLogger(__name__)
+
+# Code generation flags implied by --fast-math. Only those supported by the
+# installed `llc` are used.
+_FAST_MATH_LLC_FLAGS = (
+    "--fp-contract=fast",
+    "--enable-unsafe-fp-math",
+    "--enable-no-infs-fp-math",
+    "--enable-no-nans-fp-math",
+    "--enable-no-signed-zeros-fp-math",
+)
+
+
+@dataclass(frozen=True)
+class ToolchainOptions:
+    """Options of the native code generation.
+
+    Attributes:
+        opt_level: LLVM optimization level, 0 to 3.
+        target_cpu: CPU to generate code for; ``"native"`` for the host CPU,
+            None for the generic CPU of the host triple.
+        thin_lto: Use ThinLTO. Cross-module optimization with `libspy`
+            requires a bitcode build of it; see `libspy_bitcode()`.
+        fast_math: Allow floating point contraction and reassociation and
+            assume no NaNs, infinities or signed zeros. Sets the ``fast``
+            flags on the floating point operations of the IR given to
+            `opt`, and the corresponding `llc` options.
+    """
+
+    opt_level: int = 3
+    target_cpu: str | None = None
+    thin_lto: bool = False
+    fast_math: bool = False
+
+    def __post_init__(self):
+        if self.opt_level not in (0, 1, 2, 3):
+            raise ValueError(f"invalid opt_level: {self.opt_level}")
+
+    def resolved_cpu(self) -> str | None:
+        if self.target_cpu == "native":
+            return host_cpu()
+        return self.target_cpu
+
+    def cache_key(self) -> dict[str, Any]:
+        """Options as they affect the generated code."""
+        key = asdict(self)
+        key["target_cpu"] = self.resolved_cpu()
+        return key
+
+
+def find_mlir_runner_utils() -> str:
+    from ctypes.util import find_library
+
+    lib_path = find_library("mlir_c_runner_utils")
+    if lib_path is None:
+        raise RuntimeError("Could not find mlir_c_runner_utils library")
+    return lib_path
+
+
+def find_openmp_runtime() -> str:
+    """Path of the OpenMP runtime, LLVM's `libomp` or GNU's `libgomp`."""
+    from ctypes.util import find_library
+
+    for name in ("omp", "gomp"):
+        if lib_path := find_library(name):
+            return lib_path
+    raise RuntimeError("Could not find an OpenMP runtime (libomp/libgomp)")
+
+
+def set_omp_num_threads(num_threads: int) -> None:
+    """Set the thread count of the OpenMP kernels at runtime.
+
+    Only applies to modules compiled without a fixed thread count; see
+    `Backend.omp_num_threads`.
+    """
+    ctypes.CDLL(find_openmp_runtime()).omp_set_num_threads(num_threads)
+
+
+def uses_openmp(module: ir.Module) -> bool:
+    """True if the LLVM-dialect module has OpenMP parallel regions."""
+    # The control flow is lowered to blocks by now, so the OpenMP
+    # operations are at the top level of the function bodies.
+    for fn in module.body.operations:
+        for region in fn.regions:
+            for block in region.blocks:
+                for op in block.operations:
+                    if op.operation.name.startswith("omp."):
+                        return True
+    return False
+
+
+# Operations of the LLVM dialect with fast-math flags, besides the
+# intrinsics
+_FAST_MATH_OPS = frozenset(
+    [
+        "llvm.fadd",
+        "llvm.fsub",
+        "llvm.fmul",
+        "llvm.fdiv",
+        "llvm.frem",
+        "llvm.fneg",
+        "llvm.fcmp",
+        "llvm.call",
+    ]
+)
+
+
+def add_fast_math_flags(module: ir.Operation) -> None:
+    """Set the ``fast`` flags on the floating point operations of the
+    LLVM-dialect module, so that `opt` may reassociate and contract them.
+
+    `mlir-translate` only applies the flags to the calls and intrinsics that
+    return floating point values.
+    """
+    from mlir import ir
+
+    fast = ir.Attribute.parse("#llvm.fastmath<fast>", context=module.context)
+    for op in _walk(module):
+        if op.name in _FAST_MATH_OPS or op.name.startswith("llvm.intr."):
+            op.attributes["fastmathFlags"] = fast
+
+
+def _walk(op: ir.Operation):
+    for region in op.regions:
+        for block in region.blocks:
+            for child in block.operations:
+                yield child.operation
+                yield from _walk(child.operation)
+
+
+def uses_pool_allocator(module: ir.Module) -> bool:
+    """True if the LLVM-dialect module calls the allocation functions of
+    the pool allocator; see `nbcc.runtime`."""
+    from mlir import ir
+
+    for op in module.body.operations:
+        if "sym_name" not in op.attributes:
+            continue
+        if ir.StringAttr(op.attributes["sym_name"]).value in ALLOCATOR_SYMBOLS:
+            return True
+    return False
+
+
+def libspy_dir() -> Path:
+    import spy
+
+    spydir = os.path.dirname(spy.__file__)
+    return Path(spydir) / "libspy" / "build" / "native" / "release"
+
+
+def libspy_bitcode() -> Path | None:
+    """Bitcode archive of `libspy` for ThinLTO, if available.
+
+    Set `$NBCC_LIBSPY_BITCODE` to the archive built with `-flto=thin`.
+    """
+    if path := os.environ.get("NBCC_LIBSPY_BITCODE"):
+        return Path(path)
+    return None
+
+
+@lru_cache(maxsize=None)
+def host_triple() -> str:
+    return profiling.check_output(
+        ["llvm-config", "--host-target"], encoding="utf8"
+    ).strip()
+
+
+@lru_cache(maxsize=None)
+def host_cpu() -> str:
+    """Name of the host CPU as reported by `llc --version`."""
+    out = profiling.check_output(["llc", "--version"], encoding="utf8")
+    if m := re.search(r"Host CPU:\s*(\S+)", out):
+        return m.group(1)
+    return "generic"
+
+
+@lru_cache(maxsize=None)
+def _llc_supported_flags() -> frozenset[str]:
+    out = profiling.check_output(
+        ["llc", "--help-list-hidden"], encoding="utf8"
+    )
+    return frozenset(re.findall(r"^\s+(--[\w-]+)", out, re.MULTILINE))
+
+
+def _read_text(path: str | Path) -> str:
+    with open(path) as fin:
+        return fin.read()
+
+
+class Toolchain:
+    """Driver of the external LLVM tools."""
+
+    def __init__(self, options: ToolchainOptions | None = None):
+        self.options = options or ToolchainOptions()
+
+    def _cpu_flags(self, flag: str) -> list[str]:
+        cpu = self.options.resolved_cpu()
+        return [f"{flag}={cpu}"] if cpu else []
+
+    def _fast_math_flags(self) -> list[str]:
+        if not self.options.fast_math:
+            return []
+        supported = _llc_supported_flags()
+        return [
+            flag
+            for flag in _FAST_MATH_LLC_FLAGS
+            if flag.split("=")[0] in supported
+        ]
+
+    def translate(self, module: ir.Module, workdir: Path) -> Path:
+        """Translate the module to LLVM IR."""
+        mlir_file = workdir / "module.mlir"
+        if self.options.fast_math:
+            with profiling.stage("add_fast_math_flags"):
+                # On a copy, the module may be compiled again without
+                module = module.operation.clone()
+                add_fast_math_flags(module.operation)
+        with profiling.stage("emit_mlir_asm"):
+            with open(mlir_file, "w") as fout:
+                print(
+                    module.operation.get_asm(enable_debug_info=True), file=fout
+                )
+        ll_file = workdir / "module.orig.ll"
+        profiling.check_call(
+            [
+                "mlir-translate",
+                "--mlir-to-llvmir",
+                str(mlir_file),
+                "-o",
+                str(ll_file),
+            ]
+        )
+        _logger.debug(
+            "%s\n%s", str(ll_file).center(80, "-"), Lazy(_read_text, ll_file)
+        )
+        return ll_file
+
+    def optimize(self, ll_file: Path, workdir: Path) -> Path:
+        """Run the LLVM optimization pipeline.
+
+        Returns textual IR, or ThinLTO summary bitcode with `thin_lto`.
+        """
+        opts = self.options
+        cmd = [
+            "opt",
+            f"-passes=default<O{opts.opt_level}>",
+            f"-mtriple={host_triple()}",
+            *self._cpu_flags("-mcpu"),
+            str(ll_file),
+        ]
+        if opts.thin_lto:
+            out = workdir / "module.bc"
+            cmd += ["--thinlto-bc", "-o", str(out)]
+        else:
+            out = workdir / "module.opt.ll"
+            cmd += ["-S", "-o", str(out)]
+        profiling.check_call(cmd)
+        if not opts.thin_lto:
+            _logger.debug(
+                "%s\n%s\n%s",
+                str(out).center(80, "-"),
+                Lazy(_read_text, out),
+                80 * "=",
+            )
+        return out
+
+    def codegen(self, opt_file: Path, workdir: Path) -> Path:
+        """Compile optimized IR to a native object file."""
+        obj = workdir / "module.o"
+        profiling.check_call(
+            [
+                "llc",
+                f"-O{self.options.opt_level}",
+                "-filetype=obj",
+                "--relocation-model=pic",
+                *self._cpu_flags("-mcpu"),
+                *self._fast_math_flags(),
+                str(opt_file),
+                "-o",
+                str(obj),
+            ]
+        )
+        return obj
+
+    def compile_module(self, module: ir.Module, workdir: Path) -> Path:
+        """Compile the module to an object file, or bitcode for ThinLTO."""
+        optimized = self.optimize(self.translate(module, workdir), workdir)
+        if self.options.thin_lto:
+            return optimized
+        return self.codegen(optimized, workdir)
+
+    def link(
+        self,
+        inputs: list[Path],
+        out_path: str | Path,
+        *,
+        shared: bool,
+        openmp: bool = False,
+    ) -> None:
+        opts = self.options
+        cmd = ["clang", f"-O{opts.opt_level}"]
+        if shared:
+            cmd.append("-shared")
+        if openmp:
+            cmd.append("-fopenmp")
+        cmd += ["-o", str(out_path), *map(str, inputs)]
+        if opts.thin_lto:
+            cmd += ["-flto=thin", "-fuse-ld=lld"]
+            cmd += self._cpu_flags("-march")
+            if opts.fast_math:
+                cmd.append("-ffast-math")
+            if bitcode := libspy_bitcode():
+                cmd.append(str(bitcode))
+            else:
+                cmd += [f"-L{libspy_dir()}", "-lspy"]
+        else:
+            cmd += [f"-L{libspy_dir()}", "-lspy"]
+        if shared:
+            runner_dir = os.path.dirname(find_mlir_runner_utils())
+            cmd += [f"-L{runner_dir}", "-lmlir_c_runner_utils"]
+        profiling.check_call(cmd)
+
+    def compile_runtime(self, module: ir.Module, workdir: Path) -> list[Path]:
+        """Object files of the runtime support used by the module."""
+        if not uses_pool_allocator(module):
+            return []
+        obj = workdir / "nbcc_alloc.o"
+        with profiling.stage("compile_allocator"):
+            compile_allocator(obj, opt_level=self.options.opt_level)
+        return [obj]
+
+    def make_shared(self, module: ir.Module, out_path: str | Path) -> None:
+        with profiling.stage("make_shared"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                workdir = Path(tmpdir)
+                obj = self.compile_module(module, workdir)
+                self.link(
+                    [obj, *self.compile_runtime(module, workdir)],
+                    out_path,
+                    shared=True,
+                    openmp=uses_openmp(module),
+                )
+
+    def make_binary(self, module: ir.Module, out_path: str | Path) -> None:
+        with profiling.stage("make_binary"):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                workdir = Path(tmpdir)
+                obj = self.compile_module(module, workdir)
+                self.link(
+                    [obj, *self.compile_runtime(module, workdir)],
+                    out_path,
+                    shared=False,
+                    openmp=uses_openmp(module),
+                )
@@ -0,0 +1,405 @@
+"""
+Watch mode: rebuild a SPy program when its sources change.
+
+`nbcc watch input.spy out.so` builds the output, then polls the source and
+the local `.spy` modules it imports and rebuilds whenever one is modified.
+The rebuilds are incremental per function:
+
+* The frontend runs on every rebuild, since SPy redshifts whole modules. It
+  computes a structural hash of every function, which ignores the source
+  locations (`FunctionInfo.ast_hash`).
+* The key of a function combines its hash, the keys of the functions it
+  calls and the layout of the structs, so that a change also rebuilds the
+  callers of the changed function.
+* The egraph middle-end and the lowering only run for the functions whose
+  key is not cached. Each function is lowered into a module of its own, with
+  declarations of its callees, and that module is cached as text. The module
+  of the program is assembled from the cached modules.
+* The backend pass pipeline, including the per-function transforms, and the
+  toolchain run on the assembled module, since inlining crosses functions.
+  If the assembled module was built before (e.g. only a comment changed, or
+  an edit was undone) the output is restored from the artifact cache.
+
+Every rebuild prints its latency per stage and how many functions were
+recompiled; see `RebuildReport`.
+
+The lowered functions are cached in memory only: the names of the string
+constants in the lowered code come from `hash()`, which differs between
+processes.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Mapping, Sequence
+
+from nbcc import profiling
+from nbcc.cache import ArtifactCache, find_imports, is_cache_disabled
+from nbcc.compiler import artifact_key
+from nbcc.profiling import CompileStats, stage
+from nbcc.toolchain import Toolchain, ToolchainOptions
+
+if TYPE_CHECKING:
+    import sealir.rvsdg.grammar as rg
+    from mlir import ir
+    from spy.fqn import FQN
+
+    from nbcc.frontend.frontend import TranslationUnit
+    from nbcc.mlir_backend.backend import Backend
+    from nbcc.frontend.grammar import IRTag, TypeInfo
+
+_logger = logging.getLogger(__name__)
+
+# The stages shown in the report of a rebuild
+REPORTED_STAGES = (
+    "frontend",
+    "middle_end",
+    "lower",
+    "assemble",
+    "run_passes",
+    "toolchain",
+)
+
+
+@dataclass(frozen=True)
+class RebuildReport:
+    """Outcome of `IncrementalBuilder.build()`."""
+
+    # Wall time of the rebuild in seconds
+    seconds: float
+    # The functions of the program
+    functions: int
+    # The functions that went through the middle-end and the lowering
+    recompiled: list[str]
+    # False if the output was restored from the artifact cache
+    linked: bool
+    stats: CompileStats = field(repr=False, compare=False)
+
+    @property
+    def reused(self) -> int:
+        return self.functions - len(self.recompiled)
+
+    def stage_seconds(self) -> dict[str, float]:
+        return {name: self.stats.total(name) for name in REPORTED_STAGES}
+
+    def format(self) -> str:
+        action = "rebuilt" if self.linked else "restored from the cache"
+        stages = ", ".join(
+            f"{name} {secs * 1e3:.0f} ms"
+            for name, secs in self.stage_seconds().items()
+            if secs
+        )
+        return (
+            f"{action} in {self.seconds * 1e3:.0f} ms:"
+            f" {len(self.recompiled)} function(s) recompiled,"
+            f" {self.reused} reused ({stages})"
+        )
+
+
+@dataclass(frozen=True)
+class _LoweredFunction:
+    # Module with the function and the declarations of its callees
+    asm: str
+    # The `mlir.transforms` of the function, by symbol name
+    transforms: dict[str, list[str]]
+
+
+class IncrementalBuilder:
+    """Build `path` into `out_path`, reusing the lowered functions of the
+    previous build.
+
+    Args:
+        kind: ``"shared"`` for a shared library, ``"binary"`` for an
+            executable.
+        backend_options: Keyword arguments for `Backend.create()`.
+        use_cache: Restore outputs from the artifact cache.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        out_path: str | Path,
+        *,
+        kind: str = "shared",
+        backend_options: Mapping[str, Any] | None = None,
+        toolchain: ToolchainOptions | None = None,
+        use_cache: bool = True,
+    ):
+        if kind not in ("shared", "binary"):
+            raise ValueError(f"unknown output kind {kind!r}")
+        self.path = str(path)
+        self.out_path = str(out_path)
+        self.kind = kind
+        self.backend_options = dict(backend_options or {})
+        self.toolchain = toolchain or ToolchainOptions()
+        self.use_cache = use_cache and not is_cache_disabled()
+        self._functions: dict[str, _LoweredFunction] = {}
+
+    def sources(self) -> list[Path]:
+        """The source and the local modules it imports."""
+        return [Path(self.path).resolve(), *find_imports(self.path)]
+
+    def build(self) -> RebuildReport:
+        stats = CompileStats()
+        start = time.perf_counter()
+        with profiling.collect(stats), stage("rebuild"):
+            recompiled, linked = self._build()
+        return RebuildReport(
+            seconds=time.perf_counter() - start,
+            functions=len(self._functions),
+            recompiled=recompiled,
+            linked=linked,
+            stats=stats,
+        )
+
+    def _build(self) -> tuple[list[str], bool]:
+        from nbcc.frontend import frontend
+        from nbcc.middle_end import optimize_function
+        from nbcc.mlir_backend.backend import Backend
+
+        with stage("frontend"):
+            tu = frontend(self.path)
+        keys = function_keys(tu)
+        changed = [
+            fqn for fqn, key in keys.items() if key not in self._functions
+        ]
+        _logger.debug("recompiling %s", changed)
+
+        be = Backend.create(tu, **self.backend_options)
+        with stage("middle_end"):
+            optimized = {fqn: optimize_function(tu, fqn) for fqn in changed}
+        for fqn, (func_nodes, mdlist) in optimized.items():
+            with stage("lower", fn=fqn.fullname):
+                self._functions[keys[fqn]] = _lower_function(
+                    be, self.path, func_nodes, mdlist
+                )
+        # Drop the functions that are no longer in the program
+        self._functions = {key: self._functions[key] for key in keys.values()}
+
+        with stage("assemble"):
+            module, transforms = _assemble(
+                be, self.path, [self._functions[key] for key in keys.values()]
+            )
+        cache = ArtifactCache()
+        key = self._artifact_key(module)
+        if self.use_cache and cache.fetch(key, self.out_path):
+            return [fqn.fullname for fqn in changed], False
+
+        with stage("run_passes"):
+            module = be.run_passes(module, transforms=transforms)
+        with stage("toolchain"):
+            if self.kind == "shared":
+                Toolchain(self.toolchain).make_shared(module, self.out_path)
+            else:
+                Toolchain(self.toolchain).make_binary(module, self.out_path)
+        if self.use_cache:
+            cache.store(key, self.out_path)
+        return [fqn.fullname for fqn in changed], True
+
+    def _artifact_key(self, module: ir.Module) -> str:
+        # The key of `nbcc.compiler`, with the assembled module as the input
+        return artifact_key(
+            self.path,
+            self.kind,
+            self.toolchain,
+            self.backend_options,
+            source_digest=_digest(
+                module.operation.get_asm(enable_debug_info=True)
+            ),
+        )
+
+
+def function_keys(tu: TranslationUnit) -> dict[FQN, str]:
+    """Key of every function of `tu`, in the order of
+    `tu.list_functions()`.
+
+    The key of a function changes when its structural hash, the key of a
+    function it calls (transitively) or the layout of a struct changes.
+    """
+    layouts = sorted(
+        (str(fqn), [(f.name, str(f.w_T)) for f in w_struct.iterfields_w()])
+        for fqn, w_struct in tu._structs.items()
+    )
+    unit_hash = _digest(repr(layouts))
+    functions = set(tu.list_functions())
+    keys: dict[FQN, str] = {}
+
+    def key_of(fqn: FQN, visiting: set[FQN]) -> str:
+        if fqn in keys:
+            return keys[fqn]
+        fi = tu.get_function(fqn)
+        if fqn in visiting:
+            # Recursion: the cycle is covered by the hashes of its members
+            return fi.ast_hash
+        visiting.add(fqn)
+        callees = sorted(fi.callees & functions, key=str)
+        key = _digest(
+            "|".join(
+                [
+                    fi.ast_hash,
+                    unit_hash,
+                    *(key_of(c, visiting) for c in callees),
+                ]
+            )
+        )
+        visiting.discard(fqn)
+        keys[fqn] = key
+        return key
+
+    return {fqn: key_of(fqn, set()) for fqn in tu.list_functions()}
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _lower_function(
+    be: Backend,
+    name: str,
+    func_nodes: dict[str, rg.Func],
+    mdlist: Sequence[TypeInfo | IRTag],
+) -> _LoweredFunction:
+    from nbcc.mlir_lowering import Lowering, MDMap
+
+    mdmap = MDMap()
+    mdmap.load(mdlist)
+    module = be.make_module(name)
+    transforms: dict[str, list[str]] = {}
+    for rvsdg_ir in func_nodes.values():
+        lowering = Lowering(be, module, mdmap, func_nodes)
+        fn_op = lowering.lower(rvsdg_ir)
+        irtags = lowering.irtags(rvsdg_ir)
+        if mlir_transforms := irtags.get("mlir.transforms"):
+            transforms[fn_op.name.value] = [v for k, v in mlir_transforms]
+    _declare_callees(be, module)
+    return _LoweredFunction(
+        module.operation.get_asm(enable_debug_info=True), transforms
+    )
+
+
+def _declare_callees(be: Backend, module: ir.Module) -> None:
+    """Declare the functions called by `module` but defined elsewhere, so
+    that it verifies on its own."""
+    from mlir import ir
+
+    defined = {
+        ir.StringAttr(op.attributes["sym_name"]).value
+        for op in module.body.operations
+        if "sym_name" in op.attributes
+    }
+    declarations: dict[str, tuple[list[ir.Type], list[ir.Type]]] = {}
+    for op in _walk(module.operation):
+        if op.name != "func.call":
+            continue
+        callee = ir.FlatSymbolRefAttr(op.attributes["callee"]).value
+        if callee not in defined:
+            declarations[callee] = (
+                [v.type for v in op.operands],
+                [r.type for r in op.results],
+            )
+    with be.context, ir.Location.unknown(), ir.InsertionPoint(module.body):
+        for callee, (arg_types, result_types) in declarations.items():
+            be.create_function_declaration(callee, arg_types, result_types)
+
+
+def _walk(op: ir.Operation):
+    for region in op.regions:
+        for block in region.blocks:
+            for child in block.operations:
+                yield child.operation
+                yield from _walk(child.operation)
+
+
+def _assemble(
+    be: Backend, name: str, functions: Sequence[_LoweredFunction]
+) -> tuple[ir.Module, dict[str, list[str]]]:
+    """Merge the modules of `functions` into a new module.
+
+    Symbols defined by several modules, i.e. the string constants and the
+    declarations, are kept once; definitions take precedence over
+    declarations.
+    """
+    from mlir import ir
+
+    parts = [ir.Module.parse(fn.asm, context=be.context) for fn in functions]
+    defined = {
+        _symbol(op)
+        for part in parts
+        for op in part.body.operations
+        if _symbol(op) is not None and not _is_declaration(op)
+    }
+    module = be.make_module(name)
+    seen: set[str] = set()
+    transforms: dict[str, list[str]] = {}
+    for part, fn in zip(parts, functions):
+        for op in list(part.body.operations):
+            symbol = _symbol(op)
+            if symbol is not None:
+                if symbol in seen or (
+                    _is_declaration(op) and symbol in defined
+                ):
+                    continue
+                seen.add(symbol)
+            module.body.append(op)
+        transforms.update(fn.transforms)
+    with stage("verify"):
+        module.operation.verify()
+    return module, transforms
+
+
+def _symbol(op: Any) -> str | None:
+    from mlir import ir
+
+    if "sym_name" not in op.attributes:
+        return None
+    return ir.StringAttr(op.attributes["sym_name"]).value
+
+
+def _is_declaration(op: Any) -> bool:
+    return op.operation.name == "func.func" and len(op.regions[0].blocks) == 0
+
+
+def watch(
+    builder: IncrementalBuilder,
+    *,
+    interval: float = 0.5,
+    once: bool = False,
+    echo: Callable[[str], None] = print,
+) -> None:
+    """Build with `builder` every time one of its sources is modified.
+
+    Failed builds are reported with `echo` and the sources are watched for
+    the next change.
+
+    Args:
+        interval: Seconds between two checks of the modification times.
+        once: Build once and return; build errors are raised.
+    """
+    mtimes: dict[Path, int] | None = None
+    while True:
+        try:
+            current = {p: os.stat(p).st_mtime_ns for p in builder.sources()}
+        except OSError:
+            if once:
+                raise
+            # Saved in the middle of the check; look again
+            current = None
+        if current is not None and current != mtimes:
+            mtimes = current
+            try:
+                report = builder.build()
+            except Exception as e:
+                if once:
+                    raise
+                _logger.debug("build failed", exc_info=True)
+                echo(f"build failed: {type(e).__name__}: {e}")
+            else:
+                echo(report.format())
+            if once:
+                return
+        time.sleep(interval)